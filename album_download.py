@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+
+import content_cache
+import http_transport
+import pipeline_metrics
+from google_logging import structured_log, LogSeverity
+
+# stays below http_transport.POOL_MAXSIZE, so every worker keeps its own keep-alive connection
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 16))
+# sidecar file in the download directory recording the size of every finished download
+DOWNLOAD_INDEX_FILE_NAME = '.download_index.json'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+# http_transport retries failed requests, these attempts cover connections dropped while streaming the body
+MAX_DOWNLOAD_ATTEMPTS = 3
+PROGRESS_LOG_INTERVAL = 100
+
+
+class AlbumDownloader:
+    '''
+    Downloads images into a directory with a pool of threads.
+    The response bytes are written as they are, into a temporary file that is renamed once complete,
+    so an interrupted download never leaves a truncated image behind.
+    Finished downloads are recorded in a sidecar index, and a rerun skips files on disk whose size matches it.
+    A MediaUrl is copied from the content cache if it is there, and added to it once downloaded.
+    Use it as a context manager so that all downloads are waited for and the index is written on exit.
+    '''
+
+    def __init__(self, download_dir, workers=DOWNLOAD_WORKERS, log_every=PROGRESS_LOG_INTERVAL):
+        '''
+        Args:
+            download_dir: string, directory to download the images to, created if missing
+            workers: int, number of concurrent downloads
+            log_every: int, number of finished files after which the progress is logged
+        '''
+        self.download_dir = download_dir
+        self.log_every = log_every
+        os.makedirs(download_dir, exist_ok=True)
+        self.index_file_path = os.path.join(download_dir, DOWNLOAD_INDEX_FILE_NAME)
+        self.sizes = {}
+        if os.path.exists(self.index_file_path):
+            with open(self.index_file_path) as f:
+                self.sizes = json.load(f)
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        self.failed = []
+        self.futures = []
+        self.started_at = time.monotonic()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_downloaded(self, file_name):
+        file_path = os.path.join(self.download_dir, file_name)
+        return file_name in self.sizes and os.path.exists(file_path) and os.path.getsize(file_path) == self.sizes[file_name]
+
+    def submit(self, url, file_name):
+        '''
+        Starts downloading url into file_name in the download directory, unless it is already there
+        returns: a future of the file path, None if the file was already downloaded
+        '''
+        if self.is_downloaded(file_name):
+            self._finished('skipped')
+            return None
+        future = self.executor.submit(self._download, url, file_name)
+        self.futures.append(future)
+        return future
+
+    def _download(self, url, file_name):
+        file_path = os.path.join(self.download_dir, file_name)
+        temp_file_path = file_path + '.part'
+        key = content_cache.cache_key(url)
+        cached_path = None if key is None else content_cache.get_content_cache().path(key)
+        if cached_path is not None:
+            try:
+                shutil.copyfile(cached_path, temp_file_path)
+                os.replace(temp_file_path, file_path)
+                return self._downloaded(file_name, file_path, os.path.getsize(file_path))
+            except OSError as e:
+                # evicted meanwhile, downloaded below
+                structured_log('Cannot copy {} from the content cache: {!r}'.format(file_name, e), severity=LogSeverity.WARNING)
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            try:
+                size = 0
+                with pipeline_metrics.span('download') as span, http_transport.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    response.raise_for_status()
+                    with open(temp_file_path, 'wb') as f:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            size += len(chunk)
+                    span.add(items=1, bytes=size)
+                os.replace(temp_file_path, file_path)
+                break
+            except (ConnectionError, Timeout, ChunkedEncodingError) as e:
+                if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                    return self._failed(file_name, temp_file_path, e)
+                structured_log('Download of {} interrupted, retrying: {!r}'.format(file_name, e), severity=LogSeverity.WARNING)
+            except Exception as e:
+                return self._failed(file_name, temp_file_path, e)
+        if key is not None:
+            content_cache.get_content_cache().put_file(key, file_path)
+        return self._downloaded(file_name, file_path, size)
+
+    def _downloaded(self, file_name, file_path, size):
+        with self.lock:
+            self.sizes[file_name] = size
+            self.stats['bytes'] += size
+        self._finished('downloaded')
+        return file_path
+
+    def _failed(self, file_name, temp_file_path, e):
+        structured_log('Failed to download {}: {!r}'.format(file_name, e), severity=LogSeverity.ERROR)
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        with self.lock:
+            self.failed.append((file_name, repr(e)))
+        self._finished('failed')
+        return None
+
+    def _finished(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+            finished = self.stats['downloaded'] + self.stats['skipped'] + self.stats['failed']
+            if finished % self.log_every == 0:
+                self._log_progress()
+                # a crash loses at most log_every entries of the index
+                self._save_index()
+
+    def _log_progress(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        structured_log('Downloaded {downloaded}, skipped {skipped}, failed {failed} files, '.format(**self.stats) +
+                       '{:.1f} files/s, {:.1f} MiB/s'.format(self.stats['downloaded'] / elapsed, self.stats['bytes'] / elapsed / (1024 * 1024)))
+
+    def _save_index(self):
+        temp_index_file_path = self.index_file_path + '.part'
+        with open(temp_index_file_path, 'w') as f:
+            json.dump(self.sizes, f)
+        os.replace(temp_index_file_path, self.index_file_path)
+
+    def wait(self):
+        '''
+        Waits for all submitted downloads
+        '''
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        '''
+        returns: dict of download counts
+        '''
+        self.wait()
+        self.executor.shutdown()
+        with self.lock:
+            self._save_index()
+            self._log_progress()
+        return self.stats
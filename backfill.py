@@ -0,0 +1,141 @@
+import argparse
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date, timedelta
+from multiprocessing.util import Finalize
+
+from google_photo_api import GooglePhotoHelper
+from incremental_discovery import candidate_days
+from google_logging import structured_log, LogSeverity, flush_logs
+import pipeline_metrics
+
+DEFAULT_BACKFILL_WORKERS = 4
+# number of days listed with a single paginated dateFilter.ranges search
+DEFAULT_DAYS_PER_SEARCH = 31
+
+# set in every worker process by _init_worker
+_worker_helper = None
+# face album id, ContentDedupIndex and FaceCropEngine shared by all days a worker processes
+_worker_state = None
+
+
+def _init_worker(cred_bytes):
+    global _worker_helper, _worker_state
+    # imported here since main imports this module for batch_process_photo
+    from main import upsert_face_album, TEST_BUCKET_NAME
+    from face_crop import FaceCropEngine
+    from content_dedup import ContentDedupIndex
+    from google_cloud_storage_api import GoogleStorageHelper
+    # all workers share the credentials of the parent instead of each loading them from the secret
+    _worker_helper = GooglePhotoHelper(cred=pickle.loads(cred_bytes))
+    crop_engine = FaceCropEngine()
+    # pool workers exit without running atexit handlers, multiprocessing finalizers do run
+    Finalize(crop_engine, crop_engine.close, exitpriority=10)
+    _worker_state = {
+        'album_id': upsert_face_album(_worker_helper),
+        'dedup_index': ContentDedupIndex(GoogleStorageHelper(TEST_BUCKET_NAME)),
+        'crop_engine': crop_engine,
+    }
+
+
+def _process_day(day, dry_run):
+    from main import face_image_generation_for_google_photo
+    start = time.monotonic()
+    try:
+        # the day is searched again here, right before its downloads: baseUrls of the listing expire after an hour,
+        # and the manifest is keyed by the searched day exactly as in the daily runs
+        face_image_generation_for_google_photo(day.year, day.month, day.day, dry_run=dry_run, helper=_worker_helper, **_worker_state)
+    finally:
+        # pool workers exit without running atexit handlers, so buffered log entries are written now
+        flush_logs()
+    return time.monotonic() - start
+
+
+def iter_date_windows(start_date, end_date, days_per_search=DEFAULT_DAYS_PER_SEARCH):
+    '''
+    Splits an inclusive date range into inclusive windows of at most days_per_search days
+    '''
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(end_date, window_start + timedelta(days=days_per_search - 1))
+        yield window_start, window_end
+        window_start = window_end + timedelta(days=1)
+
+
+def iter_days_with_items(helper, start_date, end_date, days_per_search=DEFAULT_DAYS_PER_SEARCH):
+    '''
+    Lists the date range one window at a time, only as far as the days are consumed
+    yields:
+        the days that may have items, in order
+    '''
+    for window_start, window_end in iter_date_windows(start_date, end_date, days_per_search):
+        days = set()
+        item_count = 0
+        for item in helper.search_media_items_by_date_range(window_start, window_end, ['PHOTO'], prefetch=True):
+            days.update(candidate_days(item, window_start, window_end))
+            item_count += 1
+        structured_log('Listed {} items between {} and {}, {} days to process'.format(item_count, window_start, window_end, len(days)))
+        yield from sorted(days)
+
+
+def backfill(start_date, end_date, workers=DEFAULT_BACKFILL_WORKERS, days_per_search=DEFAULT_DAYS_PER_SEARCH, dry_run=False):
+    '''
+    Generates face images for every day between two dates, both inclusive.
+    Many days are listed with one search to find the days with photos, and those days are processed in parallel
+    by a pool of worker processes. A window is only listed once the workers are about to run out of days,
+    and every worker searches its day itself, so no download uses a baseUrl older than a day takes to process.
+    A worker looks the face album up, loads the dedup index and starts its crop pool once, for all of its days.
+    Args:
+        start_date: datetime.date, first day to process
+        end_date: datetime.date, last day to process
+        workers: int, number of worker processes
+        days_per_search: int, number of days listed per mediaItems:search
+        dry_run: boolean, passed on to face_image_generation_for_google_photo
+    '''
+    helper = GooglePhotoHelper()
+    cred_bytes = pickle.dumps(helper.cred)
+    start = time.monotonic()
+    pending = {}
+    submitted_days = 0
+    done_days = 0
+    failed_days = 0
+    structured_log('Backfilling {} to {} with {} workers'.format(start_date, end_date, workers))
+
+    def finish(futures):
+        nonlocal done_days, failed_days
+        for future in futures:
+            day = pending.pop(future)
+            try:
+                seconds = future.result()
+            except Exception as e:
+                failed_days += 1
+                structured_log('Backfill of {} failed: {!r}'.format(day, e), severity=LogSeverity.ERROR)
+                continue
+            done_days += 1
+            structured_log('Backfilled {} in {:.0f}s: {} of {} days listed so far, {:.1f} days/h'.format(
+                day, seconds, done_days, submitted_days, done_days * 3600 / (time.monotonic() - start)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cred_bytes,)) as executor:
+        for day in iter_days_with_items(helper, start_date, end_date, days_per_search):
+            # keep every worker busy with one day queued behind it, and no more
+            if len(pending) >= 2 * workers:
+                finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[executor.submit(_process_day, day, dry_run)] = day
+            submitted_days += 1
+        while pending:
+            finish(wait(pending, return_when=FIRST_COMPLETED).done)
+    structured_log('Backfill done: {} of {} days, {} failed, in {:.0f}s'.format(done_days, submitted_days, failed_days, time.monotonic() - start))
+    # the days report their own stages, this covers the listing done here
+    pipeline_metrics.log_summary('backfill {} to {}'.format(start_date, end_date))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate face images for every day in a date range')
+    parser.add_argument('start_date', type=date.fromisoformat, help='first day, e.g. 2022-01-01')
+    parser.add_argument('end_date', type=date.fromisoformat, help='last day, inclusive, e.g. 2022-12-31')
+    parser.add_argument('--workers', type=int, default=DEFAULT_BACKFILL_WORKERS)
+    parser.add_argument('--days-per-search', type=int, default=DEFAULT_DAYS_PER_SEARCH)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    backfill(args.start_date, args.end_date, workers=args.workers, days_per_search=args.days_per_search, dry_run=args.dry_run)
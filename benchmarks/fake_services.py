@@ -0,0 +1,464 @@
+'''
+Local stand-ins for the Photos Library REST api, GCS and Vision async batch annotation,
+so that the pipeline can be measured without network access or quota.
+'''
+import contextlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import piexif
+from PIL import Image, ImageDraw
+from google.api_core.exceptions import PreconditionFailed
+
+import pipeline_metrics
+from google_cloud_storage_api import HttpSourceStream, STREAM_CHUNK_SIZE
+
+PHOTOS_API_URL = 'https://photoslibrary.googleapis.com'
+
+
+def make_jpeg(width, height, faces, seed=0, quality=90):
+    '''
+    Synthetic photo: noise, so that it compresses like a real photo, with a light ellipse per face
+    Args:
+        width, height: int, size of the image
+        faces: list of (left, top, right, bottom) boxes
+        seed: int, seed of the noise
+    returns:
+        JPEG bytes with a DateTimeOriginal in the EXIF data
+    '''
+    rng = random.Random(seed)
+    # noise at 1/8 scale, scaled up, is much faster to make than full resolution noise
+    small = Image.frombytes('RGB', (max(1, width // 8), max(1, height // 8)), bytes(rng.getrandbits(8) for _ in range(3 * max(1, width // 8) * max(1, height // 8))))
+    image = small.resize((width, height))
+    draw = ImageDraw.Draw(image)
+    for box in faces:
+        draw.ellipse(box, fill=(230, 190, 160))
+    exif_dict = {'0th': {}, 'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2022:01:01 12:00:00'}}
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, exif=piexif.dump(exif_dict))
+    return buffer.getvalue()
+
+
+class FakeLibrary:
+    '''
+    Synthetic media items of a single day, each with a few faces at known positions
+    '''
+
+    def __init__(self, items=100, width=1600, height=1200, faces_per_item=2, day=(2022, 1, 1), seed=0):
+        self.width = width
+        self.height = height
+        self.day = day
+        self.items = []
+        self.faces = {}
+        self.content = {}
+        rng = random.Random(seed)
+        year, month, day_of_month = day
+        for i in range(items):
+            file_name = f'IMG_{i:05d}.jpg'
+            boxes = []
+            for _ in range(faces_per_item):
+                size = rng.randint(height // 10, height // 4)
+                left, top = rng.randint(0, width - size), rng.randint(0, height - size)
+                boxes.append((left, top, left + size, top + size))
+            self.faces[file_name] = boxes
+            self.content[f'item{i}'] = make_jpeg(width, height, boxes, seed=i)
+            self.items.append({
+                'id': f'item{i}',
+                'filename': file_name,
+                'mimeType': 'image/jpeg',
+                'mediaMetadata': {
+                    'creationTime': f'{year:04d}-{month:02d}-{day_of_month:02d}T12:00:{i % 60:02d}Z',
+                    'width': str(width),
+                    'height': str(height),
+                    'photo': {},
+                },
+            })
+
+
+class FakeServerConfig:
+    '''
+    Behavior of the fake servers
+    Args:
+        latency: float, seconds added to every request
+        error_rate: float, share of requests answered with 503
+        quota_per_second: int, requests per second above which requests are answered with 429, 0 for no quota
+        bandwidth_mbps: float, MiB per second each download is limited to, 0 for no limit
+    '''
+
+    def __init__(self, latency=0.0, error_rate=0.0, quota_per_second=0, bandwidth_mbps=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_per_second = quota_per_second
+        self.bandwidth_mbps = bandwidth_mbps
+
+
+class FakePhotosServer:
+    '''
+    HTTP server answering the Photos Library endpoints the helpers use, and serving the media bytes of the library:
+    mediaItems:search, albums (list, get and create), uploads, mediaItems:batchCreate,
+    and baseUrl downloads with =d, =dv and =w{N}-h{N}, including Range requests
+    '''
+
+    def __init__(self, library, config=None, page_size=100):
+        self.library = library
+        self.config = config or FakeServerConfig()
+        self.page_size = page_size
+        self.albums = {}
+        # album ids are never reused, like in the api, even after an album is removed from albums
+        self.created_albums = 0
+        self.album_items = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        for item in library.items:
+            item['baseUrl'] = f"{self.url}/media/{item['id']}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _admit(self):
+        '''
+        returns: None if the request is served, otherwise the error status to answer with
+        '''
+        with self.lock:
+            self.requests += 1
+            if self.config.quota_per_second:
+                now = time.monotonic()
+                if now - self.window_start >= 1:
+                    self.window_start, self.window_requests = now, 0
+                self.window_requests += 1
+                if self.window_requests > self.config.quota_per_second:
+                    self.throttled += 1
+                    return 429
+            if random.random() < self.config.error_rate:
+                self.failed += 1
+                return 503
+        return None
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', content_type='application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if fake.config.bandwidth_mbps and len(body) > 65536:
+                    chunk_size = 65536
+                    for start in range(0, len(body), chunk_size):
+                        self.wfile.write(body[start:start + chunk_size])
+                        time.sleep(chunk_size / (fake.config.bandwidth_mbps * 1024 * 1024))
+                else:
+                    self.wfile.write(body)
+
+            def _send_json(self, payload):
+                self._send(200, json.dumps(payload).encode('utf-8'))
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return self.rfile.read(length) if length else b''
+
+            def _begin(self):
+                time.sleep(fake.config.latency)
+                status = fake._admit()
+                if status is not None:
+                    self._body()
+                    self._send(status, b'{}', headers={'Retry-After': '1'} if status == 429 else None)
+                    return False
+                return True
+
+            def do_GET(self):
+                if not self._begin():
+                    return
+                if self.path.startswith('/media/'):
+                    return self._media()
+                if self.path.startswith('/v1/albums/'):
+                    album = fake.albums.get(self.path[len('/v1/albums/'):])
+                    return self._send_json(album) if album is not None else self._send(404, b'{}')
+                if self.path.startswith('/v1/albums'):
+                    query = dict(part.split('=', 1) for part in self.path.partition('?')[2].split('&') if '=' in part)
+                    albums = list(fake.albums.values())
+                    start = int(query.get('pageToken', 0))
+                    page = {'albums': albums[start:start + 50]}
+                    if start + 50 < len(albums):
+                        page['nextPageToken'] = str(start + 50)
+                    return self._send_json(page)
+                self._send(404, b'{}')
+
+            def do_POST(self):
+                if not self._begin():
+                    return
+                body = self._body()
+                if self.path == '/v1/mediaItems:search':
+                    return self._search(json.loads(body or b'{}'))
+                if self.path == '/v1/uploads':
+                    with fake.lock:
+                        token = f'upload{len(fake.uploads)}'
+                        fake.uploads[token] = len(body)
+                    return self._send(200, token.encode('utf-8'), content_type='text/plain')
+                if self.path == '/v1/mediaItems:batchCreate':
+                    payload = json.loads(body)
+                    if payload['albumId'] not in fake.albums:
+                        return self._send(400, b'{"error": {"code": 400, "status": "INVALID_ARGUMENT"}}')
+                    results = []
+                    with fake.lock:
+                        for new_item in payload['newMediaItems']:
+                            token = new_item['simpleMediaItem']['uploadToken']
+                            item_id = f'created_{token}'
+                            fake.album_items.setdefault(payload['albumId'], []).append({
+                                'id': item_id, 'filename': new_item['simpleMediaItem']['fileName'],
+                                'baseUrl': f'{fake.url}/media/{item_id}', 'mediaMetadata': {'photo': {}}})
+                            results.append({'uploadToken': token, 'status': {'message': 'Success'}, 'mediaItem': {'id': item_id}})
+                    return self._send_json({'newMediaItemResults': results})
+                if self.path == '/v1/albums':
+                    title = json.loads(body)['album']['title']
+                    with fake.lock:
+                        fake.created_albums += 1
+                        album_id = f'album{fake.created_albums - 1}'
+                        fake.albums[album_id] = {'id': album_id, 'title': title, 'mediaItemsCount': '0'}
+                    return self._send_json(fake.albums[album_id])
+                self._send(404, b'{}')
+
+            def _search(self, payload):
+                if 'albumId' in payload:
+                    items = fake.album_items.get(payload['albumId'], [])
+                else:
+                    items = fake.library.items
+                page_size = min(payload.get('pageSize', fake.page_size), fake.page_size)
+                start = int(payload.get('pageToken', 0))
+                page = {'mediaItems': items[start:start + page_size]}
+                if start + page_size < len(items):
+                    page['nextPageToken'] = str(start + page_size)
+                self._send_json(page)
+
+            def _media(self):
+                match = re.match(r'/media/([^=?]+)(?:=(.*))?', self.path)
+                item_id, variant = match.group(1), match.group(2) or 'd'
+                content = fake.library.content.get(item_id)
+                if content is None:
+                    # created face images are not kept, any JPEG does
+                    content = next(iter(fake.library.content.values()))
+                size_match = re.match(r'w(\d+)-h(\d+)', variant)
+                if size_match:
+                    image = Image.open(BytesIO(content))
+                    image.thumbnail((int(size_match.group(1)), int(size_match.group(2))))
+                    buffer = BytesIO()
+                    image.save(buffer, format='JPEG')
+                    content = buffer.getvalue()
+                range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if range_match:
+                    start = int(range_match.group(1))
+                    end = int(range_match.group(2)) if range_match.group(2) else len(content) - 1
+                    return self._send(206, content[start:end + 1], content_type='image/jpeg',
+                                      headers={'Content-Range': f'bytes {start}-{end}/{len(content)}'})
+                self._send(200, content, content_type='image/jpeg')
+
+        return Handler
+
+
+class FakeStorageHelper:
+    '''
+    In memory GoogleStorageHelper with the same methods, every call takes latency seconds.
+    stream_url_to_google_cloud downloads through HttpSourceStream like the real one.
+    '''
+    objects = {}
+    generations = {}
+    generation_numbers = itertools.count(1)
+    latency = 0.0
+
+    def __init__(self, bucket_name='fake-bucket'):
+        self.bucket_name = bucket_name
+        self.bucket = type('Bucket', (), {'name': bucket_name})()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def file_exists(self, file_name):
+        self._wait()
+        return file_name in self.objects
+
+    def upload_string_content_to_google_cloud(self, content, target_file_name, content_type, if_generation_match=None):
+        with pipeline_metrics.span('gcs_upload', items=1, bytes=len(content)):
+            self._wait()
+            if if_generation_match is not None and self.generations.get(target_file_name, 0) != if_generation_match:
+                raise PreconditionFailed(target_file_name)
+            self.objects[target_file_name] = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+            self.generations[target_file_name] = next(self.generation_numbers)
+
+    def stream_url_to_google_cloud(self, url, target_file_name, content_type, chunk_size=None, on_chunk=None):
+        with pipeline_metrics.span('gcs_upload', items=1) as span:
+            stream = HttpSourceStream(url, chunk_size=chunk_size or STREAM_CHUNK_SIZE, on_chunk=on_chunk)
+            content = stream.read()
+            self._wait()
+            self.objects[target_file_name] = content
+            self.generations[target_file_name] = next(self.generation_numbers)
+            span.add(bytes=len(content))
+        return len(content)
+
+    def upload_url_to_google_cloud(self, url, target_file_name, content_type):
+        return self.stream_url_to_google_cloud(url, target_file_name, content_type)
+
+    def read_file_from_google_cloud_to_string(self, file_name):
+        self._wait()
+        return self.objects[file_name].decode('utf-8')
+
+    def read_file_from_google_cloud_to_bytes(self, file_name):
+        self._wait()
+        return self.objects[file_name]
+
+    def read_file_from_google_cloud_with_generation(self, file_name):
+        self._wait()
+        if file_name not in self.objects:
+            return None, 0
+        return self.objects[file_name].decode('utf-8'), self.generations.get(file_name, 0)
+
+    def open_file(self, file_name, chunk_size=None):
+        self._wait()
+        return BytesIO(self.objects[file_name])
+
+    def list_file_names(self, prefix):
+        self._wait()
+        return [name for name in self.objects if name.startswith(prefix)]
+
+    def delete_file(self, file_name):
+        self._wait()
+        self.objects.pop(file_name, None)
+        self.generations.pop(file_name, None)
+
+
+class FakeOperation:
+    def __init__(self, done_at, error=None):
+        self.done_at = done_at
+        self.error = error
+
+    def done(self):
+        return time.monotonic() >= self.done_at
+
+    def exception(self):
+        return self.error
+
+
+class FakeVisionClient:
+    '''
+    ImageAnnotatorClient whose async_batch_annotate_images writes face annotations of the library's known faces
+    into the fake storage, scaled to the size of the image in the bucket
+    Args:
+        library: FakeLibrary
+        operation_seconds: float, time until an operation is done
+        seconds_per_image: float, additional time per image of an operation
+        error_rate: float, share of operations that fail
+    '''
+
+    def __init__(self, library, operation_seconds=1.0, seconds_per_image=0.0, error_rate=0.0):
+        self.library = library
+        self.operation_seconds = operation_seconds
+        self.seconds_per_image = seconds_per_image
+        self.error_rate = error_rate
+        self.faces_by_file_name = dict(library.faces)
+
+    def async_batch_annotate_images(self, requests, output_config):
+        if random.random() < self.error_rate:
+            return FakeOperation(time.monotonic() + self.operation_seconds, RuntimeError('fake operation failure'))
+        prefix = output_config['gcs_destination']['uri'].split('/', 3)[3]
+        batch_size = output_config['batch_size']
+        responses = [self._annotate(request['image']['source']['image_uri']) for request in requests]
+        for start in range(0, len(responses), batch_size):
+            batch = responses[start:start + batch_size]
+            name = f'{prefix}output-{start + 1}-to-{start + len(batch)}.json'
+            FakeStorageHelper.objects[name] = json.dumps({'responses': batch}).encode('utf-8')
+        return FakeOperation(time.monotonic() + self.operation_seconds + self.seconds_per_image * len(requests))
+
+    def _annotate(self, uri):
+        file_name = uri.split('/')[-1]
+        content = FakeStorageHelper.objects[file_name]
+        width, _ = Image.open(BytesIO(content)).size
+        scale = width / self.library.width
+        faces = []
+        for left, top, right, bottom in self.faces_by_file_name.get(file_name, []):
+            box = [round(left * scale), round(top * scale), round(right * scale), round(bottom * scale)]
+            faces.append({
+                'boundingPoly': {'vertices': [{'x': box[0], 'y': box[1]}, {'x': box[2], 'y': box[1]}, {'x': box[2], 'y': box[3]}, {'x': box[0], 'y': box[3]}]},
+                'detectionConfidence': 0.99,
+                'landmarks': [{'type': 'NOSE_TIP', 'position': {'x': (box[0] + box[2]) / 2, 'y': (box[1] + box[3]) / 2, 'z': 0.0}}],
+            })
+        return {'context': {'uri': uri}, 'faceAnnotations': faces}
+
+
+class FakeCredentials:
+    token = 'fake-token'
+    refresh_token = None
+    expiry = None
+    valid = True
+
+
+@contextlib.contextmanager
+def install(photos_server, vision_client, storage_latency=0.0):
+    '''
+    Points the pipeline at the fakes while the context is open: Photos api requests go to photos_server,
+    GCS and Vision are replaced in process. Everything is put back on exit.
+    yields: a GooglePhotoHelper using fake credentials
+    '''
+    import client_registry
+    import google_photo_api
+    import http_transport
+    import main
+    import vision_batch
+
+    session = http_transport.get_session()
+    send = session.request
+
+    def redirect(method, url, *args, **kwargs):
+        if url.startswith(PHOTOS_API_URL):
+            url = photos_server.url + url[len(PHOTOS_API_URL):]
+        return send(method, url, *args, **kwargs)
+
+    patched_modules = (google_photo_api, main, vision_batch)
+    storage_helpers = [module.GoogleStorageHelper for module in patched_modules]
+    storage_latency_before = FakeStorageHelper.latency
+    vision_client_before = client_registry._clients.get('vision')
+    # the rate limiter still applies, it looks at the original host
+    session.request = redirect
+    FakeStorageHelper.latency = storage_latency
+    for module in patched_modules:
+        module.GoogleStorageHelper = FakeStorageHelper
+    client_registry._clients['vision'] = vision_client
+    try:
+        yield google_photo_api.GooglePhotoHelper(cred=FakeCredentials())
+    finally:
+        # drops the instance attribute, the session's own request method shows through again
+        del session.request
+        FakeStorageHelper.latency = storage_latency_before
+        for module, storage_helper in zip(patched_modules, storage_helpers):
+            module.GoogleStorageHelper = storage_helper
+        if vision_client_before is None:
+            client_registry._clients.pop('vision', None)
+        else:
+            client_registry._clients['vision'] = vision_client_before
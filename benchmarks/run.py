@@ -0,0 +1,134 @@
+'''
+Measures the pipeline and the album downloader against the local fakes, e.g.
+    python -m benchmarks.run --items 200 --latency 0.02 --error-rate 0.01 --output results.json
+Every benchmark runs in its own process, so that its peak RSS is its own.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.fake_services import FakeLibrary, FakePhotosServer, FakeServerConfig, FakeVisionClient, install
+
+
+def _start_server(options):
+    library = FakeLibrary(items=options['items'], width=options['width'], height=options['height'], faces_per_item=options['faces_per_item'])
+    config = FakeServerConfig(latency=options['latency'], error_rate=options['error_rate'],
+                              quota_per_second=options['quota_per_second'], bandwidth_mbps=options['bandwidth_mbps'])
+    return library, FakePhotosServer(library, config).start()
+
+
+def _result(name, items, seconds, stages, server):
+    import pipeline_metrics
+    return {
+        'benchmark': name,
+        'items': items,
+        'seconds': round(seconds, 3),
+        'items_per_second': round(items / seconds, 2) if seconds else 0.0,
+        'peak_rss_mb': round(pipeline_metrics.peak_memory_mb(), 1),
+        'server_requests': server.requests,
+        'server_throttled': server.throttled,
+        'server_errors': server.failed,
+        'stages': stages,
+    }
+
+
+def benchmark_pipeline(options):
+    '''
+    face_image_generation_for_google_photo for a single day of the fake library
+    '''
+    import main
+    import pipeline_metrics
+    import vision_batch
+    library, server = _start_server(options)
+    vision_client = FakeVisionClient(library, operation_seconds=options['vision_seconds'], error_rate=options['vision_error_rate'])
+    vision_batch.POLL_INTERVAL_SECONDS = options['poll_interval']
+    # the run logs and resets its stage stats at the end, keep them
+    summaries = []
+    log_summary = pipeline_metrics.log_summary
+    pipeline_metrics.log_summary = lambda label='': summaries.append(log_summary(label)) or summaries[-1]
+    pipeline_metrics.reset()
+    with install(server, vision_client, storage_latency=options['storage_latency']) as helper:
+        start = time.monotonic()
+        main.face_image_generation_for_google_photo(*library.day, helper=helper)
+        seconds = time.monotonic() - start
+    server.stop()
+    return _result('pipeline', len(library.items), seconds, summaries[-1] if summaries else {}, server)
+
+
+def benchmark_download(options):
+    '''
+    AlbumDownloader fetching every item of the fake library
+    '''
+    import pipeline_metrics
+    from album_download import AlbumDownloader
+    library, server = _start_server(options)
+    pipeline_metrics.reset()
+    start = time.monotonic()
+    with tempfile.TemporaryDirectory() as download_dir:
+        with AlbumDownloader(download_dir, workers=options['download_workers']) as downloader:
+            for item in library.items:
+                downloader.submit(item['baseUrl'] + '=d', item['filename'])
+    seconds = time.monotonic() - start
+    server.stop()
+    return _result('download', len(library.items), seconds, pipeline_metrics.summary(), server)
+
+
+BENCHMARKS = {'pipeline': benchmark_pipeline, 'download': benchmark_download}
+
+
+def benchmark_name(value):
+    if value not in BENCHMARKS:
+        raise argparse.ArgumentTypeError('unknown benchmark {}, choose from {}'.format(value, ', '.join(BENCHMARKS)))
+    return value
+
+
+def _run_isolated(name, options):
+    if not options['verbose']:
+        # the pipeline logs every item
+        sys.stdout = open(os.devnull, 'w')
+    return BENCHMARKS[name](options)
+
+
+def print_result(result):
+    print('{benchmark}: {items} items in {seconds}s, {items_per_second} items/s, peak RSS {peak_rss_mb} MiB, '
+          '{server_requests} requests ({server_throttled} throttled, {server_errors} failed)'.format(**result))
+    for stage, stats in result['stages'].items():
+        print('    {:<14} p50 {:>8.3f}s  p99 {:>8.3f}s  total {:>8.2f}s  {:>6} items  {:>8.1f} MiB  {:>4} retries  {:>4} errors'.format(
+            stage, stats['p50_seconds'], stats['p99_seconds'], stats['seconds'], stats['items'], stats['bytes'] / (1024 * 1024),
+            stats['retries'], stats['errors']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against local fake Photos, GCS and Vision services')
+    parser.add_argument('benchmarks', nargs='*', type=benchmark_name, help='benchmarks to run, all by default: {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--items', type=int, default=100, help='number of synthetic photos')
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--faces-per-item', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every Photos request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Photos requests answered with 503')
+    parser.add_argument('--quota-per-second', type=int, default=0, help='Photos requests per second before 429s, 0 for none')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help='MiB/s per download, 0 for no limit')
+    parser.add_argument('--storage-latency', type=float, default=0.01, help='seconds per GCS call')
+    parser.add_argument('--vision-seconds', type=float, default=1.0, help='seconds until a Vision operation is done')
+    parser.add_argument('--vision-error-rate', type=float, default=0.0)
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between Vision operation polls')
+    parser.add_argument('--download-workers', type=int, default=16)
+    parser.add_argument('--output', help='json file to write the results to')
+    parser.add_argument('--verbose', action='store_true', help='show the log of the benchmarked code')
+    args = parser.parse_args()
+    options = vars(args)
+    results = []
+    for name in args.benchmarks or list(BENCHMARKS):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(_run_isolated, name, options).result()
+        print_result(result)
+        results.append(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
@@ -0,0 +1,109 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import MutableMapping
+
+from google_logging import structured_log, LogSeverity
+
+# how many bytes of downloaded originals are kept in memory before spilling to disk
+BLOB_STORE_MEMORY_BUDGET = int(os.environ.get('BLOB_STORE_MEMORY_BUDGET_MB', 128)) * 1024 * 1024
+# note that /tmp of a Cloud Function is itself in memory, point this to a disk backed mount to really save memory
+BLOB_STORE_SPILL_DIR = os.environ.get('BLOB_STORE_SPILL_DIR')
+
+
+class SpillBlobStore(MutableMapping):
+    '''
+    name -> bytes store that keeps blobs in memory up to a budget and spills the rest to a temp directory.
+    Spilled blobs are read back as read-only memory mapped files, which behave like bytes
+    (len, slicing, BytesIO(...)) without loading the whole file up front.
+    Any MutableMapping, e.g. a plain dict, can be used in its place.
+    Blobs may be stored and read from several threads at once.
+    '''
+
+    def __init__(self, memory_budget=BLOB_STORE_MEMORY_BUDGET, spill_dir=BLOB_STORE_SPILL_DIR):
+        '''
+        Args:
+            memory_budget: int, max number of bytes kept in memory
+            spill_dir: string, parent directory of the spill files, defaults to the system temp directory
+        '''
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.in_memory = {}
+        self.spilled = {}
+        self.mmaps = {}
+        self.spill_count = 0
+        self.spill_dir = tempfile.mkdtemp(prefix='blob_store_', dir=spill_dir)
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __setitem__(self, name, data):
+        with self.lock:
+            if name in self:
+                del self[name]
+            if self.memory_used + len(data) <= self.memory_budget:
+                self.in_memory[name] = bytes(data)
+                self.memory_used += len(data)
+                return
+            path = os.path.join(self.spill_dir, f'{self.spill_count}.blob')
+            self.spill_count += 1
+        # the file is only visible once complete, other threads carry on meanwhile
+        with open(path, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.spilled[name] = path
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name in self.in_memory:
+                return self.in_memory[name]
+            path = self.spilled[name]
+            if name not in self.mmaps:
+                if os.path.getsize(path) == 0:
+                    # empty files cannot be memory mapped
+                    return b''
+                with open(path, 'rb') as f:
+                    self.mmaps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mmaps[name]
+
+    def __delitem__(self, name):
+        with self.lock:
+            if name in self.in_memory:
+                self.memory_used -= len(self.in_memory.pop(name))
+                return
+            path = self.spilled.pop(name)
+            if name in self.mmaps:
+                self.mmaps.pop(name).close()
+            os.remove(path)
+
+    def __iter__(self):
+        yield from self.in_memory
+        yield from self.spilled
+
+    def __len__(self):
+        return len(self.in_memory) + len(self.spilled)
+
+    def __contains__(self, name):
+        return name in self.in_memory or name in self.spilled
+
+    def close(self):
+        '''
+        Drops all blobs and removes the spill directory
+        '''
+        for m in self.mmaps.values():
+            m.close()
+        self.mmaps = {}
+        self.in_memory = {}
+        self.spilled = {}
+        self.memory_used = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def log_usage(self):
+        structured_log('Blob store: {} blobs, {} MiB in memory, {} spilled to {}'.format(
+            len(self), self.memory_used // (1024 * 1024), len(self.spilled), self.spill_dir), severity=LogSeverity.INFO)
@@ -0,0 +1,120 @@
+import datetime
+import os
+import threading
+import time
+
+from google.auth.transport.requests import Request
+from google.cloud import secretmanager, storage, vision_v1
+
+from google_logging import structured_log, LogSeverity
+
+# refresh tokens this long before they expire, so a long batch never sends an expired one
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+REFRESH_CHECK_INTERVAL_SECONDS = 60
+
+_lock = threading.RLock()
+# serializes token refreshes, which are network calls, without holding _lock during them
+_refresh_lock = threading.Lock()
+_clients = {}
+_credentials = {}
+_refresher = None
+
+
+def _get_client(name, factory):
+    with _lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_storage_client():
+    '''
+    returns: the process wide google.cloud.storage.Client
+    '''
+    return _get_client('storage', storage.Client)
+
+
+def get_vision_client():
+    '''
+    returns: the process wide vision_v1.ImageAnnotatorClient
+    '''
+    return _get_client('vision', vision_v1.ImageAnnotatorClient)
+
+
+def get_secret_manager_client():
+    '''
+    returns: the process wide secretmanager.SecretManagerServiceClient
+    '''
+    return _get_client('secretmanager', secretmanager.SecretManagerServiceClient)
+
+
+def _expires_soon(cred):
+    if cred.expiry is None:
+        return not cred.valid
+    # google.auth stores expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return cred.expiry - now < TOKEN_REFRESH_MARGIN
+
+
+def _refresh_if_expiring(key, cred):
+    with _refresh_lock:
+        # another thread may have refreshed it while this one waited
+        if cred.refresh_token and _expires_soon(cred):
+            structured_log("=== Refreshing token for {} ===".format(key))
+            cred.refresh(Request())
+
+
+def get_credentials(key, loader):
+    '''
+    Returns cached credentials, loading them once per process and refreshing them before they expire.
+    The same credentials object is handed out every time and refreshed in place,
+    so holders always read the current token from cred.token.
+    Args:
+        key: string, cache key of the credentials
+        loader: callable returning the credentials when they are not cached yet
+    '''
+    with _lock:
+        cred = _credentials.get(key)
+        if cred is None:
+            cred = loader()
+            _credentials[key] = cred
+        # started on use rather than at import or fork, so that pool workers that never call this get no thread
+        _start_refresher()
+    if cred.refresh_token and _expires_soon(cred):
+        _refresh_if_expiring(key, cred)
+    return cred
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_CHECK_INTERVAL_SECONDS)
+        with _lock:
+            credentials = list(_credentials.items())
+        for key, cred in credentials:
+            if not cred.refresh_token or not _expires_soon(cred):
+                continue
+            try:
+                _refresh_if_expiring(key, cred)
+            except Exception as e:
+                # try again on the next round or on the next get_credentials
+                structured_log('Background refresh of {} failed: {!r}'.format(key, e), severity=LogSeverity.WARNING)
+
+
+def _start_refresher():
+    global _refresher
+    if _refresher is None or not _refresher.is_alive():
+        _refresher = threading.Thread(target=_refresh_loop, name='credential-refresher', daemon=True)
+        _refresher.start()
+
+
+def _reset_after_fork():
+    global _lock, _refresh_lock, _refresher
+    # grpc channels, threads and locks held by other threads do not survive a fork, credentials do.
+    # The refresher starts again with the first get_credentials, pool workers that never call it get no thread
+    _lock = threading.RLock()
+    _refresh_lock = threading.Lock()
+    _clients.clear()
+    _refresher = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
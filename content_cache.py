@@ -0,0 +1,286 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from google_logging import structured_log, LogSeverity
+
+# /tmp of a Cloud Function is itself in memory, so the cache is off there unless it is sized explicitly,
+# point CONTENT_CACHE_DIR to a disk backed mount to use it there
+CONTENT_CACHE_DIR = os.environ.get('CONTENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'photo_content_cache'))
+CONTENT_CACHE_MAX_MB = int(os.environ.get('CONTENT_CACHE_MAX_MB', 0 if 'K_SERVICE' in os.environ else 1024))
+# temporary files of writes that did not finish, e.g. of a killed process, are removed after this long
+STALE_PART_FILE_SECONDS = 3600
+PART_FILE_SUFFIX = '.part'
+# other processes sharing the directory add entries this process does not know about, so it reads the directory
+# again after writing this share of max_bytes, the processes together overshoot by at most that much each
+RESCAN_SHARE = 0.1
+
+
+class MediaUrl(str):
+    '''
+    Download url of a media item, {baseUrl}={variant}, that remembers the media item id and the size variant.
+    baseUrls expire after an hour but ids do not, so the pair keys the bytes in the ContentCache.
+    It is a plain string to everything else, e.g. when written into a dataset json.
+    '''
+
+    def __new__(cls, item, variant):
+        '''
+        Args:
+            item: media item dict
+            variant: string, e.g. 'd' for the original photo, 'dv' for a video, 'w1024-h1024' for a scaled copy
+        '''
+        url = super().__new__(cls, f"{item['baseUrl']}={variant}")
+        url.media_item_id = item['id']
+        url.variant = variant
+        return url
+
+
+def cache_key(url):
+    '''
+    returns: (media item id, variant) of a MediaUrl, None for any other url
+    '''
+    media_item_id = getattr(url, 'media_item_id', None)
+    return None if media_item_id is None else (media_item_id, url.variant)
+
+
+class ContentCache:
+    '''
+    Bytes of media items on local disk, keyed by media item id and size variant, up to max_bytes.
+    The least recently used entries are evicted first, the recency survives reruns as the modification time of the files.
+    Entries are written to a temporary file and renamed once complete, so readers, other threads and other processes
+    sharing the directory never see a partial entry. Concurrent reads of the same missing entry download it once.
+    The size is accounted from the directory, which is read again before evicting and after writing RESCAN_SHARE
+    of max_bytes, so the limit holds across the processes sharing it, e.g. the backfill workers.
+    '''
+
+    def __init__(self, cache_dir=CONTENT_CACHE_DIR, max_bytes=CONTENT_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # file name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.written_since_scan = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _scan(self):
+        with self.lock:
+            self._rescan()
+            self._evict()
+        structured_log('Content cache {} holds {} entries, {} MiB'.format(self.cache_dir, len(self.entries), self.total_bytes // (1024 * 1024)))
+
+    def _rescan(self):
+        '''
+        Replaces the entries with those in the directory, including the ones other processes added or evicted
+        '''
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                # evicted by another process meanwhile
+                continue
+            if entry.name.endswith(PART_FILE_SUFFIX):
+                if now - stat.st_mtime > STALE_PART_FILE_SECONDS:
+                    self._remove(entry.path)
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        self.entries = OrderedDict((file_name, size) for _, file_name, size in sorted(files))
+        self.total_bytes = sum(self.entries.values())
+        self.written_since_scan = 0
+
+    @staticmethod
+    def _file_name(key):
+        media_item_id, variant = key
+        return hashlib.sha256(f'{media_item_id}={variant}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another process sharing the directory
+            pass
+
+    def _make_room(self):
+        if self.total_bytes > self.max_bytes or self.written_since_scan > self.max_bytes * RESCAN_SHARE:
+            # the entries this process knows of are not all that is on disk
+            self._rescan()
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            file_name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.stats['evicted'] += 1
+            self._remove(os.path.join(self.cache_dir, file_name))
+
+    def _touch(self, file_name):
+        '''
+        returns: the path of a cached entry after marking it as the most recently used, None if it is not cached
+        '''
+        path = os.path.join(self.cache_dir, file_name)
+        with self.lock:
+            if file_name not in self.entries:
+                return None
+            self.entries.move_to_end(file_name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            with self.lock:
+                self.total_bytes -= self.entries.pop(file_name, 0)
+            return None
+        return path
+
+    def path(self, key):
+        '''
+        returns: the path of the file of an entry, None if it is not cached
+        '''
+        if not self.enabled:
+            return None
+        path = self._touch(self._file_name(key))
+        with self.lock:
+            self.stats['hits' if path is not None else 'misses'] += 1
+        return path
+
+    def get(self, key):
+        '''
+        returns: the bytes of an entry, None if it is not cached
+        '''
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _commit(self, file_name, temp_path):
+        size = os.path.getsize(temp_path)
+        if size > self.max_bytes:
+            self._remove(temp_path)
+            return
+        os.replace(temp_path, os.path.join(self.cache_dir, file_name))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(file_name, 0)
+            self.entries[file_name] = size
+            self.written_since_scan += size
+            self._make_room()
+
+    def put(self, key, content):
+        if not self.enabled or len(content) > self.max_bytes:
+            return
+        file_name = self._file_name(key)
+        fd, temp_path = tempfile.mkstemp(prefix=file_name, suffix=PART_FILE_SUFFIX, dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            self._commit(file_name, temp_path)
+        except OSError as e:
+            # a full disk only costs the cache entry
+            structured_log('Cannot cache {}: {!r}'.format(key, e), severity=LogSeverity.WARNING)
+            self._remove(temp_path)
+
+    def put_file(self, key, file_path):
+        '''
+        Adds a copy of a file, e.g. one just downloaded into a directory
+        '''
+        if not self.enabled or os.path.getsize(file_path) > self.max_bytes:
+            return
+        file_name = self._file_name(key)
+        fd, temp_path = tempfile.mkstemp(prefix=file_name, suffix=PART_FILE_SUFFIX, dir=self.cache_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(file_path, temp_path)
+            self._commit(file_name, temp_path)
+        except OSError as e:
+            structured_log('Cannot cache {}: {!r}'.format(key, e), severity=LogSeverity.WARNING)
+            self._remove(temp_path)
+
+    def fetch(self, key, download):
+        '''
+        Reads an entry through the cache
+        Args:
+            key: (media item id, variant)
+            download: callable returning the bytes, called if the entry is not cached
+        '''
+        content = self.get(key)
+        if content is not None:
+            return content
+        with self.lock:
+            # [lock, number of threads holding or waiting for it], dropped when the last one is done
+            key_lock = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                # another thread may have downloaded it meanwhile
+                path = self._touch(self._file_name(key))
+                if path is not None:
+                    with open(path, 'rb') as f:
+                        return f.read()
+                content = download()
+                self.put(key, content)
+                return content
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self.key_locks[key]
+
+    def log_stats(self):
+        if not self.enabled:
+            return
+        structured_log('Content cache {hits} hits, {misses} misses, {evicted} evicted, '.format(**self.stats) +
+                       '{} entries, {} MiB'.format(len(self.entries), self.total_bytes // (1024 * 1024)))
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_content_cache():
+    '''
+    returns: the process wide ContentCache
+    '''
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = ContentCache()
+        return _cache
+
+
+def read_through(url, download):
+    '''
+    Reads a url through the process wide cache if it is a MediaUrl, otherwise just downloads it
+    Args:
+        download: callable taking the url and returning its bytes
+    '''
+    key = cache_key(url)
+    if key is None:
+        return download(url)
+    return get_content_cache().fetch(key, lambda: download(url))
+
+
+def cached_content(url):
+    '''
+    returns: the cached bytes of a MediaUrl, None if they are not cached or url is no MediaUrl
+    '''
+    key = cache_key(url)
+    return None if key is None else get_content_cache().get(key)
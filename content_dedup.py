@@ -0,0 +1,116 @@
+import hashlib
+import json
+import threading
+
+from google.api_core.exceptions import PreconditionFailed
+
+from google_logging import structured_log, LogSeverity
+
+DEDUP_INDEX_FILE_NAME = 'dedup/content_index.json'
+# attempts to write the index while other processes keep writing it in between
+MAX_FLUSH_ATTEMPTS = 5
+
+
+class ContentDedupIndex:
+    '''
+    Content addressed index of annotated photos, so that copies of the same photo (shared albums, re-uploads,
+    reruns) reuse the face annotations of the first copy instead of going through GCS and Vision again.
+    A photo only matches on the SHA-256 of its bytes, a near identical photo may be cropped differently and is annotated itself.
+    Only a pointer to the Vision output is stored per photo:
+    {"items": {sha256: [result_file_name, file_name, annotation_scale]}}
+    '''
+
+    def __init__(self, storage_helper, index_file_name=DEDUP_INDEX_FILE_NAME):
+        self.storage_helper = storage_helper
+        self.index_file_name = index_file_name
+        self.items = self._read_items()[0]
+        # file name -> content key and file name -> index entry of the photos looked up in this run
+        self.content_keys = {}
+        self.hits = {}
+        self.forgotten_keys = set()
+        self.unsaved_updates = 0
+        self.stats = {'hits': 0, 'misses': 0, 'skipped_upload_bytes': 0, 'flush_conflicts': 0}
+        # lookups come from the copy threads, the hashes are computed outside of it
+        self.lock = threading.RLock()
+
+    def _read_items(self):
+        '''
+        returns: the stored items and the generation of the index object, 0 if there is none yet
+        '''
+        content, generation = self.storage_helper.read_file_from_google_cloud_with_generation(self.index_file_name)
+        if content is None:
+            return {}, 0
+        # entries written before matching was exact-only start with the perceptual hash and dimensions
+        return {key: entry[-3:] for key, entry in json.loads(content)['items'].items()}, generation
+
+    def lookup(self, file_name, image_bytes):
+        '''
+        Looks up a photo, the outcome is also kept in content_keys and hits under its file name
+        returns: the index entry of an already annotated copy, None if there is none
+        '''
+        key = hashlib.sha256(image_bytes).hexdigest()
+        with self.lock:
+            self.content_keys[file_name] = key
+            entry = self.items.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.stats['skipped_upload_bytes'] += len(image_bytes)
+            self.hits[file_name] = entry
+            return entry
+
+    def add(self, file_name, result_file_name, annotation_scale=1):
+        '''
+        Records where the annotation of a photo looked up in this run can be found
+        '''
+        with self.lock:
+            key = self.content_keys.get(file_name)
+            if key is None or key in self.items:
+                return
+            self.items[key] = [result_file_name, file_name, annotation_scale]
+            self.unsaved_updates += 1
+
+    def forget(self, file_name):
+        '''
+        Drops the entry a photo of this run matched, e.g. because its annotation is gone
+        '''
+        with self.lock:
+            entry = self.hits.pop(file_name, None)
+            if entry is None:
+                return
+            for key, item_entry in list(self.items.items()):
+                if item_entry is entry:
+                    del self.items[key]
+                    self.forgotten_keys.add(key)
+            self.unsaved_updates += 1
+
+    def flush(self):
+        '''
+        Merges the entries other processes stored since the index was loaded and writes it back,
+        the write only succeeds if nobody wrote the index in between, otherwise it is merged again
+        '''
+        with self.lock:
+            if self.unsaved_updates == 0:
+                return
+            for _ in range(MAX_FLUSH_ATTEMPTS):
+                stored_items, generation = self._read_items()
+                for key, entry in stored_items.items():
+                    if key not in self.forgotten_keys:
+                        self.items.setdefault(key, entry)
+                try:
+                    self.storage_helper.upload_string_content_to_google_cloud(
+                        json.dumps({'items': self.items}, separators=(',', ':')), self.index_file_name, 'application/json',
+                        if_generation_match=generation)
+                except PreconditionFailed:
+                    self.stats['flush_conflicts'] += 1
+                    continue
+                self.unsaved_updates = 0
+                return
+            # the entries stay unsaved, the next flush tries again
+            structured_log('Index {} kept changing, {} updates not written'.format(self.index_file_name, self.unsaved_updates), severity=LogSeverity.WARNING)
+
+    def log_stats(self):
+        hits = self.stats['hits']
+        structured_log('Deduplication saved {} GCS uploads ({} MiB) and {} Vision annotations: {}'.format(
+            hits, self.stats['skipped_upload_bytes'] // (1024 * 1024), hits, json.dumps(self.stats)), severity=LogSeverity.INFO)
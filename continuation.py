@@ -0,0 +1,191 @@
+import base64
+import json
+import os
+import time
+from collections import deque
+
+import http_transport
+from google_logging import structured_log, LogSeverity
+
+CONTINUATION_FILE_PREFIX = 'continuations/'
+THROUGHPUT_FILE_NAME = f'{CONTINUATION_FILE_PREFIX}throughput.json'
+# the --timeout the function is deployed with, see README
+FUNCTION_TIMEOUT_SECONDS = float(os.environ.get('FUNCTION_TIMEOUT_SECONDS', 540))
+# time kept back for saving the cursor, the manifest and publishing the follow-up
+DEADLINE_SAFETY_MARGIN_SECONDS = float(os.environ.get('DEADLINE_SAFETY_MARGIN_SECONDS', 60))
+# fixed cost of a chunk of items on top of its items: manifest, album lookup, Vision operation round trips
+CHUNK_OVERHEAD_SECONDS = float(os.environ.get('CHUNK_OVERHEAD_SECONDS', 30))
+# per item estimate used until a run has been measured
+DEFAULT_SECONDS_PER_ITEM = 2.0
+# weight of the latest chunk in the moving average of seconds per item
+THROUGHPUT_SMOOTHING = 0.3
+# a day that still is not done after this many follow-ups is left to the next run
+MAX_CONTINUATIONS = int(os.environ.get('MAX_CONTINUATIONS', 20))
+CONTINUATION_TOPIC = os.environ.get('CONTINUATION_TOPIC', 'recurring_jobs')
+PUBSUB_SCOPES = ['https://www.googleapis.com/auth/pubsub']
+
+
+class DeadlineScheduler:
+    '''
+    Keeps track of the time left before the function is killed, and of how long an item takes,
+    so that work is only started when it can finish in time.
+    The seconds per item are a moving average over the chunks of this and earlier runs,
+    earlier runs hand it over through THROUGHPUT_FILE_NAME in the bucket.
+    '''
+
+    def __init__(self, budget_seconds=FUNCTION_TIMEOUT_SECONDS - DEADLINE_SAFETY_MARGIN_SECONDS,
+                 seconds_per_item=DEFAULT_SECONDS_PER_ITEM, chunk_overhead_seconds=CHUNK_OVERHEAD_SECONDS):
+        '''
+        Args:
+            budget_seconds: float, seconds from now until work has to stop
+            seconds_per_item: float, initial estimate of the time an item takes
+            chunk_overhead_seconds: float, fixed time a chunk takes regardless of its size
+        '''
+        self.deadline = time.monotonic() + budget_seconds
+        self.seconds_per_item = seconds_per_item
+        self.chunk_overhead_seconds = chunk_overhead_seconds
+        self.processed_items = 0
+
+    def load_from_bucket(self, storage_helper):
+        '''
+        Starts from the seconds per item measured by earlier runs, if there are any
+        '''
+        if storage_helper.file_exists(THROUGHPUT_FILE_NAME):
+            self.seconds_per_item = json.loads(storage_helper.read_file_from_google_cloud_to_string(THROUGHPUT_FILE_NAME))['seconds_per_item']
+
+    def save_to_bucket(self, storage_helper):
+        if self.processed_items == 0:
+            return
+        storage_helper.upload_string_content_to_google_cloud(
+            json.dumps({'seconds_per_item': self.seconds_per_item}), THROUGHPUT_FILE_NAME, 'application/json')
+
+    def remaining(self):
+        '''
+        returns: seconds left before work has to stop, negative once it is overdue
+        '''
+        return self.deadline - time.monotonic()
+
+    def items_that_fit(self):
+        '''
+        returns: the number of items a chunk started now can hold and still finish before the deadline
+        '''
+        return max(0, int((self.remaining() - self.chunk_overhead_seconds) / self.seconds_per_item))
+
+    def next_chunk_size(self):
+        '''
+        returns: items_that_fit, but at least 1 for the first chunk, so that an invocation always makes progress
+            however pessimistic the estimate, 0 when the invocation should stop
+        '''
+        chunk_size = self.items_that_fit()
+        if chunk_size == 0 and self.processed_items == 0:
+            return 1
+        return chunk_size
+
+    def record(self, item_count, seconds):
+        '''
+        Updates the estimate with a finished chunk
+        '''
+        if item_count == 0:
+            return
+        # the chunk overhead is part of the estimate already, the average is over the rest
+        seconds_per_item = max(seconds - self.chunk_overhead_seconds, 0) / item_count
+        self.seconds_per_item += THROUGHPUT_SMOOTHING * (max(seconds_per_item, 0.01) - self.seconds_per_item)
+        self.processed_items += item_count
+
+
+class ContinuationCursor:
+    '''
+    Where processing of a day stopped: the page token of the search page in progress
+    and the ids of the items of that page that are done, so that a follow-up run resumes there.
+    Stored in the bucket as {"page_token": ..., "completed_item_ids": [...], "continuation": k}
+    '''
+
+    def __init__(self, storage_helper, file_name):
+        self.storage_helper = storage_helper
+        self.file_name = file_name
+        self.page_token = None
+        self.completed_item_ids = set()
+        self.continuation = 0
+        if storage_helper.file_exists(file_name):
+            state = json.loads(storage_helper.read_file_from_google_cloud_to_string(file_name))
+            self.page_token = state['page_token']
+            self.completed_item_ids = set(state['completed_item_ids'])
+            self.continuation = state['continuation']
+
+    @classmethod
+    def for_day(cls, storage_helper, year, month, day):
+        return cls(storage_helper, f'{CONTINUATION_FILE_PREFIX}{year}_{month}_{day}.json')
+
+    def start_page(self, page_token):
+        if page_token != self.page_token:
+            self.page_token = page_token
+            self.completed_item_ids = set()
+
+    def complete(self, item_ids):
+        self.completed_item_ids.update(item_ids)
+
+    def save(self):
+        self.storage_helper.upload_string_content_to_google_cloud(json.dumps({
+            'page_token': self.page_token,
+            'completed_item_ids': sorted(self.completed_item_ids),
+            'continuation': self.continuation,
+        }), self.file_name, 'application/json')
+
+    def clear(self):
+        '''
+        Removes the cursor once the day is done, the next run of the day starts from the first page again
+        '''
+        self.storage_helper.delete_file(self.file_name)
+
+
+class PubSubPublisher:
+    '''
+    Publishes json messages to a Pub/Sub topic through the REST api, with the default credentials of the function
+    '''
+
+    def __init__(self, topic=CONTINUATION_TOPIC, project=None):
+        import google.auth
+        self.cred, default_project = google.auth.default(scopes=PUBSUB_SCOPES)
+        project = project or os.environ.get('GOOGLE_CLOUD_PROJECT') or default_project
+        self.url = f'https://pubsub.googleapis.com/v1/projects/{project}/topics/{topic}:publish'
+
+    def publish(self, message):
+        '''
+        Args:
+            message: json serializable dict
+        '''
+        if not self.cred.valid:
+            from google.auth.transport.requests import Request
+            self.cred.refresh(Request())
+        data = base64.b64encode(json.dumps(message).encode('utf-8')).decode('ascii')
+        response = http_transport.request('POST', self.url, json={'messages': [{'data': data}]},
+                                          headers={'Authorization': 'Bearer {}'.format(self.cred.token)})
+        response.raise_for_status()
+        structured_log('Published {} to {}'.format(message, self.url))
+
+
+class LocalPublisher:
+    '''
+    Stand-in for PubSubPublisher that queues the messages in memory, see main.run_with_local_continuations
+    '''
+
+    def __init__(self):
+        self.messages = deque()
+
+    def publish(self, message):
+        structured_log('Queued follow-up {}'.format(message))
+        self.messages.append(message)
+
+
+def follow_up_message(fields, dry_run, continuation):
+    '''
+    Args:
+        fields: dict, what to resume, e.g. {"year": 2022, "month": 10, "day": 29}
+    returns: the message that resumes the work, main accepts it next to the days_past messages,
+        None once MAX_CONTINUATIONS is exceeded
+    '''
+    if continuation > MAX_CONTINUATIONS:
+        structured_log('{} is still not done after {} continuations, leaving it to the next run'.format(fields, MAX_CONTINUATIONS),
+                       severity=LogSeverity.ERROR)
+        return None
+    return dict(fields, dry_run=dry_run, continuation=continuation)
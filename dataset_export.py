@@ -0,0 +1,288 @@
+import abc
+import io
+import json
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import piexif
+
+import content_cache
+import http_transport
+from exif_index import find_exif_segment, user_comment_from_exif_segment
+from google_logging import structured_log, LogSeverity
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # only needed for the parquet format, pip install pyarrow
+    pyarrow = None
+
+# a shard is written once it holds this many bytes of images, which also bounds the memory a parquet shard needs
+DATASET_SHARD_SIZE_MB = int(os.environ.get('DATASET_SHARD_SIZE_MB', 256))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 16))
+EXPORT_FORMATS = ('parquet', 'tar')
+
+
+def face_annotation_from_image_bytes(image_bytes):
+    '''
+    Reads the face annotation the crop was saved with from the EXIF UserComment, without decoding the image
+    returns: the annotation as a json string, '{}' if there is none
+    '''
+    location = find_exif_segment(image_bytes)
+    if location is None:
+        return '{}'
+    offset, length = location
+    try:
+        return user_comment_from_exif_segment(image_bytes[offset:offset + length]) or '{}'
+    except (ValueError, piexif.InvalidImageDataError):
+        return '{}'
+
+
+class ShardWriter(abc.ABC):
+    '''
+    Writes records into numbered shard files {prefix}-00000.{extension}, ... of about shard_size bytes each.
+    Each shard is written to a temporary file and renamed once complete, if the export fails it is removed instead.
+    '''
+    extension = None
+
+    def __init__(self, output_dir, prefix, shard_size=DATASET_SHARD_SIZE_MB * 1024 * 1024):
+        '''
+        Args:
+            output_dir: string, directory of the shards, created if missing
+            prefix: string, file name prefix of the shards
+            shard_size: int, bytes of images after which a shard is closed
+        '''
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard_paths = []
+        self.shard_bytes = 0
+        self.shard_records = 0
+        self.records = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def shard_path(self):
+        return os.path.join(self.output_dir, f'{self.prefix}-{len(self.shard_paths):05d}.{self.extension}')
+
+    def write(self, key, image_bytes, label, annotation):
+        '''
+        Args:
+            key: string, unique name of the record, e.g. the file name without extension
+            image_bytes: bytes of the JPEG image
+            label: string
+            annotation: string, face annotation json
+        '''
+        if self.shard_records == 0:
+            self._open_shard(self.shard_path() + '.part')
+        self._write_record(key, image_bytes, label, annotation)
+        self.shard_bytes += len(image_bytes)
+        self.shard_records += 1
+        self.records += 1
+        if self.shard_bytes >= self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        shard_path = self.shard_path()
+        self._close_shard()
+        os.replace(shard_path + '.part', shard_path)
+        structured_log('Wrote shard {} with {} records, {} MiB'.format(shard_path, self.shard_records, self.shard_bytes // (1024 * 1024)))
+        self.shard_paths.append(shard_path)
+        self.shard_bytes = 0
+        self.shard_records = 0
+
+    def close(self):
+        '''
+        returns: list of the shard file paths
+        '''
+        if self.shard_records:
+            self._finish_shard()
+        return self.shard_paths
+
+    def abort(self):
+        '''
+        Drops the shard being written, the finished shards are kept
+        '''
+        if self.shard_records:
+            try:
+                self._discard_shard()
+            finally:
+                try:
+                    os.remove(self.shard_path() + '.part')
+                except FileNotFoundError:
+                    pass
+                self.shard_bytes = 0
+                self.shard_records = 0
+
+    @abc.abstractmethod
+    def _open_shard(self, path):
+        pass
+
+    @abc.abstractmethod
+    def _write_record(self, key, image_bytes, label, annotation):
+        pass
+
+    @abc.abstractmethod
+    def _close_shard(self):
+        pass
+
+    def _discard_shard(self):
+        # releases the shard file before it is removed
+        self._close_shard()
+
+
+class TarShardWriter(ShardWriter):
+    '''
+    webdataset style tar shards: {key}.jpg with the image and {key}.json with label and face annotation.
+    Records are streamed into the tar file, only the current record is held in memory.
+    '''
+    extension = 'tar'
+
+    def _open_shard(self, path):
+        self.tar = tarfile.open(path, 'w')
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def _write_record(self, key, image_bytes, label, annotation):
+        self._add_member(f'{key}.jpg', bytes(image_bytes))
+        self._add_member(f'{key}.json', json.dumps({'label': label, 'face_annotation': json.loads(annotation)}).encode('utf-8'))
+
+    def _close_shard(self):
+        self.tar.close()
+
+
+class ParquetShardWriter(ShardWriter):
+    '''
+    Parquet shards with the columns key, image, label and face_annotation.
+    image is a struct of bytes and path, the layout huggingface datasets decodes as an Image feature.
+    A shard is buffered in memory until it is written, so shard_size bounds the memory used.
+    '''
+    extension = 'parquet'
+
+    def __init__(self, output_dir, prefix, shard_size=DATASET_SHARD_SIZE_MB * 1024 * 1024):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for the parquet format, pip install pyarrow')
+        super().__init__(output_dir, prefix, shard_size)
+
+    def _open_shard(self, path):
+        self.path = path
+        self.rows = {'key': [], 'image': [], 'label': [], 'face_annotation': []}
+
+    def _write_record(self, key, image_bytes, label, annotation):
+        self.rows['key'].append(key)
+        self.rows['image'].append({'bytes': bytes(image_bytes), 'path': f'{key}.jpg'})
+        self.rows['label'].append(label)
+        self.rows['face_annotation'].append(annotation)
+
+    def _close_shard(self):
+        pyarrow.parquet.write_table(pyarrow.table(self.rows), self.path)
+        self.rows = None
+
+    def _discard_shard(self):
+        # nothing is on disk before the shard is closed
+        self.rows = None
+
+
+SHARD_WRITERS = {'parquet': ParquetShardWriter, 'tar': TarShardWriter}
+
+
+def _download(url):
+    response = http_transport.get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def _fetch(url):
+    # the bytes of a MediaUrl are read through the content cache
+    return content_cache.read_through(url, _download)
+
+
+def iter_downloaded_images(file_url_iter, workers=EXPORT_WORKERS):
+    '''
+    Downloads images concurrently, keeping at most 2 * workers of them in flight or waiting to be consumed
+    Args:
+        file_url_iter: iterable of (file_name, url)
+        workers: int, number of concurrent downloads
+    yields:
+        (file_name, image bytes) in the order of file_url_iter, failed downloads are logged and left out
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def next_result():
+            file_name, future = pending.popleft()
+            try:
+                return file_name, future.result()
+            except Exception as e:
+                structured_log('Failed to download {}: {!r}'.format(file_name, e), severity=LogSeverity.ERROR)
+                return file_name, None
+
+        for file_name, url in file_url_iter:
+            pending.append((file_name, executor.submit(_fetch, url)))
+            if len(pending) >= 2 * workers:
+                file_name, image_bytes = next_result()
+                if image_bytes is not None:
+                    yield file_name, image_bytes
+        while pending:
+            file_name, image_bytes = next_result()
+            if image_bytes is not None:
+                yield file_name, image_bytes
+
+
+def export_images(file_url_iter, label, output_dir, prefix, format='parquet', shard_size_mb=DATASET_SHARD_SIZE_MB, workers=EXPORT_WORKERS):
+    '''
+    Streams images into self contained dataset shards, embedding the image bytes, the label
+    and the face annotation from the EXIF UserComment of each image
+    Args:
+        file_url_iter: iterable of (file_name, url)
+        label: string, label of every record
+        output_dir: string, directory of the shards
+        prefix: string, file name prefix of the shards
+        format: string, one of EXPORT_FORMATS
+        shard_size_mb: int, MiB of images per shard
+        workers: int, number of concurrent downloads
+    returns:
+        list of the shard file paths
+    '''
+    if format not in SHARD_WRITERS:
+        raise ValueError(f'format must be one of {EXPORT_FORMATS}, got {format}')
+    with SHARD_WRITERS[format](output_dir, prefix, shard_size_mb * 1024 * 1024) as writer:
+        for file_name, image_bytes in iter_downloaded_images(file_url_iter, workers):
+            writer.write(file_name.rsplit('.', 1)[0], image_bytes, label, face_annotation_from_image_bytes(image_bytes))
+            if writer.records % 1000 == 0:
+                structured_log('Exported {} images'.format(writer.records))
+    structured_log('Exported {} images into {} shards in {}'.format(writer.records, len(writer.shard_paths), output_dir))
+    return writer.shard_paths
+
+
+def export_image_files(file_paths, label, output_dir, prefix, format='parquet', shard_size_mb=DATASET_SHARD_SIZE_MB):
+    '''
+    Same as export_images for images that are on disk already, e.g. downloaded by AlbumDownloader
+    Args:
+        file_paths: iterable of image file paths
+    returns:
+        list of the shard file paths
+    '''
+    if format not in SHARD_WRITERS:
+        raise ValueError(f'format must be one of {EXPORT_FORMATS}, got {format}')
+    with SHARD_WRITERS[format](output_dir, prefix, shard_size_mb * 1024 * 1024) as writer:
+        for file_path in file_paths:
+            with open(file_path, 'rb') as f:
+                image_bytes = f.read()
+            writer.write(os.path.basename(file_path).rsplit('.', 1)[0], image_bytes, label, face_annotation_from_image_bytes(image_bytes))
+    structured_log('Exported {} images into {} shards in {}'.format(writer.records, len(writer.shard_paths), output_dir))
+    return writer.shard_paths
@@ -0,0 +1,175 @@
+import json
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import piexif
+
+import content_cache
+import http_transport
+from google_logging import structured_log, LogSeverity
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # only needed for parquet indexes, pip install pyarrow
+    pyarrow = None
+
+# PIL writes the EXIF segment right after the JFIF header, a face annotation with landmarks takes a few KB
+EXIF_RANGE_BYTES = 16 * 1024
+INDEX_WORKERS = int(os.environ.get('INDEX_WORKERS', os.cpu_count() or 1))
+FACE_IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+SOI = b'\xff\xd8'
+APP1 = 0xE1
+SOS = 0xDA
+EOI = 0xD9
+EXIF_HEADER = b'Exif\x00\x00'
+
+
+def find_exif_segment(buffer):
+    '''
+    Walks the JPEG segment headers up to the start of the image data, looking for the APP1 EXIF segment
+    Args:
+        buffer: bytes, mmap or memoryview holding the start of a JPEG file
+    returns:
+        (offset, length) of the EXIF payload starting with b'Exif', None if there is none.
+        The payload may extend past the end of buffer if buffer is only the start of the file.
+    '''
+    if buffer[:2] != SOI:
+        return None
+    offset = 2
+    while offset + 4 <= len(buffer):
+        if buffer[offset] != 0xFF:
+            return None
+        marker = buffer[offset + 1]
+        if marker == 0xFF:
+            # fill byte
+            offset += 1
+            continue
+        if marker in (SOS, EOI):
+            return None
+        segment_length = struct.unpack('>H', buffer[offset + 2:offset + 4])[0]
+        if marker == APP1 and buffer[offset + 4:offset + 10] == EXIF_HEADER:
+            return offset + 4, segment_length - 2
+        offset += 2 + segment_length
+    return None
+
+
+def user_comment_from_exif_segment(segment):
+    '''
+    returns: the UserComment of an EXIF payload as a string, None if there is none
+    '''
+    exif_dict = piexif.load(bytes(segment))
+    user_comment = exif_dict['Exif'].get(piexif.ExifIFD.UserComment)
+    return user_comment.decode('utf-8') if user_comment else None
+
+
+def read_exif_user_comment_from_file(file_path):
+    '''
+    Reads the UserComment of a JPEG file, only the segment headers and the EXIF segment are paged in
+    returns: the UserComment as a string, None if there is none
+    '''
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            location = find_exif_segment(buffer)
+            if location is None:
+                return None
+            offset, length = location
+            return user_comment_from_exif_segment(buffer[offset:offset + length])
+
+
+def read_exif_user_comment_from_url(url, range_bytes=EXIF_RANGE_BYTES):
+    '''
+    Reads the UserComment of a JPEG behind a url, downloading only the start of the file.
+    A second range request is made if the EXIF segment is larger than range_bytes.
+    Nothing is downloaded for a MediaUrl whose bytes are in the content cache.
+    returns: the UserComment as a string, None if there is none
+    '''
+    head = content_cache.cached_content(url)
+    if head is not None:
+        location = find_exif_segment(head)
+        return None if location is None else user_comment_from_exif_segment(head[location[0]:location[0] + location[1]])
+    head = http_transport.get(url, headers={'Range': f'bytes=0-{range_bytes - 1}'}).content
+    location = find_exif_segment(head)
+    if location is None:
+        return None
+    offset, length = location
+    if offset + length > len(head):
+        head = http_transport.get(url, headers={'Range': f'bytes=0-{offset + length - 1}'}).content
+    return user_comment_from_exif_segment(head[offset:offset + length])
+
+
+def face_index_row(file_name, annotation):
+    '''
+    Flattens a face annotation from Vision into a row of the face index
+    '''
+    left, top, right, bottom = 0, 0, 0, 0
+    vertices = annotation.get('boundingPoly', {}).get('vertices', [])
+    if len(vertices) == 4:
+        left, top = vertices[0].get('x', 0), vertices[0].get('y', 0)
+        right, bottom = vertices[2].get('x', 0), vertices[2].get('y', 0)
+    landmarks = annotation.get('landmarks', [])
+    return {
+        'file_name': file_name,
+        'left': left,
+        'top': top,
+        'right': right,
+        'bottom': bottom,
+        'detection_confidence': annotation.get('detectionConfidence', 0.0),
+        'landmarking_confidence': annotation.get('landmarkingConfidence', 0.0),
+        'roll_angle': annotation.get('rollAngle', 0.0),
+        'pan_angle': annotation.get('panAngle', 0.0),
+        'tilt_angle': annotation.get('tiltAngle', 0.0),
+        'landmark_types': [landmark.get('type', '') for landmark in landmarks],
+        'landmark_x': [landmark.get('position', {}).get('x', 0.0) for landmark in landmarks],
+        'landmark_y': [landmark.get('position', {}).get('y', 0.0) for landmark in landmarks],
+        'landmark_z': [landmark.get('position', {}).get('z', 0.0) for landmark in landmarks],
+    }
+
+
+def _index_file(file_path):
+    try:
+        user_comment = read_exif_user_comment_from_file(file_path)
+        if user_comment is None:
+            return None
+        return face_index_row(os.path.basename(file_path), json.loads(user_comment))
+    except (ValueError, piexif.InvalidImageDataError, OSError) as e:
+        structured_log('Cannot index {}: {!r}'.format(file_path, e), severity=LogSeverity.WARNING)
+        return None
+
+
+def build_face_annotation_index(image_dir, index_file_path, workers=INDEX_WORKERS):
+    '''
+    Reads the face annotations of all face crops in a directory on a process pool and writes them into a columnar index,
+    one row per crop with bounding box, confidences, angles and landmark positions.
+    Args:
+        image_dir: string, directory of the face crops
+        index_file_path: string, .parquet (needs pyarrow) or .json, which holds a list of values per column
+        workers: int, number of processes
+    returns:
+        number of indexed crops
+    '''
+    file_paths = sorted(
+        os.path.join(image_dir, file_name) for file_name in os.listdir(image_dir)
+        if file_name.lower().endswith(FACE_IMAGE_EXTENSIONS))
+    if index_file_path.endswith('.parquet') and pyarrow is None:
+        raise ImportError('pyarrow is required for parquet indexes, pip install pyarrow')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # the work per file is tiny, so files are handed out in chunks
+        chunksize = max(1, len(file_paths) // (workers * 8))
+        rows = [row for row in executor.map(_index_file, file_paths, chunksize=chunksize) if row is not None]
+    columns = {name: [row[name] for row in rows] for name in face_index_row('', {})}
+    temp_index_file_path = index_file_path + '.part'
+    if index_file_path.endswith('.parquet'):
+        pyarrow.parquet.write_table(pyarrow.table(columns), temp_index_file_path)
+    else:
+        with open(temp_index_file_path, 'w') as f:
+            json.dump(columns, f)
+    os.replace(temp_index_file_path, index_file_path)
+    structured_log('Indexed {} of {} face images into {}'.format(len(rows), len(file_paths), index_file_path))
+    return len(rows)
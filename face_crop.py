@@ -0,0 +1,191 @@
+import copy
+import json
+import math
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+
+import piexif
+from PIL import Image
+
+import pipeline_metrics
+
+# longest side of a face crop in pixels, larger crops are scaled down, 0 keeps the full resolution
+FACE_CROP_MAX_SIZE = int(os.environ.get('FACE_CROP_MAX_SIZE', 0))
+# 75 is the PIL default the crops were always saved with
+FACE_CROP_QUALITY = int(os.environ.get('FACE_CROP_QUALITY', 75))
+FACE_CROP_WORKERS = int(os.environ.get('FACE_CROP_WORKERS', os.cpu_count() or 1))
+# image modes PIL can write as JPEG, e.g. RGBA from PNG originals has to be converted
+JPEG_MODES = ('1', 'L', 'RGB', 'RGBX', 'CMYK', 'YCbCr')
+
+
+def face_bounding_box(face, width, height):
+    '''
+    returns: (left, top, right, bottom) of a face annotation, vertices without x or y lie on the image border
+    '''
+    vertices = face['boundingPoly']['vertices']
+    return (
+        vertices[0].get('x', 0),
+        vertices[0].get('y', 0),
+        vertices[2].get('x', width),
+        vertices[2].get('y', height),
+    )
+
+
+def rescale_face_annotation(face, factor):
+    '''
+    Maps a face annotation made on a downscaled copy back onto the original image
+    Args:
+        face: dict, a faceAnnotation from Vision
+        factor: float, original pixels per pixel of the annotated copy
+    returns: a new face annotation with bounding polygons and landmark positions multiplied by factor
+    '''
+    if factor == 1:
+        return face
+    face = copy.deepcopy(face)
+    for poly_name in ('boundingPoly', 'fdBoundingPoly'):
+        for vertex in face.get(poly_name, {}).get('vertices', []):
+            for axis in ('x', 'y'):
+                if axis in vertex:
+                    vertex[axis] = round(vertex[axis] * factor)
+    for landmark in face.get('landmarks', []):
+        position = landmark.get('position', {})
+        for axis in ('x', 'y', 'z'):
+            if axis in position:
+                position[axis] *= factor
+    return face
+
+
+def load_exif(image):
+    try:
+        return piexif.load(image.info['exif'])
+    except KeyError:
+        # some images does not have proper exif data altogether
+        return {"0th": {}, "Exif": {}}
+
+
+def image_creation_time(image, exif_dict=None):
+    '''
+    returns: the date part of DateTimeOriginal, e.g. 2022:10:29, or UNKONWN_TIME
+    '''
+    if exif_dict is None:
+        exif_dict = load_exif(image)
+    if piexif.ExifIFD.DateTimeOriginal in exif_dict['Exif']:
+        return exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal][:10].decode('utf-8')
+    return 'UNKONWN_TIME'
+
+
+def crop_faces(image_bytes, faces, max_size=FACE_CROP_MAX_SIZE, quality=FACE_CROP_QUALITY):
+    '''
+    Decodes an image once and crops all its faces.
+    If every crop would be scaled down to max_size anyway, a JPEG is decoded at a reduced DCT scale (1/2, 1/4 or 1/8),
+    which skips most of the decoding work.
+    Args:
+        image_bytes: bytes of the original image
+        faces: list of faceAnnotations from Vision, in the coordinates of the original image
+        max_size: int, longest side of a crop, 0 for no limit
+        quality: int, JPEG quality of the crops
+    returns:
+        tuple (image creation time, list of JPEG bytes per face with the face annotation as EXIF UserComment)
+        the crops keep the ImageDescription of the image, e.g. the time of a video frame, see video_frames.frame_to_jpeg
+    '''
+    image = Image.open(BytesIO(image_bytes))
+    source_exif_dict = load_exif(image)
+    creation_time = image_creation_time(image, source_exif_dict)
+    description = source_exif_dict['0th'].get(piexif.ImageIFD.ImageDescription)
+    width, height = image.size
+    boxes = [face_bounding_box(face, width, height) for face in faces]
+    if max_size and boxes and image.format == 'JPEG':
+        # the smallest face decides how far the whole image may be reduced
+        scale = max(min(1, max_size / max(right - left, bottom - top, 1)) for left, top, right, bottom in boxes)
+        if scale < 1:
+            image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+    scale_x = image.size[0] / width
+    scale_y = image.size[1] / height
+    image.load()
+
+    crops = []
+    for face, (left, top, right, bottom) in zip(faces, boxes):
+        face_crop = image.crop((
+            round(left * scale_x),
+            round(top * scale_y),
+            round(right * scale_x),
+            round(bottom * scale_y),
+        ))
+        if max_size and max(face_crop.size) > max_size:
+            face_crop.thumbnail((max_size, max_size))
+        if face_crop.mode not in JPEG_MODES:
+            face_crop = face_crop.convert('RGB')
+        # add face detection meta data to exif
+        exif_dict = {"0th": {}, "Exif": {}}
+        exif_dict['Exif'][piexif.ExifIFD.UserComment] = json.dumps(face).encode('utf-8')
+        if description is not None:
+            exif_dict['0th'][piexif.ImageIFD.ImageDescription] = description
+        face_crop_bytes = BytesIO()
+        face_crop.save(face_crop_bytes, format='JPEG', quality=quality, exif=piexif.dump(exif_dict))
+        crops.append(face_crop_bytes.getvalue())
+    return creation_time, crops
+
+
+def _timed_crop_faces(*args):
+    # the time is taken in the worker process, the parent records it
+    start = time.monotonic()
+    result = crop_faces(*args)
+    return result, time.monotonic() - start
+
+
+def _record_crop(result, seconds):
+    _, crops = result
+    pipeline_metrics.record('crop', seconds, items=len(crops), bytes=sum(len(crop) for crop in crops))
+
+
+class FaceCropEngine:
+    '''
+    Runs crop_faces on a process pool so that decoding and encoding scale with the number of cores.
+    With a single worker the crops are made inline.
+    '''
+
+    def __init__(self, workers=FACE_CROP_WORKERS, max_size=FACE_CROP_MAX_SIZE, quality=FACE_CROP_QUALITY):
+        self.max_size = max_size
+        self.quality = quality
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, image_bytes, faces):
+        '''
+        returns: a future of crop_faces(image_bytes, faces)
+        '''
+        future = Future()
+        if self.executor is not None:
+            # memory mapped blobs cannot be pickled to the workers
+            timed_future = self.executor.submit(_timed_crop_faces, bytes(image_bytes), faces, self.max_size, self.quality)
+            timed_future.add_done_callback(lambda done: self._resolve(future, done))
+            return future
+        try:
+            result, seconds = _timed_crop_faces(image_bytes, faces, self.max_size, self.quality)
+            _record_crop(result, seconds)
+            future.set_result(result)
+        except Exception as e:
+            pipeline_metrics.record('crop', errors=1)
+            future.set_exception(e)
+        return future
+
+    def _resolve(self, future, timed_future):
+        try:
+            result, seconds = timed_future.result()
+        except Exception as e:
+            pipeline_metrics.record('crop', errors=1)
+            future.set_exception(e)
+            return
+        _record_crop(result, seconds)
+        future.set_result(result)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
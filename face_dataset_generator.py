@@ -1,21 +1,24 @@
 from google_photo_api import GooglePhotoHelper
 import json
-from PIL import Image
-from io import BytesIO
-import piexif
-import requests
+from album_download import DOWNLOAD_WORKERS
+from dataset_export import export_images, export_image_files, DATASET_SHARD_SIZE_MB, EXPORT_WORKERS
+from face_grouping import FaceGroupingIndex
+import itertools
+from exif_index import read_exif_user_comment_from_file, read_exif_user_comment_from_url
 from requests.exceptions import ConnectionError
 import os
 
 ALBUM_NAME = 'Ada'
 
-def generate_face_dataset_from_google_album_for_hugging_face(album_name, size):
+def generate_face_dataset_from_google_album_for_hugging_face(album_name, size, catalog=None):
     '''
     If you want to generate face with someone specific, do the following:
     1. make sure all the face images are generated using this automation tool
     2. in Google photo, use the search function to search for the person you want to generate face with
     3. in the search result page, create a new album using "share as album"
     4. name the album as the person's name, use the name as the parameter for this function
+    export_face_dataset_from_face_groups does without the album, from faces downloaded once
+
 
     How to use the file with huggingface datasets:
     ```
@@ -30,47 +33,106 @@ def generate_face_dataset_from_google_album_for_hugging_face(album_name, size):
     from io import BytesIO
     import requests
 
-    # you also need to pre-download the image files to your local machine, since the urls will be expired after an hour
+    # you also need to pre-download the image files to your local machine, since the urls will be expired after an hour,
+    # export_face_dataset_from_google_album does that in bulk and writes shards that load without network access
     def pre_download(example):
         example['image'] = Image.open(BytesIO(requests.get(example["image_url"]).content))
         return example
 
+    # or, next to this repo, images the other dataset tools downloaded before are read from the content cache
+    from content_cache import get_content_cache
+    def pre_download(example):
+        image_bytes = get_content_cache().fetch((example["media_item_id"], 'd'), lambda: requests.get(example["image_url"]).content)
+        example['image'] = Image.open(BytesIO(image_bytes))
+        return example
+
     dataset = dataset.map(pre_download, batched=False)
     dataset = dataset.cast_column("image", DsImage())
     ```
     '''
     helper = GooglePhotoHelper()
-    album_list = helper.find_albums_by_name(album_name)
+    album_list = helper.find_albums_by_name(album_name, catalog)
     if len(album_list) != 1:
         raise Exception(f'There should be only one album named {album_name}!')
     file_name_url_list = helper.list_face_download_urls_from_album(album_list[0]['id'], size=size)
-    data_json_str_list = [json.dumps({"image_url": url, "label": album_name}) for _, url in file_name_url_list]
+    # the media item id keys the bytes in the content cache, the url expires
+    data_json_str_list = [json.dumps({"image_url": url, "media_item_id": url.media_item_id, "label": album_name}) + '\n' for _, url in file_name_url_list]
     # write json lines to file:
     with open(album_name + '_face_dataset.json', 'w') as f:
         f.writelines(data_json_str_list)
 
+def export_face_dataset_from_google_album(album_name, output_dir, size=None, format='parquet', shard_size_mb=DATASET_SHARD_SIZE_MB, workers=EXPORT_WORKERS, catalog=None):
+    '''
+    Exports the face images of an album into self contained dataset shards, see generate_face_dataset_from_google_album_for_hugging_face
+    for how to create the album. Every record holds the image bytes, the album name as label and the face annotation json.
+
+    How to use the shards with huggingface datasets:
+    ```
+    from datasets import load_dataset, Image as DsImage
+    dataset = load_dataset("parquet", data_files="faces/Ada-*.parquet", split='train')
+    dataset = dataset.cast_column("image", DsImage())
+    ```
+    or with webdataset, for format='tar': `webdataset.WebDataset("faces/Ada-{00000..00009}.tar").decode("pil")`
+    Args:
+        album_name: string, name of the album, also the label of the records
+        output_dir: string, directory of the shards
+        size: int, maximum number of images, None for all of them
+        format: string, 'parquet' (needs pyarrow) or 'tar'
+        shard_size_mb: int, MiB of images per shard
+        workers: int, number of concurrent downloads
+        catalog: PhotoCatalog, if not None, the album is looked up there instead of listing every album
+    returns:
+        list of the shard file paths
+    '''
+    helper = GooglePhotoHelper()
+    album_list = helper.find_albums_by_name(album_name, catalog)
+    if len(album_list) != 1:
+        raise Exception(f'There should be only one album named {album_name}!')
+    file_url_iter = itertools.islice(helper.iter_face_download_urls_from_album(album_list[0]['id']), size)
+    return export_images(file_url_iter, album_name, output_dir, album_name, format, shard_size_mb, workers)
+
+def export_face_dataset_from_face_groups(image_dir, examples, output_dir, index_file_path=None, with_descriptors=True, format='parquet', shard_size_mb=DATASET_SHARD_SIZE_MB):
+    '''
+    Exports a dataset per person from face crops on disk, e.g. downloaded with download_file_into_folder_from_url_list,
+    by grouping the faces offline and naming the groups by an example face of each person, see face_grouping
+    Args:
+        image_dir: string, directory of the face crops
+        examples: dict of a person's name, which is also the label, to the file name of one or more of their faces
+        output_dir: string, directory of the shards, named {name}-00000.{format}, ...
+        index_file_path: string, .npz file the grouping index is loaded from if it exists, and saved to otherwise
+        with_descriptors: boolean, see FaceGroupingIndex.build
+    returns:
+        dict of name to the list of its shard file paths
+    '''
+    if index_file_path is not None and os.path.exists(index_file_path):
+        index = FaceGroupingIndex.load(index_file_path)
+    else:
+        index = FaceGroupingIndex.build(image_dir, with_descriptors=with_descriptors)
+        if index_file_path is not None:
+            index.save(index_file_path)
+    named_file_names = index.name_groups(index.cluster(), examples)
+    return {
+        name: export_image_files([os.path.join(image_dir, file_name) for file_name in file_names], name, output_dir, name, format, shard_size_mb)
+        for name, file_names in named_file_names.items()
+    }
+
 def retry_if_connection_error(exception):
     return isinstance(exception, ConnectionError)
 
-def download_file_into_folder_from_url_list(album_name, size, dir_path):
+def download_file_into_folder_from_url_list(album_name, size, dir_path, workers=DOWNLOAD_WORKERS, catalog=None):
     helper = GooglePhotoHelper()
-    album_list = helper.find_albums_by_name('Ada')
+    album_list = helper.find_albums_by_name('Ada', catalog)
     if len(album_list) != 1:
         raise Exception(f'There should be only one album named {album_name}!')
-    return helper.list_face_download_urls_from_album(album_list[0]['id'], size=size, download=True, download_dir=dir_path)
+    return helper.list_face_download_urls_from_album(album_list[0]['id'], size=size, download=True, download_dir=dir_path, workers=workers)
 
 def read_exif_user_comment_from_image_file(file_path):
-    image = Image.open(file_path)
-    try:
-        exif_dict = piexif.load(image.info['exif'])
-        return exif_dict['Exif'][piexif.ExifIFD.UserComment].decode('utf-8')
-    except KeyError:
-        return '{}'
+    # only the EXIF segment is read, the image is never decoded
+    return read_exif_user_comment_from_file(file_path) or '{}'
 
 def read_exif_user_comment_from_image_url(url):
-    image = Image.open(BytesIO(requests.get(url).content))
-    exif_dict = piexif.load(image.info['exif'])
-    return exif_dict['Exif'][piexif.ExifIFD.UserComment].decode('utf-8')
+    # only the first few KB of the image are downloaded, nothing if it is in the content cache
+    return read_exif_user_comment_from_url(url) or '{}'
 
 
 if __name__ == '__main__':
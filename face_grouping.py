@@ -0,0 +1,326 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import piexif
+from PIL import Image
+
+from exif_index import read_exif_user_comment_from_file, face_index_row, INDEX_WORKERS, FACE_IMAGE_EXTENSIONS
+from google_logging import structured_log, LogSeverity
+
+try:
+    import numpy as np
+except ImportError:
+    # only needed for grouping faces, pip install numpy
+    np = None
+
+# landmark types of a Vision face annotation, in the column order of the geometry array
+LANDMARK_TYPES = (
+    'LEFT_EYE', 'RIGHT_EYE', 'LEFT_OF_LEFT_EYEBROW', 'RIGHT_OF_LEFT_EYEBROW', 'LEFT_OF_RIGHT_EYEBROW',
+    'RIGHT_OF_RIGHT_EYEBROW', 'MIDPOINT_BETWEEN_EYES', 'NOSE_TIP', 'UPPER_LIP', 'LOWER_LIP', 'MOUTH_LEFT',
+    'MOUTH_RIGHT', 'MOUTH_CENTER', 'NOSE_BOTTOM_RIGHT', 'NOSE_BOTTOM_LEFT', 'NOSE_BOTTOM_CENTER',
+    'LEFT_EYE_TOP_BOUNDARY', 'LEFT_EYE_RIGHT_CORNER', 'LEFT_EYE_BOTTOM_BOUNDARY', 'LEFT_EYE_LEFT_CORNER',
+    'RIGHT_EYE_TOP_BOUNDARY', 'RIGHT_EYE_RIGHT_CORNER', 'RIGHT_EYE_BOTTOM_BOUNDARY', 'RIGHT_EYE_LEFT_CORNER',
+    'LEFT_EYEBROW_UPPER_MIDPOINT', 'RIGHT_EYEBROW_UPPER_MIDPOINT', 'LEFT_EAR_TRAGION', 'RIGHT_EAR_TRAGION',
+    'LEFT_EYE_PUPIL', 'RIGHT_EYE_PUPIL', 'FOREHEAD_GLABELLA', 'CHIN_GNATHION', 'CHIN_LEFT_GONION', 'CHIN_RIGHT_GONION',
+)
+LANDMARK_COLUMNS = {landmark_type: n for n, landmark_type in enumerate(LANDMARK_TYPES)}
+# side of the grayscale thumbnail the pixel descriptor is made of
+DESCRIPTOR_SIZE = 16
+# share of the distance between two faces that comes from the pixel descriptor and from the head pose,
+# the rest comes from the landmark geometry
+DESCRIPTOR_WEIGHT = float(os.environ.get('GROUPING_DESCRIPTOR_WEIGHT', 0.5))
+POSE_WEIGHT = float(os.environ.get('GROUPING_POSE_WEIGHT', 0.1))
+GROUPING_NEIGHBORS = int(os.environ.get('GROUPING_NEIGHBORS', 10))
+# distance between unit vectors, 0 to 2, below which mutual neighbors are put into the same group
+GROUPING_DISTANCE_THRESHOLD = float(os.environ.get('GROUPING_DISTANCE_THRESHOLD', 0.6))
+GROUPING_MIN_GROUP_SIZE = int(os.environ.get('GROUPING_MIN_GROUP_SIZE', 3))
+# queries are answered this many at a time, a batch takes batch size * index size * 4 bytes of distances
+QUERY_BATCH_SIZE = 1024
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for grouping faces, pip install numpy')
+
+
+def _eye_frame(points, box):
+    '''
+    returns: (center, scale, cos, sin) of the frame with the eyes on the x axis, one unit apart,
+    or the bounding box with no rotation if an eye is missing
+    '''
+    left_eye, right_eye = points[LANDMARK_COLUMNS['LEFT_EYE']], points[LANDMARK_COLUMNS['RIGHT_EYE']]
+    if np.isnan(left_eye).any() or np.isnan(right_eye).any():
+        left, top, right, bottom = box
+        return np.array([(left + right) / 2, (top + bottom) / 2, 0.0]), max(right - left, 1), 1.0, 0.0
+    direction = right_eye[:2] - left_eye[:2]
+    # the eye on the left of the image comes first, whichever side of the face it is
+    if direction[0] < 0:
+        direction = -direction
+    scale = float(np.hypot(*direction)) or 1.0
+    return (left_eye + right_eye) / 2, scale, direction[0] / scale, direction[1] / scale
+
+
+def face_geometry(annotation):
+    '''
+    Normalizes the landmarks of a face annotation: centered between the eyes, rotated so that the eyes are level
+    and scaled so that they are one unit apart, which leaves the proportions of the face.
+    returns: float32 array of x, y and z of every landmark type, NaN for missing landmarks
+    '''
+    points = np.full((len(LANDMARK_TYPES), 3), np.nan)
+    for landmark in annotation.get('landmarks', []):
+        column = LANDMARK_COLUMNS.get(landmark.get('type'))
+        if column is not None:
+            position = landmark.get('position', {})
+            points[column] = position.get('x', 0.0), position.get('y', 0.0), position.get('z', 0.0)
+    row = face_index_row('', annotation)
+    center, scale, cos, sin = _eye_frame(points, (row['left'], row['top'], row['right'], row['bottom']))
+    points = (points - center) / scale
+    x, y = points[:, 0].copy(), points[:, 1].copy()
+    points[:, 0] = x * cos + y * sin
+    points[:, 1] = y * cos - x * sin
+    return points.reshape(-1).astype(np.float32)
+
+
+def face_descriptor(image, annotation, size=DESCRIPTOR_SIZE):
+    '''
+    A pixel descriptor of a face crop: the crop rotated so that the eyes are level,
+    as a size x size grayscale thumbnail with zero mean and unit norm
+    Args:
+        image: PIL image of the crop
+        annotation: dict, the face annotation of the crop, in the coordinates of the original image
+    returns: float32 array of size * size values
+    '''
+    row = face_index_row('', annotation)
+    box_width, box_height = max(row['right'] - row['left'], 1), max(row['bottom'] - row['top'], 1)
+    positions = {landmark.get('type'): landmark.get('position', {}) for landmark in annotation.get('landmarks', [])}
+    image = image.convert('L')
+    if 'LEFT_EYE' in positions and 'RIGHT_EYE' in positions:
+        # the crop may have been scaled down from the bounding box
+        scale_x, scale_y = image.size[0] / box_width, image.size[1] / box_height
+        eyes = [((positions[eye].get('x', 0.0) - row['left']) * scale_x, (positions[eye].get('y', 0.0) - row['top']) * scale_y)
+                for eye in ('LEFT_EYE', 'RIGHT_EYE')]
+        (x0, y0), (x1, y1) = sorted(eyes)
+        image = image.rotate(math.degrees(math.atan2(y1 - y0, x1 - x0)), resample=Image.BILINEAR,
+                             center=((x0 + x1) / 2, (y0 + y1) / 2))
+    pixels = np.asarray(image.resize((size, size), Image.BOX), dtype=np.float32).reshape(-1)
+    pixels -= pixels.mean()
+    norm = np.linalg.norm(pixels)
+    return pixels / norm if norm else pixels
+
+
+def _face_record(file_path, with_descriptor):
+    try:
+        user_comment = read_exif_user_comment_from_file(file_path)
+        if user_comment is None:
+            return None
+        annotation = json.loads(user_comment)
+        row = face_index_row(os.path.basename(file_path), annotation)
+        descriptor = None
+        if with_descriptor:
+            with Image.open(file_path) as image:
+                # half precision is plenty for unit vectors of pixel values, and halves the index
+                descriptor = face_descriptor(image, annotation).astype(np.float16)
+        return (
+            row['file_name'],
+            face_geometry(annotation),
+            np.array([row['pan_angle'], row['tilt_angle'], row['roll_angle']], dtype=np.float32),
+            np.array([row['left'], row['top'], row['right'], row['bottom']], dtype=np.int32),
+            np.array([row['detection_confidence'], row['landmarking_confidence']], dtype=np.float32),
+            descriptor,
+        )
+    except (ValueError, piexif.InvalidImageDataError, OSError) as e:
+        structured_log('Cannot group {}: {!r}'.format(file_path, e), severity=LogSeverity.WARNING)
+        return None
+
+
+class FaceGroupingIndex:
+    '''
+    Face crops as NumPy arrays, one row per crop, for finding the crops of the same person without any API calls.
+    The rows are made from the face annotation in the EXIF UserComment of the crops, see face_crop.crop_faces:
+    geometry holds the normalized landmark positions, see face_geometry, pose the pan, tilt and roll angles,
+    boxes the bounding box in the original image and confidences the detection and landmarking confidence.
+    descriptors optionally holds a pixel descriptor of every crop in half precision, see face_descriptor.
+    Saved as a single .npz file.
+    '''
+    ARRAYS = ('file_names', 'geometry', 'pose', 'boxes', 'confidences', 'descriptors')
+
+    def __init__(self, file_names, geometry, pose, boxes, confidences, descriptors=None):
+        _require_numpy()
+        self.file_names = np.asarray(file_names, dtype=str)
+        self.geometry = geometry
+        self.pose = pose
+        self.boxes = boxes
+        self.confidences = confidences
+        self.descriptors = descriptors
+        self.rows = {file_name: n for n, file_name in enumerate(self.file_names)}
+        self._vectors = None
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @classmethod
+    def build(cls, image_dir, with_descriptors=False, workers=INDEX_WORKERS):
+        '''
+        Reads the face crops of a directory on a process pool, e.g. a directory filled by AlbumDownloader
+        Args:
+            image_dir: string, directory of the face crops
+            with_descriptors: boolean, whether to decode the crops for pixel descriptors,
+                which tell people apart much better than the geometry alone but take most of the time
+            workers: int, number of processes
+        '''
+        _require_numpy()
+        file_paths = sorted(
+            os.path.join(image_dir, file_name) for file_name in os.listdir(image_dir)
+            if file_name.lower().endswith(FACE_IMAGE_EXTENSIONS))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(file_paths) // (workers * 8))
+            records = [record for record in executor.map(partial(_face_record, with_descriptor=with_descriptors), file_paths, chunksize=chunksize)
+                       if record is not None]
+        structured_log('Read {} faces of {} images in {}'.format(len(records), len(file_paths), image_dir))
+        if not records:
+            return cls([], np.zeros((0, 3 * len(LANDMARK_TYPES)), np.float32), np.zeros((0, 3), np.float32),
+                       np.zeros((0, 4), np.int32), np.zeros((0, 2), np.float32),
+                       np.zeros((0, DESCRIPTOR_SIZE * DESCRIPTOR_SIZE), np.float32) if with_descriptors else None)
+        file_names, geometry, pose, boxes, confidences, descriptors = zip(*records)
+        return cls(file_names, np.stack(geometry), np.stack(pose), np.stack(boxes), np.stack(confidences),
+                   np.stack(descriptors) if with_descriptors else None)
+
+    @classmethod
+    def load(cls, index_file_path):
+        _require_numpy()
+        with np.load(index_file_path, allow_pickle=False) as arrays:
+            return cls(**{name: arrays[name] for name in cls.ARRAYS if name in arrays.files})
+
+    def save(self, index_file_path):
+        arrays = {name: getattr(self, name) for name in self.ARRAYS if getattr(self, name) is not None}
+        temp_index_file_path = index_file_path + '.part'
+        with open(temp_index_file_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_index_file_path, index_file_path)
+        structured_log('Saved {} faces into {}'.format(len(self), index_file_path))
+
+    def vectors(self):
+        '''
+        returns: float32 array with a unit vector per face, the geometry, pose and descriptor columns
+        standardized and weighted by DESCRIPTOR_WEIGHT and POSE_WEIGHT, so that distances are comparable
+        '''
+        if self._vectors is None:
+            blocks = [(self.pose, POSE_WEIGHT)]
+            if self.descriptors is not None:
+                blocks.append((self.descriptors, DESCRIPTOR_WEIGHT))
+            blocks.insert(0, (self.geometry, 1 - sum(weight for _, weight in blocks)))
+            columns = []
+            for block, weight in blocks:
+                block = block.astype(np.float32)
+                with np.errstate(invalid='ignore'):
+                    mean = np.nanmean(block, axis=0) if len(block) else np.zeros(block.shape[1], np.float32)
+                    std = np.nanstd(block, axis=0) if len(block) else np.ones(block.shape[1], np.float32)
+                # a missing landmark counts as an average one
+                block = np.nan_to_num((block - np.nan_to_num(mean)) / np.where(std > 0, std, 1))
+                columns.append(block * math.sqrt(max(weight, 0) / block.shape[1]))
+            vectors = np.concatenate(columns, axis=1)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            self._vectors = vectors / np.where(norms > 0, norms, 1)
+        return self._vectors
+
+    def query(self, query_vectors, k=GROUPING_NEIGHBORS, exclude_self=False):
+        '''
+        Finds the k nearest faces of every query, QUERY_BATCH_SIZE queries with a single matrix product
+        Args:
+            query_vectors: array of rows of vectors(), e.g. vectors()[[3, 5]]
+            k: int, number of neighbors
+            exclude_self: boolean, whether the queries are all rows of the index in order, whose own row is skipped
+        returns:
+            (distances, row indices), arrays of shape (queries, k) sorted by distance
+        '''
+        vectors = self.vectors()
+        k = min(k, len(self) - (1 if exclude_self else 0))
+        all_distances = np.empty((len(query_vectors), max(k, 0)), np.float32)
+        all_indices = np.empty((len(query_vectors), max(k, 0)), np.int64)
+        if k <= 0:
+            return all_distances, all_indices
+        for start in range(0, len(query_vectors), QUERY_BATCH_SIZE):
+            batch = query_vectors[start:start + QUERY_BATCH_SIZE]
+            # for unit vectors |a - b|^2 = 2 - 2 a.b
+            squared = np.maximum(2 - 2 * batch @ vectors.T, 0)
+            if exclude_self:
+                squared[np.arange(len(batch)), np.arange(start, start + len(batch))] = np.inf
+            indices = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            distances = np.take_along_axis(squared, indices, axis=1)
+            order = np.argsort(distances, axis=1)
+            all_indices[start:start + len(batch)] = np.take_along_axis(indices, order, axis=1)
+            all_distances[start:start + len(batch)] = np.sqrt(np.take_along_axis(distances, order, axis=1))
+        return all_distances, all_indices
+
+    def similar(self, file_names, k=GROUPING_NEIGHBORS):
+        '''
+        returns: list of lists of (file name, distance) of the k faces nearest to each of file_names, the face itself included
+        '''
+        distances, indices = self.query(self.vectors()[[self.rows[file_name] for file_name in file_names]], k)
+        return [[(str(self.file_names[i]), float(d)) for d, i in zip(row_distances, row_indices)]
+                for row_distances, row_indices in zip(distances, indices)]
+
+    def cluster(self, k=GROUPING_NEIGHBORS, threshold=GROUPING_DISTANCE_THRESHOLD, min_size=GROUPING_MIN_GROUP_SIZE):
+        '''
+        Groups the faces: two faces are linked if each is among the k nearest of the other and they are closer
+        than threshold, a group is a connected set of linked faces. Requiring both directions keeps a face between
+        two groups from merging them.
+        returns:
+            int array with the group of every face, groups numbered by size from 0, -1 for faces in groups smaller than min_size
+        '''
+        n = len(self)
+        labels = np.full(n, -1, np.int64)
+        if n < 2:
+            return labels
+        distances, indices = self.query(self.vectors(), k, exclude_self=True)
+        sources = np.repeat(np.arange(n), indices.shape[1])
+        targets = indices.reshape(-1)
+        close = distances.reshape(-1) < threshold
+        sources, targets = sources[close], targets[close]
+        pairs = sources * n + targets
+        mutual = np.isin(targets * n + sources, pairs) & (sources < targets)
+        parents = np.arange(n)
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for source, target in zip(sources[mutual].tolist(), targets[mutual].tolist()):
+            root_source, root_target = find(source), find(target)
+            if root_source != root_target:
+                parents[max(root_source, root_target)] = min(root_source, root_target)
+        roots = np.array([find(i) for i in range(n)])
+        unique_roots, inverse, counts = np.unique(roots, return_inverse=True, return_counts=True)
+        group_order = np.argsort(-counts, kind='stable')
+        group_numbers = np.full(len(unique_roots), -1, np.int64)
+        large = counts[group_order] >= min_size
+        group_numbers[group_order[large]] = np.arange(large.sum())
+        labels = group_numbers[inverse]
+        structured_log('Grouped {} faces into {} groups of at least {}, {} faces left over'.format(
+            n, int(large.sum()), min_size, int((labels < 0).sum())))
+        return labels
+
+    def name_groups(self, labels, examples):
+        '''
+        Names groups by an example face of each person, which replaces collecting the faces into an album by hand
+        Args:
+            labels: array from cluster()
+            examples: dict of name to the file name of a face of that person, or a list of file names
+        returns:
+            dict of name to the file names of the faces in the groups of its examples
+        '''
+        named = {}
+        for name, file_names in examples.items():
+            if isinstance(file_names, str):
+                file_names = [file_names]
+            groups = {labels[self.rows[file_name]] for file_name in file_names} - {-1}
+            if not groups:
+                structured_log('The examples of {} are in no group'.format(name), severity=LogSeverity.WARNING)
+            rows = np.flatnonzero(np.isin(labels, list(groups)))
+            named[name] = sorted(set(self.file_names[rows].tolist()) | set(file_names))
+        return named
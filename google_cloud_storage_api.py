@@ -1,35 +1,180 @@
-from google.cloud import storage
-from google.api_core.exceptions import BadRequest
-import requests
+import time
+import client_registry
+from google.api_core.exceptions import BadRequest, NotFound, PreconditionFailed
+from google.resumable_media import DataCorruption, InvalidResponse
+from google.resumable_media.requests import ResumableUpload
+from requests.exceptions import ConnectionError, ChunkedEncodingError
+import http_transport
+import pipeline_metrics
 from retrying import retry
+from google_logging import structured_log, LogSeverity
+
+# resumable upload chunks must be a multiple of 256 KiB
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_STREAM_RECOVERIES = 5
+# chunks of files read with open_file
+READ_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeout of streamed downloads, so that a stalled connection is resumed instead of hanging
+DOWNLOAD_TIMEOUT = (10, 60)
 
 def retry_if_bad_request(exception):
     return isinstance(exception, BadRequest)
 
 
+class HttpSourceStream:
+    '''
+    Read-only file object over a streamed HTTP download, used as the source of a resumable upload.
+    Only the most recently read chunk is kept in memory so the upload can seek back after a failed chunk,
+    and the download is continued with a Range request if the connection drops half way.
+    '''
+
+    def __init__(self, url, chunk_size=STREAM_CHUNK_SIZE, on_chunk=None):
+        '''
+        Args:
+            url: string, url to download from
+            chunk_size: int, size of the network reads
+            on_chunk: callable, if not None, called with every newly downloaded chunk of bytes
+        '''
+        self.url = url
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.position = 0
+        self.downloaded = 0
+        self.buffer = b''
+        self.buffer_start = 0
+        self.iterator = None
+        self.eof = False
+        self.reconnects = 0
+
+    def _open(self):
+        headers = {'Range': f'bytes={self.downloaded}-'} if self.downloaded else {}
+        response = http_transport.get(self.url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        self.iterator = response.iter_content(self.chunk_size)
+        if self.downloaded and response.status_code != 206:
+            # the server ignored the range, skip what we already have
+            skip = self.downloaded
+            while skip > 0:
+                chunk = next(self.iterator, b'')
+                if not chunk:
+                    raise ConnectionError(f'{self.url} is shorter than the {self.downloaded} bytes read before')
+                if len(chunk) > skip:
+                    self.iterator = _prepend(chunk[skip:], self.iterator)
+                skip -= len(chunk)
+
+    def _download_more(self):
+        if self.iterator is None:
+            self._open()
+        start = time.monotonic()
+        try:
+            chunk = next(self.iterator, b'')
+        except (ConnectionError, ChunkedEncodingError):
+            pipeline_metrics.record('download', time.monotonic() - start, retries=1)
+            self.reconnects += 1
+            if self.reconnects > MAX_STREAM_RECOVERIES:
+                raise
+            structured_log(f'Download of {self.url} interrupted at byte {self.downloaded}, resuming', severity=LogSeverity.WARNING)
+            self.iterator = None
+            return
+        pipeline_metrics.record('download', time.monotonic() - start, items=int(not chunk), bytes=len(chunk))
+        if not chunk:
+            self.eof = True
+            return
+        self.buffer += chunk
+        self.downloaded += len(chunk)
+        if self.on_chunk is not None:
+            self.on_chunk(chunk)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self.downloaded < self.position + size):
+            self._download_more()
+        start = self.position - self.buffer_start
+        data = self.buffer[start:] if size < 0 else self.buffer[start:start + size]
+        self.position += len(data)
+        # the upload never seeks back further than the start of the last chunk it read
+        self.buffer = self.buffer[start:]
+        self.buffer_start += start
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        if whence != 0 or position < self.buffer_start or position > self.downloaded:
+            raise ValueError(f'cannot seek to {position}, only bytes {self.buffer_start}-{self.downloaded} are buffered')
+        self.position = position
+        return position
+
+
+def _prepend(chunk, iterator):
+    yield chunk
+    yield from iterator
+
+
 class GoogleStorageHelper:
 
     @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
     def __init__(self, bucket_name) -> None:
-        self.client = storage.Client()
+        self.client = client_registry.get_storage_client()
         self.bucket = self.client.bucket(bucket_name)
         pass
 
-    @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
     def upload_url_to_google_cloud(self, url, target_file_name, content_type):
         '''
         Uploads a file from a given url to a bucket
         '''
-        blob = self.bucket.blob(target_file_name)
-        blob.upload_from_string(requests.get(url).content, content_type=content_type)
+        self.stream_url_to_google_cloud(url, target_file_name, content_type)
+
+    def stream_url_to_google_cloud(self, url, target_file_name, content_type, chunk_size=STREAM_CHUNK_SIZE, on_chunk=None):
+        '''
+        Streams a file from a given url into a bucket with a resumable upload, so that at most a few chunks
+        are held in memory. The CRC32C of the streamed bytes is computed on the fly and checked against the
+        one GCS reports for the finished object.
+        Args:
+            url: string, url to download from
+            target_file_name: string, name of the object in the bucket
+            content_type: string, content type of the object
+            chunk_size: int, size of the upload chunks, a multiple of 256 KiB
+            on_chunk: callable, if not None, called with every downloaded chunk, e.g. to keep a copy of the bytes
+        returns:
+            total number of bytes uploaded
+        '''
+        upload_url = f'https://storage.googleapis.com/upload/storage/v1/b/{self.bucket.name}/o?uploadType=resumable'
+        # the authorized session of the storage client
+        transport = self.client._http
+        stream = HttpSourceStream(url, chunk_size=chunk_size, on_chunk=on_chunk)
+        upload = ResumableUpload(upload_url, chunk_size, checksum='crc32c')
+        # the span includes the streamed download, whose share is recorded to the download stage as well
+        with pipeline_metrics.span('gcs_upload', items=1) as span:
+            upload.initiate(transport, stream, {'name': target_file_name}, content_type, stream_final=False)
+            recoveries = 0
+            while not upload.finished:
+                try:
+                    upload.transmit_next_chunk(transport)
+                except DataCorruption:
+                    self.bucket.blob(target_file_name).delete()
+                    raise
+                except (InvalidResponse, ConnectionError) as e:
+                    recoveries += 1
+                    pipeline_metrics.add_retry()
+                    if recoveries > MAX_STREAM_RECOVERIES:
+                        raise
+                    structured_log(f'Upload of {target_file_name} interrupted ({e}), resuming at byte {upload.bytes_uploaded}', severity=LogSeverity.WARNING)
+                    upload.recover(transport)
+            span.add(bytes=upload.bytes_uploaded)
+        return upload.bytes_uploaded
 
     @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
-    def upload_string_content_to_google_cloud(self, content, target_file_name, content_type):
+    def upload_string_content_to_google_cloud(self, content, target_file_name, content_type, if_generation_match=None):
         '''
-        Uploads a file from a given url to a bucket
+        Uploads bytes or a string to a bucket, checked against the CRC32C GCS computes for the object
+        Args:
+            if_generation_match: int, if not None, the upload fails with PreconditionFailed unless the object
+                still has this generation, 0 meaning that it must not exist yet
         '''
         blob = self.bucket.blob(target_file_name)
-        blob.upload_from_string(content, content_type=content_type)
+        with pipeline_metrics.span('gcs_upload', items=1, bytes=len(content)):
+            blob.upload_from_string(content, content_type=content_type, checksum='crc32c', if_generation_match=if_generation_match)
     
     @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
     def read_file_from_google_cloud_to_string(self, file_name):
@@ -39,11 +184,58 @@ class GoogleStorageHelper:
         blob = self.bucket.blob(file_name)
         return blob.download_as_text()
     
+    @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
+    def read_file_from_google_cloud_with_generation(self, file_name):
+        '''
+        Reads a file from a bucket together with the generation it was read at, to write it back with if_generation_match
+        returns: (content string, generation), (None, 0) if the file does not exist
+        '''
+        blob = self.bucket.get_blob(file_name)
+        if blob is None:
+            return None, 0
+        try:
+            return blob.download_as_text(if_generation_match=blob.generation), blob.generation
+        except (NotFound, PreconditionFailed):
+            # replaced or deleted since, read it again
+            return self.read_file_from_google_cloud_with_generation(file_name)
+
     @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
     def read_file_from_google_cloud_to_bytes(self, file_name):
         '''
         Reads a file from a bucket to bytes
         '''
         blob = self.bucket.blob(file_name)
-        return blob.download_as_bytes()
-    
\ No newline at end of file
+        with pipeline_metrics.span('download') as span:
+            content = blob.download_as_bytes()
+            span.add(items=1, bytes=len(content))
+        return content
+    
+    def open_file(self, file_name, chunk_size=READ_CHUNK_SIZE):
+        '''
+        Opens a file of the bucket for streamed reading, only chunk_size bytes are held in memory at a time
+        returns: a binary file object, close it when done
+        '''
+        return self.bucket.blob(file_name).open('rb', chunk_size=chunk_size)
+
+    @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
+    def list_file_names(self, prefix):
+        '''
+        Lists the names of all files in the bucket starting with a prefix
+        '''
+        return [blob.name for blob in self.client.list_blobs(self.bucket, prefix=prefix)]
+
+    @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
+    def file_exists(self, file_name):
+        '''
+        Checks if a file exists in the bucket
+        '''
+        return self.bucket.blob(file_name).exists()
+
+    @retry(retry_on_exception=retry_if_bad_request, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
+    def delete_file(self, file_name):
+        '''
+        Deletes a file from the bucket if it exists
+        '''
+        blob = self.bucket.blob(file_name)
+        if blob.exists():
+            blob.delete()
@@ -1,6 +1,17 @@
+import atexit
 import json
+import os
+import queue
+import sys
+import threading
 from enum import Enum
 
+# entries are handed to a background thread that writes them in batches, so logging never waits on stdout
+LOG_BUFFERED = os.environ.get('LOG_BUFFERED', '1') == '1'
+# when this many entries are waiting, callers write themselves instead of queueing more
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', 10000))
+LOG_BATCH_SIZE = 500
+
 class LogSeverity(str, Enum):
     DEFAULT = 'DEFAULT'
     DEBUG = 'DEBUG'
@@ -13,12 +24,97 @@ class LogSeverity(str, Enum):
     EMERGENCY = 'EMERGENCY'
 
 
+class BufferedLogWriter:
+    '''
+    Writes log lines to stdout from a daemon thread, several lines per write.
+    Lines are never dropped: if the buffer is full, the caller writes its line directly.
+    '''
+
+    def __init__(self, max_entries=LOG_BUFFER_SIZE):
+        self.queue = queue.Queue(maxsize=max_entries)
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            _write_lines([line])
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            while len(lines) < LOG_BATCH_SIZE:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                _write_lines(lines)
+            finally:
+                for _ in lines:
+                    self.queue.task_done()
+
+    def flush(self):
+        '''
+        Blocks until every queued line is written
+        '''
+        self.queue.join()
+
+
+def _write_lines(lines):
+    # stdout is looked up on every write, it may have been replaced, e.g. by a test runner
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BufferedLogWriter()
+    return _writer
+
+
 def structured_log(
         message: str, 
-        severity: LogSeverity = LogSeverity.NOTICE
+        severity: LogSeverity = LogSeverity.NOTICE,
+        **fields
     ):
-    entry = dict(severity=severity, message=message)
-    print(json.dumps(entry))
+    '''
+    Logs a json entry that Cloud Logging parses into severity, message and jsonPayload
+    fields: additional json serializable fields of the entry, e.g. durations or counts
+    '''
+    entry = dict(severity=severity, message=message, **fields)
+    line = json.dumps(entry)
+    if LOG_BUFFERED:
+        _get_writer().write(line)
+    else:
+        _write_lines([line])
+
+
+def flush_logs():
+    '''
+    Writes out all buffered entries, call it before the function returns since the instance may be frozen afterwards
+    '''
+    if _writer is not None:
+        _writer.flush()
+
+
+def _reset_after_fork():
+    global _writer, _writer_lock
+    # the writer thread does not survive a fork, lines still queued are written by the parent
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+atexit.register(flush_logs)
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 if __name__ == '__main__':
-    structured_log('hello world')
\ No newline at end of file
+    structured_log('hello world')
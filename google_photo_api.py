@@ -1,25 +1,31 @@
 import pickle
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-import requests
-from requests.exceptions import ConnectionError
+import http_transport
+import pipeline_metrics
 import json
 from google_cloud_storage_api import GoogleStorageHelper
+from blob_store import SpillBlobStore
+from album_download import AlbumDownloader, DOWNLOAD_WORKERS
+import content_cache
+from content_cache import MediaUrl
+from processing_manifest import STAGE_SEEN, STAGE_COPIED, STAGE_FACES_UPLOADED
 import google_crc32c
-from google.cloud import secretmanager
+import client_registry
 from google.api_core.exceptions import NotFound
 from google_logging import structured_log, LogSeverity
-from retrying import retry
-from PIL import Image, UnidentifiedImageError
-from io import BytesIO
-import os
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import HTTPError
+import threading
 
 CLIENT_SECRET_FILE = "secrets/google_photo_credentials.json"
 CREDENTIAL_PICKLE_FILE_SECRET_SOURCE = "projects/1083696682843/secrets/google-photo-api-credential-pickle/versions/2"
+# mediaItems:batchCreate accepts at most 50 items per call
+MAX_BATCH_CREATE_SIZE = 50
 
 def get_api_credential_from_google_secret():
     # loads of setup to do, see: https://cloud.google.com/secret-manager/docs/creating-and-accessing-secrets
-    client = secretmanager.SecretManagerServiceClient()
+    client = client_registry.get_secret_manager_client()
     # remember to upload your own pickle file to google secret manager!!
     response = client.access_secret_version(request={"name": CREDENTIAL_PICKLE_FILE_SECRET_SOURCE})
     crc32c = google_crc32c.Checksum()
@@ -28,22 +34,77 @@ def get_api_credential_from_google_secret():
         raise Exception("Secret data corruption detected.")
     return response.payload.data
 
-def retry_if_connection_error(exception):
-    return isinstance(exception, ConnectionError)
-
-@retry(retry_on_exception=retry_if_connection_error, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
 def safe_retryable_requests(*args, **kwargs):
-    return requests.request(*args, **kwargs)
-
-@retry(retry_on_exception=retry_if_connection_error, wait_fixed=500, stop_max_attempt_number=3, wrap_exception=True)
-def save_image_from_url_helper(url, file_path):
-    try:
-        image = Image.open(BytesIO(requests.get(url).content))
-        # save original image exif data
-        image.save(file_path, exif=image.info.get('exif'))
-    except UnidentifiedImageError:
-        print(f'UnidentifiedImageError: {url}')
-        pass
+    # pooled, rate limited and retried on connection errors, 429 and 5xx, see http_transport
+    return http_transport.request(*args, **kwargs)
+
+def _download(url):
+    with pipeline_metrics.span('download') as span:
+        content = http_transport.get(url).content
+        span.add(items=1, bytes=len(content))
+    return content
+
+def download_media_bytes(url):
+    '''
+    Downloads a media item, or any other url, as a whole. A MediaUrl is read through the content cache.
+    '''
+    return content_cache.read_through(url, _download)
+
+def stream_media_to_bucket(storage_api, url, target_file_name, content_type):
+    '''
+    Streams a photo into the bucket, or uploads its bytes from the content cache if they are there
+    returns: the bytes of the photo
+    '''
+    content = content_cache.cached_content(url)
+    if content is not None:
+        storage_api.upload_string_content_to_google_cloud(content, target_file_name, content_type)
+        return content
+    # keep a copy of the photo for cropping while it is streamed to the bucket
+    chunks = []
+    storage_api.stream_url_to_google_cloud(url, target_file_name, content_type, on_chunk=chunks.append)
+    content = b''.join(chunks)
+    key = content_cache.cache_key(url)
+    if key is not None:
+        content_cache.get_content_cache().put(key, content)
+    return content
+
+def annotation_derivative_scale(item, max_size):
+    '''
+    Photos scales a =w{max_size}-h{max_size} variant to fit into the box keeping the aspect ratio, and never enlarges it
+    returns: the factor from pixels of that variant to pixels of the original
+    '''
+    width = int(item['mediaMetadata']['width'])
+    height = int(item['mediaMetadata']['height'])
+    return max(1.0, width / max_size, height / max_size)
+
+def day_search_payload(year, month, day, media_types):
+    '''
+    returns: the body of a mediaItems:search request for the media items created on a given day
+    '''
+    return {
+        "filters": {
+            "dateFilter": {
+                "dates": [
+                    {
+                    "day": day,
+                    "month": month,
+                    "year": year
+                    }
+                    
+                ]
+            },
+            "mediaTypeFilter": {
+                "mediaTypes": media_types
+            }
+            # TODO people filter does not work very well
+            # "contentFilter": {
+            #     "includedContentCategories": [
+            #         "PEOPLE"
+            #     ]
+            # }
+        },
+        "pageSize": 100
+    }
 
 class GooglePhotoHelper:
     '''
@@ -58,12 +119,14 @@ class GooglePhotoHelper:
                  scopes = [
                     'https://www.googleapis.com/auth/photoslibrary.appendonly',
                     'https://www.googleapis.com/auth/photoslibrary.readonly',
-                ]):
+                ],
+                 cred=None):
         '''
         Args:
             api_version: string, the version of the service
             api_name: string, name of the api e.g."docs","photoslibrary",...
             api_version: version of the api
+            cred: credentials to reuse, e.g. handed over to a worker process, loaded from the secret if None
         '''
 
         self.api_name = api_name
@@ -71,33 +134,41 @@ class GooglePhotoHelper:
         self.scopes = scopes
         self.cred_pickle_file = f'token_{self.api_name}_{self.api_version}.pickle'
 
-        self.cred = None
-        self.run_local_server()
+        if cred is None:
+            self.run_local_server()
+        else:
+            # handed over credentials are kept fresh by the client registry as well
+            self.cred = client_registry.get_credentials(self.cred_pickle_file, lambda: cred)
 
     def run_local_server(self):
+        # credentials are loaded once per process and kept fresh by the client registry
+        self.cred = client_registry.get_credentials(self.cred_pickle_file, self.load_credentials)
+        return self.cred
+
+    def load_credentials(self):
         # checking if there is already a pickle file with relevant credentials
         try:
-            self.cred = pickle.loads(get_api_credential_from_google_secret())
+            cred = pickle.loads(get_api_credential_from_google_secret())
         except NotFound:
-            self.cred = None
+            cred = None
             structured_log("!!! Make sure this is run locally first to create the pickle file, then upload it as a secret !!!", severity=LogSeverity.WARNING)
             structured_log('************ upload the generated pickle file to your google secret and update the secret source id in CREDENTIAL_PICKLE_FILE_SECRET_SOURCE ************', severity=LogSeverity.WARNING)
 
         # if there is no pickle file with stored credentials, create one using google_auth_oauthlib.flow
-        if not self.cred or not self.cred.valid:
-            if self.cred and self.cred.expired and self.cred.refresh_token:
+        if not cred or not cred.valid:
+            if cred and cred.expired and cred.refresh_token:
                 structured_log("=== Refreshing token ===")
-                self.cred.refresh(Request())
+                cred.refresh(Request())
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, self.scopes)
-                self.cred = flow.run_local_server()
+                cred = flow.run_local_server()
 
             with open(self.cred_pickle_file, 'wb') as token:
-                pickle.dump(self.cred, token)
+                pickle.dump(cred, token)
         
-        return self.cred
+        return cred
 
-    def upload_from_google_photo_to_bucket(self, year, month, day, bucket_name, upload_photo=True, upload_video=False, dry_run=False, exclude_file_prefix=None):
+    def upload_from_google_photo_to_bucket(self, year, month, day, bucket_name, upload_photo=True, upload_video=False, dry_run=False, exclude_file_prefix=None, blob_store=None, manifest=None, annotation_max_size=0, annotation_scales=None, dedup_index=None):
         '''
         Uploads all photos from a given day to a bucket
         Args:
@@ -107,67 +178,222 @@ class GooglePhotoHelper:
             bucket_name: string, name of the bucket
             dry_run: boolean, if True, only prints the files that would be uploaded without actually uploading them
             exclude_file_prefix: string, if not None, files with this prefix will not be uploaded
+            blob_store: mapping that receives the downloaded originals, a new SpillBlobStore if None
+            manifest: ProcessingManifest, if not None, finished items are skipped and copied items are recorded
+            annotation_max_size: int, if not 0, photos are copied to the bucket as a derivative that fits into
+                annotation_max_size x annotation_max_size instead of the original, which is only kept for cropping
+            annotation_scales: dict, if not None, receives file name -> factor from derivative to original pixels
+            dedup_index: ContentDedupIndex, if not None, photos annotated before under another name or day are not uploaded,
+                they are recorded in dedup_index.hits instead
         returns:
-            A dictionary with file names as keys and file content as values
+            The blob store with file names as keys and file content as values, close it when done
         '''
         media_type_list = []
         if upload_photo:
             media_type_list.append('PHOTO')
         if upload_video:
             media_type_list.append('VIDEO')
+        items = self.search_media_items_by_day(year, month, day, media_type_list, prefetch=True)
+        return self.upload_media_items_to_bucket(items, bucket_name, dry_run=dry_run, exclude_file_prefix=exclude_file_prefix, blob_store=blob_store, manifest=manifest, annotation_max_size=annotation_max_size, annotation_scales=annotation_scales, dedup_index=dedup_index)
+
+    def upload_media_items_to_bucket(self, items, bucket_name, dry_run=False, exclude_file_prefix=None, blob_store=None, manifest=None, annotation_max_size=0, annotation_scales=None, dedup_index=None):
+        '''
+        Uploads the given media items to a bucket
+        Args:
+            items: iterable of media item dicts, e.g. from search_media_items_by_day
+            see upload_from_google_photo_to_bucket for the other args
+        returns:
+            The blob store with file names as keys and file content as values, close it when done
+        '''
+        file_name_dict = blob_store if blob_store is not None else SpillBlobStore()
+        storage_api = GoogleStorageHelper(bucket_name)
+        i = -1
+        for i, item in enumerate(items):
+            self.copy_media_item(item, storage_api, file_name_dict, dry_run=dry_run, exclude_file_prefix=exclude_file_prefix, manifest=manifest, annotation_max_size=annotation_max_size, annotation_scales=annotation_scales, dedup_index=dedup_index)
+        if i < 0:
+            structured_log("No media items found")
+        return file_name_dict
+
+    def copy_media_item(self, item, storage_api, file_name_dict, dry_run=False, exclude_file_prefix=None, manifest=None, annotation_max_size=0, annotation_scales=None, dedup_index=None):
+        '''
+        Uploads a single media item to a bucket, see upload_media_items_to_bucket.
+        Safe to call from several threads at once with the same manifest, blob store and dedup index.
+        Args:
+            item: media item dict
+            storage_api: GoogleStorageHelper of the bucket
+            file_name_dict: mapping that receives the bytes of photos that still need their faces
+            see upload_from_google_photo_to_bucket for the other args
+        returns:
+            True if the bytes of the photo were added to file_name_dict, False if the item was skipped
+        '''
+        if exclude_file_prefix is not None and item['filename'].startswith(exclude_file_prefix):
+            return False
+        is_photo = 'photo' in item['mediaMetadata']
+        # videos are done once copied, photos once their faces are uploaded
+        if manifest is not None and manifest.reached(item['id'], STAGE_FACES_UPLOADED if is_photo else STAGE_COPIED):
+            return False
+        base_url = MediaUrl(item, 'd' if is_photo else 'dv')
+        structured_log(f"==== Uploading photo {item['filename']} ====")
+        use_derivative = is_photo and annotation_max_size > 0
+        if dry_run:
+            return False
+        # preserving the original file name when uploading.
+        target_file_name = item['filename']
+        if manifest is not None and manifest.reached(item['id'], STAGE_COPIED):
+            # already in the bucket, only the bytes are needed for cropping. What the bucket holds was recorded
+            # when it was copied, ANNOTATION_INPUT_MAX_SIZE may have changed since
+            annotation_scale = manifest.annotation_scale(
+                item['id'], default=annotation_derivative_scale(item, annotation_max_size) if use_derivative else None)
+            if annotation_scales is not None and annotation_scale is not None:
+                annotation_scales[target_file_name] = annotation_scale
+            if annotation_scale is not None:
+                file_name_dict[target_file_name] = download_media_bytes(base_url)
+            else:
+                # the original may still be in the content cache from the run that copied it
+                content = content_cache.cached_content(base_url)
+                file_name_dict[target_file_name] = content if content is not None else storage_api.read_file_from_google_cloud_to_bytes(target_file_name)
+            return True
+        if is_photo and (use_derivative or dedup_index is not None):
+            # the original is needed before deciding what goes to the bucket
+            file_content = download_media_bytes(base_url)
+            file_name_dict[target_file_name] = file_content
+            if dedup_index is not None and dedup_index.lookup(target_file_name, file_content) is not None:
+                # annotated before, the stored annotation is in original coordinates or carries its own scale
+                if manifest is not None:
+                    # nothing is in the bucket, so the item is only remembered, not marked as copied
+                    manifest.mark(item['id'], target_file_name, STAGE_SEEN)
+                return True
+            if use_derivative:
+                annotation_scale = annotation_derivative_scale(item, annotation_max_size)
+                if annotation_scales is not None:
+                    annotation_scales[target_file_name] = annotation_scale
+                # vision only needs a bounded resolution copy, the original never goes to the bucket
+                derivative_url = MediaUrl(item, f'w{annotation_max_size}-h{annotation_max_size}')
+                stream_media_to_bucket(storage_api, derivative_url, target_file_name, 'image/jpeg')
+            else:
+                # the photo is in memory for cropping anyway, the upload of its bytes is CRC32C checked like a streamed one
+                storage_api.upload_string_content_to_google_cloud(file_content, target_file_name, item['mimeType'])
+        elif is_photo:
+            file_name_dict[target_file_name] = stream_media_to_bucket(storage_api, base_url, target_file_name, item['mimeType'])
+        else:
+            # videos are only backed up, they never sit in memory as a whole, nor in the content cache
+            storage_api.stream_url_to_google_cloud(base_url, target_file_name, item['mimeType'])
+        if manifest is not None:
+            manifest.mark(item['id'], target_file_name, STAGE_COPIED, annotation_scale=annotation_scale if use_derivative else None)
+        return is_photo
+
+    def iter_media_items(self, payload, prefetch=False):
+        '''
+        Iterates over all media items matching a search, following nextPageToken until the last page
+        see https://developers.google.com/photos/library/guides/list#pagination
+        Args:
+            payload: dict, body of the mediaItems:search request, e.g. with "filters" or "albumId"
+            prefetch: boolean, if True, the next page is requested in the background while the current one is being consumed
+        yields:
+            media item dicts, one at a time
+        '''
+        def fetch_page(page_token):
+            return self.fetch_media_items_page(payload, page_token)
+
+        if not prefetch:
+            page_token = None
+            while True:
+                page = fetch_page(page_token)
+                yield from page.get('mediaItems', [])
+                page_token = page.get('nextPageToken')
+                if page_token is None:
+                    return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(fetch_page, None)
+            while next_page is not None:
+                page = next_page.result()
+                page_token = page.get('nextPageToken')
+                next_page = executor.submit(fetch_page, page_token) if page_token is not None else None
+                yield from page.get('mediaItems', [])
+
+    def fetch_media_items_page(self, payload, page_token=None):
+        '''
+        Requests a single page of a mediaItems:search
+        Args:
+            payload: dict, body of the search request, see iter_media_items
+            page_token: string, nextPageToken of the previous page, None for the first page
+        returns:
+            the response dict with mediaItems and nextPageToken, both missing if there is nothing (more)
+        '''
         url = 'https://photoslibrary.googleapis.com/v1/mediaItems:search'
+        page_payload = dict(payload)
+        page_payload.setdefault('pageSize', 100)
+        if page_token is not None:
+            page_payload['pageToken'] = page_token
+        headers = {
+            'content-type': 'application/json',
+            'Authorization': 'Bearer {}'.format(self.cred.token)
+        }
+        with pipeline_metrics.span('list') as span:
+            page = safe_retryable_requests("POST", url, data=json.dumps(page_payload), headers=headers).json()
+            span.add(items=len(page.get('mediaItems', [])))
+        return page
+
+    def iter_media_item_pages(self, payload, page_token=None):
+        '''
+        Iterates over the pages of a search, so that a caller can remember where it stopped and resume there
+        Args:
+            payload: dict, body of the search request, see iter_media_items
+            page_token: string, token of the page to start at, None for the first page
+        yields:
+            tuples (page_token, list of media item dicts), page_token being the token that requests this page again
+        '''
+        while True:
+            page = self.fetch_media_items_page(payload, page_token)
+            yield page_token, page.get('mediaItems', [])
+            page_token = page.get('nextPageToken')
+            if page_token is None:
+                return
+
+    def search_media_items_by_day(self, year, month, day, media_types, prefetch=False):
+        '''
+        Iterates over all media items created on a given day
+        Args:
+            year: int, year of the day
+            month: int, month of the day
+            day: int, date of the day
+            media_types: list of strings, e.g. ['PHOTO', 'VIDEO']
+            prefetch: boolean, see iter_media_items
+        yields:
+            media item dicts, one at a time
+        '''
+        payload = day_search_payload(year, month, day, media_types)
+        return self.iter_media_items(payload, prefetch=prefetch)
+
+    def search_media_items_by_date_range(self, start_date, end_date, media_types, prefetch=False):
+        '''
+        Iterates over all media items created between two dates, both inclusive
+        Args:
+            start_date: datetime.date, first day of the range
+            end_date: datetime.date, last day of the range
+            media_types: list of strings, e.g. ['PHOTO', 'VIDEO']
+            prefetch: boolean, see iter_media_items
+        yields:
+            media item dicts, one at a time
+        '''
         payload = {
             "filters": {
                 "dateFilter": {
-                    "dates": [
+                    "ranges": [
                         {
-                        "day": day,
-                        "month": month,
-                        "year": year
+                            "startDate": {"day": start_date.day, "month": start_date.month, "year": start_date.year},
+                            "endDate": {"day": end_date.day, "month": end_date.month, "year": end_date.year},
                         }
-                        
                     ]
                 },
                 "mediaTypeFilter": {
-                    "mediaTypes": media_type_list
+                    "mediaTypes": media_types
                 }
-                # TODO people filter does not work very well
-                # "contentFilter": {
-                #     "includedContentCategories": [
-                #         "PEOPLE"
-                #     ]
-                # }
             },
-            #TODO: add pagination according to https://developers.google.com/photos/library/guides/list#pagination
             "pageSize": 100
         }
-        headers = {
-            'content-type': 'application/json',
-            'Authorization': 'Bearer {}'.format(self.cred.token)
-        }
-        
-        res = safe_retryable_requests("POST", url, data=json.dumps(payload), headers=headers)
-        if 'mediaItems' not in res.json():
-            structured_log("No media items found")
-            return []
-        file_name_dict = {}
-        storage_api = GoogleStorageHelper(bucket_name)
-        for i, item in enumerate(res.json()['mediaItems']):
-            if exclude_file_prefix is not None and item['filename'].startswith(exclude_file_prefix):
-                continue
-            base_url = item['baseUrl']
-            if 'photo' in item['mediaMetadata']:
-                base_url += '=d'
-            else:
-                base_url += '=dv'
-            structured_log(f"==== Uploading photo {i}: {item['filename']} ====")
-            if not dry_run:
-                # preserving the original file name when uploading.
-                target_file_name = item['filename']
-                file_content = requests.get(base_url).content
-                storage_api.upload_string_content_to_google_cloud(file_content, target_file_name, item['mimeType'])
-                file_name_dict[target_file_name] = file_content
-        return file_name_dict
+        return self.iter_media_items(payload, prefetch=prefetch)
 
     def upload_image_to_photo_album(self, image_bytes, file_name, album_id):
         '''
@@ -176,14 +402,38 @@ class GooglePhotoHelper:
             image_bytes: bytes, image data to be uploaded
             album_id: string, id of the album to which the image will be uploaded
         '''
+        upload_token = self.upload_bytes(image_bytes)
+        self.batch_create_media_items(album_id, [(upload_token, file_name)])
+
+    def upload_bytes(self, image_bytes):
+        '''
+        Uploads raw bytes to Google Photo, the bytes only become a media item after batch_create_media_items
+        Args:
+            image_bytes: bytes, image data to be uploaded
+        returns:
+            the upload token as a string
+        '''
         url = 'https://photoslibrary.googleapis.com/v1/uploads'
         headers = {
             'content-type': 'application/octet-stream',
+            'X-Goog-Upload-Protocol': 'raw',
             'Authorization': 'Bearer {}'.format(self.cred.token)
         }
-        res = safe_retryable_requests("POST", url, data=image_bytes, headers=headers)
+        with pipeline_metrics.span('photos_upload', items=1, bytes=len(image_bytes)):
+            res = safe_retryable_requests("POST", url, data=image_bytes, headers=headers)
+            res.raise_for_status()
         # get the upload token as a string
-        upload_token = res.content.decode('utf-8')
+        return res.content.decode('utf-8')
+
+    def batch_create_media_items(self, album_id, token_file_name_list):
+        '''
+        Creates media items in an album from previously uploaded bytes
+        Args:
+            album_id: string, id of the album to which the media items will be added
+            token_file_name_list: list of tuples (upload_token, file_name), at most MAX_BATCH_CREATE_SIZE items
+        returns:
+            list of newMediaItemResults, one per upload token, each with its own status
+        '''
         url = 'https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate'
         payload = {
             "albumId": album_id,
@@ -194,14 +444,17 @@ class GooglePhotoHelper:
                         "fileName": file_name,
                         "uploadToken": upload_token
                     }
-                }
+                } for upload_token, file_name in token_file_name_list
             ]
         }
         headers = {
             'content-type': 'application/json',
             'Authorization': 'Bearer {}'.format(self.cred.token)
         }
-        safe_retryable_requests("POST", url, data=json.dumps(payload), headers=headers)
+        with pipeline_metrics.span('photos_upload'):
+            res = safe_retryable_requests("POST", url, data=json.dumps(payload), headers=headers)
+            res.raise_for_status()
+            return res.json().get('newMediaItemResults', [])
 
     def create_new_album(self, album_name):
         '''
@@ -221,83 +474,259 @@ class GooglePhotoHelper:
         }
         res = safe_retryable_requests("POST", url, data=json.dumps(payload), headers=headers)
         return res.json()['id']
-    
-    def find_albums_by_name(self, album_name):
+
+    def album_exists(self, album_id):
         '''
-        Finds all albums with a given name
-        Args:
-            album_name: string, name of the album
+        Whether an album is still in the library, e.g. after batchCreate rejected its id
         '''
-        url = 'https://photoslibrary.googleapis.com/v1/albums'
+        url = 'https://photoslibrary.googleapis.com/v1/albums/{}'.format(album_id)
         headers = {
             'content-type': 'application/json',
             'Authorization': 'Bearer {}'.format(self.cred.token)
         }
         res = safe_retryable_requests("GET", url, headers=headers)
-        albums = res.json()['albums']
-        return [album for album in albums if album['title'] == album_name]
+        if res.status_code in (400, 404):
+            return False
+        res.raise_for_status()
+        return True
+    
+    def iter_albums(self):
+        '''
+        Iterates over all albums of the library, following nextPageToken until the last page
+        yields:
+            album dicts, one at a time
+        '''
+        url = 'https://photoslibrary.googleapis.com/v1/albums'
+        params = {'pageSize': 50}
+        while True:
+            headers = {
+                'content-type': 'application/json',
+                'Authorization': 'Bearer {}'.format(self.cred.token)
+            }
+            with pipeline_metrics.span('list') as span:
+                page = safe_retryable_requests("GET", url, headers=headers, params=params).json()
+                span.add(items=len(page.get('albums', [])))
+            yield from page.get('albums', [])
+            if 'nextPageToken' not in page:
+                return
+            params['pageToken'] = page['nextPageToken']
+
+    def find_albums_by_name(self, album_name, catalog=None):
+        '''
+        Finds all albums with a given name
+        Args:
+            album_name: string, name of the album
+            catalog: PhotoCatalog, if not None, the albums are looked up there instead of listing them from the api
+        '''
+        if catalog is not None:
+            return catalog.find_albums_by_name(album_name)
+        return [album for album in self.iter_albums() if album['title'] == album_name]
 
-    def upsert_album(self, album_name):
+    def upsert_album(self, album_name, catalog=None):
         '''
         Creates a new album if it does not exist, otherwise returns the existing album
         Args:
             album_name: string, name of the album
+            catalog: PhotoCatalog, if not None, the album is looked up there and a new album is added to it
         '''
-        albums = self.find_albums_by_name(album_name)
+        albums = self.find_albums_by_name(album_name, catalog)
+        if len(albums) == 0 and catalog is not None:
+            # the album may have been created since the last sync
+            catalog.sync_albums(self)
+            albums = catalog.find_albums_by_name(album_name)
         if len(albums) == 0:
             album_id = self.create_new_album(album_name)
+            if catalog is not None:
+                catalog.upsert_albums([{'id': album_id, 'title': album_name}])
         elif len(albums) == 1:
             album_id = albums[0]['id']
         else:
             raise Exception('More than one album found, please delete all albums with the name of {}'.format(album_name))
         return album_id
 
-    def list_face_download_urls_from_album(self, album_id, size=100, download=False, download_dir=None):
+    def iter_face_download_urls_from_album(self, album_id, prefetch=True):
+        '''
+        Iterates over the face images in an album without holding the whole album in memory
+        Args:
+            album_id: string, id of the album
+            prefetch: boolean, see iter_media_items
+        yields:
+            tuples (file_name, download_url), the url is a MediaUrl, so downloads read through the content cache
+        '''
+        for item in self.iter_media_items({"albumId": album_id, "pageSize": 100}, prefetch=prefetch):
+            if item['filename'].startswith('auto_detected_face_image_'):
+                yield item['filename'], MediaUrl(item, 'd')
+
+    def list_face_download_urls_from_album(self, album_id, size=100, download=False, download_dir=None, workers=DOWNLOAD_WORKERS):
         '''
         Lists all the base urls of the face images in an album
         Args:
             album_id: string, id of the album
             download: boolean, whether to download the images
-            download_dir: string, directory to download the images, must be specified if download is True
+            download_dir: string, directory to download the images, must be specified if download is True,
+                images already downloaded there by an earlier call are skipped
+            workers: int, number of concurrent downloads
         returns:
             list of tuples (file_name, download_url)
         '''
         if download and download_dir is None:
             raise Exception('download_dir must be specified if download is True')
-        url = 'https://photoslibrary.googleapis.com/v1/mediaItems:search'
-        payload = {
-            "albumId": album_id,
-            "pageSize": 100
-        }
-        headers = {
-            'content-type': 'application/json',
-            'Authorization': 'Bearer {}'.format(self.cred.token)
-        }
-        next_page_token = None
         file_url_list = []
-        if download and not os.path.exists(download_dir):
-            os.makedirs(download_dir)
-        while True:
-            if next_page_token is not None:
-                payload['pageToken'] = next_page_token
-            res = safe_retryable_requests("POST", url, data=json.dumps(payload), headers=headers)
-            for item in res.json()['mediaItems']:
-                if item['filename'].startswith('auto_detected_face_image_'):
-                    file_name = item['filename'].split('.')[0] + '.jpg'
-                    file_path = os.path.join(download_dir, file_name)
-                    image_url = item['baseUrl'] + '=d'
-                    if download:
-                        save_image_from_url_helper(image_url, file_path)
-                    file_url_list.append((item['filename'], image_url))
-                    if len(file_url_list) % 100 == 0:
-                        print('processing {} images'.format(len(file_url_list)))
-                    if len(file_url_list) == size:
-                        break
-            next_page_token = res.json().get('nextPageToken')
-            if next_page_token is None or len(file_url_list) == size:
-                break
+        downloader = AlbumDownloader(download_dir, workers=workers) if download else None
+        try:
+            for file_name, image_url in self.iter_face_download_urls_from_album(album_id):
+                if downloader is not None:
+                    # the original bytes are stored as they are, the crops are JPEGs already
+                    downloader.submit(image_url, file_name.split('.')[0] + '.jpg')
+                file_url_list.append((file_name, image_url))
+                if len(file_url_list) % 100 == 0:
+                    structured_log('processing {} images'.format(len(file_url_list)))
+                if len(file_url_list) == size:
+                    break
+        finally:
+            if downloader is not None:
+                downloader.close()
         return file_url_list
 
+class PhotoAlbumBatchUploader:
+    '''
+    Uploads images to an album: raw bytes are uploaded concurrently, and the collected upload tokens
+    are turned into media items with one mediaItems:batchCreate call per MAX_BATCH_CREATE_SIZE images.
+    At most max_queued images wait for or are in an upload, add blocks until one finishes beyond that,
+    so a fast producer cannot pile up image bytes in memory.
+    Use it as a context manager so that the last partial batch is flushed on exit.
+    '''
+
+    def __init__(self, photo_helper, album_id, workers=8, batch_size=MAX_BATCH_CREATE_SIZE, max_queued=None, on_album_rejected=None):
+        '''
+        Args:
+            photo_helper: GooglePhotoHelper, used for the api calls
+            album_id: string, id of the album to which the images will be uploaded
+            workers: int, number of concurrent byte uploads
+            batch_size: int, number of media items per batchCreate call, at most MAX_BATCH_CREATE_SIZE
+            max_queued: int, number of images whose bytes are not uploaded yet, defaults to 4 * workers
+            on_album_rejected: callable taking the id of an album that no longer exists and returning the id to use instead,
+                if None a batch rejected for a deleted album fails
+        '''
+        self.photo_helper = photo_helper
+        self.album_id = album_id
+        self.on_album_rejected = on_album_rejected
+        self.batch_size = min(batch_size, MAX_BATCH_CREATE_SIZE)
+        self.upload_slots = threading.BoundedSemaphore(max_queued or 4 * workers)
+        self.upload_executor = ThreadPoolExecutor(max_workers=workers)
+        # batchCreate calls run one at a time in the background so callers can keep producing images
+        self.create_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.create_futures = []
+        self.created = []
+        self.failed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, image_bytes, file_name):
+        '''
+        Schedules an image for upload
+        Args:
+            image_bytes: bytes, image data to be uploaded
+            file_name: string, file name of the new media item
+        '''
+        self.upload_slots.acquire()
+        try:
+            upload_future = self.upload_executor.submit(self.photo_helper.upload_bytes, image_bytes)
+        except BaseException:
+            self.upload_slots.release()
+            raise
+        # the slot is free once the bytes are uploaded, only the upload token is kept after that
+        upload_future.add_done_callback(lambda _: self.upload_slots.release())
+        self.pending.append((upload_future, file_name))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Hands the pending uploads over to a batchCreate call without waiting for it
+        '''
+        if self.pending:
+            self.create_futures.append(self.create_executor.submit(self._create_batch, self.pending))
+            self.pending = []
+
+    def wait(self):
+        '''
+        Flushes the pending uploads and blocks until every batchCreate call so far is done
+        '''
+        self.flush()
+        for future in self.create_futures:
+            future.result()
+        self.create_futures = []
+
+    def close(self):
+        '''
+        Flushes the last batch and waits until every media item is created
+        returns:
+            tuple (list of created file names, list of (file name, error message) that failed)
+        '''
+        try:
+            self.wait()
+        finally:
+            self.upload_executor.shutdown()
+            self.create_executor.shutdown()
+        if self.failed:
+            structured_log('{} of {} images failed to upload to album {}'.format(
+                len(self.failed), len(self.failed) + len(self.created), self.album_id), severity=LogSeverity.WARNING)
+        return self.created, self.failed
+
+    def _create_batch(self, batch):
+        token_file_name_list = []
+        for upload_future, file_name in batch:
+            try:
+                token_file_name_list.append((upload_future.result(), file_name))
+            except Exception as e:
+                self.failed.append((file_name, str(e)))
+        if not token_file_name_list:
+            return
+        file_name_by_token = dict(token_file_name_list)
+        try:
+            try:
+                results = self.photo_helper.batch_create_media_items(self.album_id, token_file_name_list)
+            except HTTPError as e:
+                if not self._replace_rejected_album(e):
+                    raise
+                # upload tokens stay valid for a day, the same batch goes into the new album
+                results = self.photo_helper.batch_create_media_items(self.album_id, token_file_name_list)
+        except Exception as e:
+            structured_log('batchCreate of {} images failed: {!r}'.format(len(token_file_name_list), e), severity=LogSeverity.ERROR)
+            self.failed.extend((file_name, str(e)) for file_name in file_name_by_token.values())
+            return
+        for result in results:
+            file_name = file_name_by_token.pop(result.get('uploadToken'), None)
+            status = result.get('status', {})
+            # a successful item either has no status code or code 0 (OK)
+            if status.get('code', 0) == 0:
+                self.created.append(file_name)
+            else:
+                self.failed.append((file_name, status.get('message', 'unknown error')))
+        # tokens missing from the response were not created either
+        for file_name in file_name_by_token.values():
+            self.failed.append((file_name, 'missing from batchCreate response'))
+
+    def _replace_rejected_album(self, error):
+        '''
+        returns: whether batchCreate failed because the album was deleted and album_id now names its replacement
+        '''
+        if self.on_album_rejected is None or error.response is None or error.response.status_code not in (400, 403, 404):
+            return False
+        if self.photo_helper.album_exists(self.album_id):
+            return False
+        rejected_album_id = self.album_id
+        self.album_id = self.on_album_rejected(rejected_album_id)
+        structured_log('Album {} no longer exists, uploading into album {} instead'.format(rejected_album_id, self.album_id),
+                       severity=LogSeverity.WARNING)
+        return self.album_id != rejected_album_id
+
 if __name__ == '__main__':
     pass
     # print(get_api_credential_from_google_secret())
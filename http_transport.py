@@ -0,0 +1,242 @@
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from google_logging import structured_log, LogSeverity
+import pipeline_metrics
+
+# size the keep-alive pool for the number of concurrent workers hitting the same host
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 32))
+# the Photos Library API allows 10,000 requests per project per day, and bursts beyond
+# a few requests per second are answered with 429, so we stay well below that by default
+# see https://developers.google.com/photos/library/guides/api-limits-quotas
+PHOTOS_API_HOST = 'photoslibrary.googleapis.com'
+PHOTOS_API_RATE_PER_SECOND = float(os.environ.get('PHOTOS_API_RATE_PER_SECOND', 10))
+PHOTOS_API_BURST = int(os.environ.get('PHOTOS_API_BURST', 20))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 32
+
+
+class TokenBucket:
+    '''
+    Thread safe token bucket with additive increase / multiplicative decrease of the refill rate,
+    so that the rate adapts to the quota the server actually grants us
+    '''
+
+    def __init__(self, rate, capacity):
+        '''
+        Args:
+            rate: float, tokens added per second when the server is not throttling us
+            capacity: int, maximum burst size
+        '''
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        '''
+        Blocks until a token is available
+        '''
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        '''
+        Halves the refill rate, called when the server answers with 429
+        '''
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def recover(self):
+        '''
+        Slowly grows the refill rate back after a successful call
+        '''
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class EndpointStats:
+    '''
+    Latency and retry counters of a single endpoint
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'errors': self.errors,
+            'avg_ms': round(1000 * self.total_seconds / self.calls, 1) if self.calls else 0,
+            'max_ms': round(1000 * self.max_seconds, 1),
+        }
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_MAXSIZE, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = _create_session()
+_rate_limiters = {PHOTOS_API_HOST: TokenBucket(PHOTOS_API_RATE_PER_SECOND, PHOTOS_API_BURST)}
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _session, _stats_lock
+    # pooled connections must not be shared with the parent process,
+    # and locks held by threads of the parent at the fork would never be released
+    _session = _create_session()
+    _stats_lock = threading.Lock()
+    for limiter in _rate_limiters.values():
+        limiter.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_session():
+    '''
+    returns the process wide keep-alive session
+    '''
+    return _session
+
+
+def _endpoint_name(method, url):
+    parsed = urlparse(url)
+    if parsed.hostname == PHOTOS_API_HOST:
+        return f'{method} {parsed.path}'
+    # media downloads have a unique path per item, group them by host
+    return f'{method} {parsed.hostname}'
+
+
+def _record(endpoint, seconds, retried, failed):
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, EndpointStats())
+        stats.calls += 1
+        stats.total_seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        if retried:
+            stats.retries += 1
+        if failed:
+            stats.errors += 1
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_seconds(attempt):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def request(method, url, **kwargs):
+    '''
+    Sends a request through the shared session, rate limited per host,
+    retried with exponential backoff on connection errors, 429 and 5xx responses.
+    Retry-After is honored on 429 and 503.
+    returns:
+        the last response, which may still carry an error status after all attempts are used up
+    '''
+    endpoint = _endpoint_name(method, url)
+    limiter = _rate_limiters.get(urlparse(url).hostname)
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = _session.request(method, url, **kwargs)
+        except (ConnectionError, Timeout) as e:
+            _record(endpoint, time.monotonic() - start, attempt > 0, True)
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            pipeline_metrics.add_retry()
+            structured_log(f'{endpoint} failed with {type(e).__name__}, retrying', severity=LogSeverity.WARNING)
+            time.sleep(_backoff_seconds(attempt))
+            continue
+        failed = response.status_code in RETRYABLE_STATUS_CODES
+        _record(endpoint, time.monotonic() - start, attempt > 0, failed)
+        if not failed or attempt == MAX_ATTEMPTS - 1:
+            if limiter is not None and not failed:
+                limiter.recover()
+            return response
+        # give the connection back to the pool, streamed responses would hold on to it
+        response.close()
+        pipeline_metrics.add_retry()
+        if limiter is not None and response.status_code == 429:
+            limiter.throttle()
+        wait = None
+        if response.status_code in (429, 503):
+            wait = _retry_after_seconds(response)
+        if wait is None:
+            wait = _backoff_seconds(attempt)
+        structured_log(f'{endpoint} returned {response.status_code}, retrying in {wait:.1f}s', severity=LogSeverity.WARNING)
+        time.sleep(min(wait, BACKOFF_MAX_SECONDS * 2))
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def latency_report():
+    '''
+    returns:
+        dict of endpoint name to its latency and retry counters
+    '''
+    with _stats_lock:
+        return {endpoint: stats.to_dict() for endpoint, stats in sorted(_stats.items())}
+
+
+def log_latency_report():
+    structured_log('HTTP endpoint latency: ' + json.dumps(latency_report()), severity=LogSeverity.INFO)
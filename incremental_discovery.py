@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import struct
+from array import array
+from datetime import date, timedelta
+
+from google_logging import structured_log
+
+DISCOVERY_FILE_PREFIX = 'discovery/'
+WATERMARK_FILE_NAME = f'{DISCOVERY_FILE_PREFIX}watermark.json'
+SEEN_SET_FILE_NAME = f'{DISCOVERY_FILE_PREFIX}seen_items.bin'
+# photos may show up in the library this long after the day they were taken, e.g. from a phone that was offline
+DISCOVERY_LOOKBACK_DAYS = int(os.environ.get('DISCOVERY_LOOKBACK_DAYS', 30))
+
+
+def media_item_key(item_id):
+    '''
+    returns: a 64 bit key of a media item id, the ids themselves are over 100 characters
+    '''
+    return int.from_bytes(hashlib.blake2b(item_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def creation_day(item):
+    '''
+    returns: datetime.date of the creationTime of a media item, e.g. "2022-10-29T12:34:56Z"
+    '''
+    return date.fromisoformat(item['mediaMetadata']['creationTime'][:10])
+
+
+def candidate_days(item, window_start, window_end):
+    '''
+    A day search matches the day a photo was taken in its own time zone, UTC-12 to UTC+14,
+    so an item taken before 12:00 UTC may be found by the search of the day before its UTC day,
+    and one taken from 10:00 UTC on by the search of the day after
+    returns: those days that lie within the window
+    '''
+    utc_day = creation_day(item)
+    utc_hour = int(item['mediaMetadata']['creationTime'][11:13])
+    days = [utc_day]
+    if utc_hour < 12:
+        days.append(utc_day - timedelta(days=1))
+    if utc_hour >= 10:
+        days.append(utc_day + timedelta(days=1))
+    return [day for day in days if window_start <= day <= window_end]
+
+
+class IncrementalDiscovery:
+    '''
+    Finds the photos no earlier run handled, including those that reached the library after their day was processed.
+    Every run looks back DISCOVERY_LOOKBACK_DAYS days, or further back to the watermark if runs were missed,
+    and skips the items in the seen set. The seen set holds a 64 bit key and the searched day of every handled item
+    of the lookback window, 12 bytes per item, older items are dropped since no run lists them again.
+    Stored in the bucket as WATERMARK_FILE_NAME {"processed_until": "2022-10-29"}
+    and SEEN_SET_FILE_NAME, a count followed by the sorted keys and their days as ordinals.
+    '''
+
+    def __init__(self, storage_helper, lookback_days=DISCOVERY_LOOKBACK_DAYS):
+        self.storage_helper = storage_helper
+        self.lookback_days = lookback_days
+        self.processed_until = None
+        self.seen = {}
+        self.unsaved_updates = 0
+        if storage_helper.file_exists(WATERMARK_FILE_NAME):
+            self.processed_until = date.fromisoformat(
+                json.loads(storage_helper.read_file_from_google_cloud_to_string(WATERMARK_FILE_NAME))['processed_until'])
+        if storage_helper.file_exists(SEEN_SET_FILE_NAME):
+            self.seen = self._decode(storage_helper.read_file_from_google_cloud_to_bytes(SEEN_SET_FILE_NAME))
+        structured_log('Discovery processed until {} with {} seen items'.format(self.processed_until, len(self.seen)))
+
+    @staticmethod
+    def _decode(content):
+        count, = struct.unpack_from('<I', content)
+        keys = array('Q')
+        keys.frombytes(content[4:4 + 8 * count])
+        days = array('I')
+        days.frombytes(content[4 + 8 * count:4 + 12 * count])
+        return dict(zip(keys, days))
+
+    def _encode(self):
+        keys = array('Q', sorted(self.seen))
+        days = array('I', (self.seen[key] for key in keys))
+        return struct.pack('<I', len(keys)) + keys.tobytes() + days.tobytes()
+
+    def window(self, today):
+        '''
+        returns: (start date, end date) of the creation dates to list, both inclusive
+        '''
+        start_date = today - timedelta(days=self.lookback_days)
+        if self.processed_until is not None and self.processed_until < start_date:
+            # runs were missed, catch up from where the last one finished
+            start_date = self.processed_until
+        return start_date, today
+
+    def is_seen(self, item_id):
+        return media_item_key(item_id) in self.seen
+
+    def add(self, item_id, day):
+        '''
+        Records that an item was handled, later runs skip it
+        '''
+        self.seen[media_item_key(item_id)] = day.toordinal()
+        self.unsaved_updates += 1
+
+    def finish(self, start_date, end_date):
+        '''
+        Moves the watermark to the end of a fully processed window, and drops the items before the window
+        '''
+        self.processed_until = end_date
+        oldest = start_date.toordinal()
+        self.seen = {key: day for key, day in self.seen.items() if day >= oldest}
+        self.unsaved_updates += 1
+
+    def save(self):
+        if self.unsaved_updates == 0:
+            return
+        self.storage_helper.upload_string_content_to_google_cloud(self._encode(), SEEN_SET_FILE_NAME, 'application/octet-stream')
+        if self.processed_until is not None:
+            self.storage_helper.upload_string_content_to_google_cloud(
+                json.dumps({'processed_until': self.processed_until.isoformat()}), WATERMARK_FILE_NAME, 'application/json')
+        self.unsaved_updates = 0
@@ -1,111 +1,259 @@
 from typing import List
 
-from google_photo_api import GooglePhotoHelper
+from google_photo_api import GooglePhotoHelper, PhotoAlbumBatchUploader, day_search_payload, MAX_BATCH_CREATE_SIZE
 from google.cloud import vision_v1
 from google_cloud_storage_api import GoogleStorageHelper
 import json
-from PIL import Image
-from io import BytesIO
-import piexif
+import os
+from collections import deque
+from concurrent.futures import Future
 import functions_framework
-from datetime import datetime, timedelta
+import itertools
+import time
+from datetime import date, datetime, timedelta
 import base64
 from cloudevents.http.event import CloudEvent
-from google_logging import structured_log
+from google_logging import structured_log, LogSeverity, flush_logs
+import http_transport
+import pipeline_metrics
+from vision_batch import iter_sharded_batch_annotate_images, iter_result_responses
+from face_crop import FaceCropEngine, rescale_face_annotation, FACE_CROP_WORKERS
+from processing_manifest import ProcessingManifest, STAGE_COPIED, STAGE_ANNOTATED, STAGE_FACES_UPLOADED
+from content_dedup import ContentDedupIndex
+from continuation import DeadlineScheduler, ContinuationCursor, PubSubPublisher, LocalPublisher, follow_up_message
+from google.api_core.exceptions import NotFound
+from blob_store import SpillBlobStore
+from staged_pipeline import Stage, StagedPipeline
+from incremental_discovery import IncrementalDiscovery, candidate_days, creation_day
+from video_frames import extract_video_frames, check_video_support, VideoTooLargeError
+from content_cache import get_content_cache
+from photo_catalog import PhotoCatalog
 
 TEST_BUCKET_NAME = "test-bucket-gpa"
 FACE_IMAGE_FILE_PREFIX = 'auto_detected_face_image_'
 FACE_ALBUM_NAME = 'auto_detected_face_images'
+ANNOTATION_TIMEOUT_SECONDS = 300
+# if not 0, Vision gets a copy of each photo bounded to this many pixels per side instead of the original,
+# and the face boxes are mapped back onto the original before cropping
+ANNOTATION_INPUT_MAX_SIZE = int(os.environ.get('ANNOTATION_INPUT_MAX_SIZE', 0))
+# overlap copying, annotating, cropping and uploading instead of running them one after the other, see staged_face_image_generation
+STAGED_PIPELINE = os.environ.get('STAGED_PIPELINE', '1') == '1'
+COPY_WORKERS = int(os.environ.get('COPY_WORKERS', 8))
+# images per Vision operation of the staged pipeline, smaller operations get their faces to cropping sooner
+ANNOTATION_BATCH_SIZE = int(os.environ.get('ANNOTATION_BATCH_SIZE', 50))
+ANNOTATION_BATCH_WAIT_SECONDS = 5
+ANNOTATION_CONCURRENCY = int(os.environ.get('ANNOTATION_CONCURRENCY', 4))
+# faces in videos are detected on sampled keyframes, needs PyAV and the staged pipeline, see video_frames
+VIDEO_FACE_DETECTION = os.environ.get('VIDEO_FACE_DETECTION', '0') == '1'
+FACE_MEDIA_TYPES = ['PHOTO', 'VIDEO'] if VIDEO_FACE_DETECTION and STAGED_PIPELINE else ['PHOTO']
+if VIDEO_FACE_DETECTION:
+    # a missing PyAV shows up at deployment, not as a failure on every video
+    check_video_support()
 
 def async_batch_annotate_images(
     bucket_name: str,
     input_image_file_name_list: List[str],
     output_file_prefix: str,
     annotation_type: vision_v1.Feature.Type,
+    timeout: float = 300,
 ):
     """
-    Perform async batch image annotation.
-    return: the output file name
+    Perform async batch image annotation, sharded into concurrent operations.
+    return: the output file names of all shards
     """
-    client = vision_v1.ImageAnnotatorClient()
+    output_file_names = []
+    for shard_output_file_names in iter_sharded_batch_annotate_images(bucket_name, input_image_file_name_list, output_file_prefix, annotation_type, timeout=timeout):
+        output_file_names.extend(shard_output_file_names)
+    structured_log("Output written to GCS with file names: {}".format(output_file_names))
+    return output_file_names
 
-    features = [
-        {"type_": annotation_type},
-    ]
 
-    # Each requests element corresponds to a single image.  To annotate more
-    # images, create a request element for each image and add it to
-    # the array of requests
-    # requests = [{"image": image, "features": features}]
-    requests = [{"image": {"source":  {"image_uri": f"gs://{bucket_name}/{file_name}"}}, "features": features} for file_name in input_image_file_name_list]
-    gcs_destination = {"uri": f"gs://{bucket_name}/{output_file_prefix}"}
+def upsert_face_album(photo_api_helper, rejected_album_id=None):
+    '''
+    Looks up the album of the face images in the PhotoCatalog in the bucket instead of listing every album,
+    the album is created and added to the catalog if it is not there
+    Args:
+        rejected_album_id: string, id of a face album that was deleted, dropped from the catalog before the lookup
+    returns: the album id
+    '''
+    with PhotoCatalog.from_bucket(GoogleStorageHelper(TEST_BUCKET_NAME)) as catalog:
+        if rejected_album_id is not None:
+            catalog.remove_album(rejected_album_id)
+        cataloged = bool(catalog.find_albums_by_name(FACE_ALBUM_NAME))
+        album_id = photo_api_helper.upsert_album(FACE_ALBUM_NAME, catalog=catalog)
+        if not cataloged:
+            # the albums were synced or the album was created, the next lookup is a cheap one
+            catalog.save_to_bucket()
+    return album_id
+
+
+def face_album_uploader(photo_api_helper, album_id):
+    '''
+    returns: a PhotoAlbumBatchUploader into the face album that moves on to a new face album if this one is deleted
+    '''
+    return PhotoAlbumBatchUploader(photo_api_helper, album_id,
+                                   on_album_rejected=lambda rejected_album_id: upsert_face_album(photo_api_helper, rejected_album_id))
 
-    # The max number of responses to output in each JSON file
-    batch_size = len(input_image_file_name_list)
-    output_config = {"gcs_destination": gcs_destination,
-                     "batch_size": batch_size}
 
-    operation = client.async_batch_annotate_images(requests=requests, output_config=output_config)
+def upload_face_detection_result(photo_api_helper, detect_result_file_name, file_name_dict, bucket_name, dry_run=False, uploader=None, manifest=None, crop_engine=None, annotation_scales=None):
+    '''
+    Crops and uploads the faces of a result file, streamed one response at a time
+    returns: the file names of the images the result file has an annotation for
+    '''
+    if uploader is None or crop_engine is None:
+        album_id = upsert_face_album(photo_api_helper)
+        with face_album_uploader(photo_api_helper, album_id) as uploader, FaceCropEngine() as crop_engine:
+            annotated_file_names = upload_face_detection_result(photo_api_helper, detect_result_file_name, file_name_dict, bucket_name, dry_run, uploader, manifest, crop_engine, annotation_scales)
+        structured_log('Uploaded {} faces, {} failed'.format(len(uploader.created), len(uploader.failed)))
+        return annotated_file_names
+    storage_helper = GoogleStorageHelper(bucket_name)
+    responses = iter_result_responses(storage_helper, detect_result_file_name)
+    return process_face_detection_responses(responses, detect_result_file_name, file_name_dict, dry_run, uploader, manifest, crop_engine, annotation_scales)
+
 
-    # TODO deal with timeout cases
-    structured_log("Waiting for operation to complete...")
-    response = operation.result(300)
+def process_face_detection_responses(responses, detect_result_file_name, file_name_dict, dry_run, uploader, manifest=None, crop_engine=None, annotation_scales=None):
+    '''
+    Crops and uploads the faces of annotation responses
+    responses: iterable of responses, consumed one at a time
+    detect_result_file_name: the result file the responses come from, None for responses reused from another photo,
+        which then are not marked as annotated
+    returns: the file names of the images with an annotation among the responses
+    '''
+    # images are cropped in parallel while the responses are read,
+    # and their faces are uploaded in order as soon as the oldest crop is done
+    pending_crops = deque()
+    face_file_names_by_file = {}
+    annotated_file_names = []
+    for detection_res in responses:
+        ori_file_name = detection_res['context']['uri'].split('/')[-1]
+        if 'error' not in detection_res:
+            annotated_file_names.append(ori_file_name)
+        if manifest is not None:
+            if manifest.file_reached(ori_file_name, STAGE_FACES_UPLOADED) or ori_file_name not in file_name_dict:
+                continue
+            if 'error' not in detection_res and detect_result_file_name is not None:
+                manifest.mark_file(ori_file_name, STAGE_ANNOTATED, detect_result_file_name)
+        annotation_scale = annotation_scales.get(ori_file_name, 1) if annotation_scales is not None else 1
+        pending_crops.append((ori_file_name, submit_face_crops(detection_res, file_name_dict, crop_engine, dry_run, annotation_scale)))
+        while pending_crops and (pending_crops[0][1] is None or pending_crops[0][1].done()):
+            ori_file_name, crop_future = pending_crops.popleft()
+            face_file_names_by_file[ori_file_name] = upload_face_crops(ori_file_name, crop_future, uploader)
+    while pending_crops:
+        ori_file_name, crop_future = pending_crops.popleft()
+        face_file_names_by_file[ori_file_name] = upload_face_crops(ori_file_name, crop_future, uploader)
+    if manifest is None or dry_run:
+        return annotated_file_names
+    # only items whose faces all made it into the album are done
+    uploader.wait()
+    failed_face_file_names = {file_name for file_name, _ in uploader.failed}
+    for ori_file_name, face_file_names in face_file_names_by_file.items():
+        if face_file_names is not None and failed_face_file_names.isdisjoint(face_file_names):
+            manifest.mark_file(ori_file_name, STAGE_FACES_UPLOADED)
+    manifest.flush()
+    return annotated_file_names
 
-    # The output is written to GCS with the provided output_uri as prefix
-    output_put_filename = f"{output_file_prefix}output-1-to-{batch_size}.json"
 
-    structured_log("Output written to GCS with file name: {}".format(output_put_filename))
-    return output_put_filename
+def read_face_detection_responses(storage_helper, result_file_name, file_names):
+    '''
+    Picks the responses of some images out of a result file, which is streamed so that the others are never all in memory
+    returns: dict, file name -> response
+    '''
+    file_names = set(file_names)
+    found = {}
+    for detection_res in iter_result_responses(storage_helper, result_file_name):
+        file_name = detection_res['context']['uri'].split('/')[-1]
+        if file_name in file_names:
+            found[file_name] = detection_res
+            if len(found) == len(file_names):
+                break
+    return found
 
 
-def upload_face_detection_result(photo_api_helper, detect_result_file_name, file_name_dict, bucket_name, dry_run=False):
+def reuse_face_detection_responses(dedup_hits, bucket_name):
+    '''
+    Builds annotation responses for photos whose content was annotated before under another file name
+    Args:
+        dedup_hits: dict, file name -> ContentDedupIndex entry of the annotated copy
+        bucket_name: string, bucket holding the result files
+    returns: list of responses as if Vision had annotated the photos under their new file names,
+        and the file names whose earlier annotation could not be found anymore
+    '''
     storage_helper = GoogleStorageHelper(bucket_name)
-    album_id = photo_api_helper.upsert_album(FACE_ALBUM_NAME)
-    face_detection_result_json = json.loads(storage_helper.read_file_from_google_cloud_to_string(detect_result_file_name))
-    for detection_res in face_detection_result_json['responses']:
-        file_url = detection_res['context']['uri']
-        ori_file_name = file_url.split('/')[-1]
-        if 'error' in detection_res:
-            continue
-        if 'faceAnnotations' in detection_res:
-            structured_log('======== Found {} faces in {}'.format(len(detection_res['faceAnnotations']), ori_file_name))
-            image = Image.open(BytesIO(file_name_dict[ori_file_name]))
-            # get image creation time
-            try:
-                exif_dict = piexif.load(image.info['exif'])
-            except KeyError:
-                # some images does not have proper exif data altogether
-                exif_dict = {"0th": {}, "Exif": {}}
-            if piexif.ExifIFD.DateTimeOriginal in exif_dict['Exif']:
-                image_creation_time = exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal][:10].decode('utf-8')
-            else:
-                image_creation_time = 'UNKONWN_TIME'
-            for i, face in enumerate(detection_res['faceAnnotations']):
-                if not dry_run:
-                    # crop the faces from the image
-                    face_crop = image.crop((
-                        face['boundingPoly']['vertices'][0]['x'] if 'x' in face['boundingPoly']['vertices'][0] else 0,
-                        face['boundingPoly']['vertices'][0]['y'] if 'y' in face['boundingPoly']['vertices'][0] else 0,
-                        face['boundingPoly']['vertices'][2]['x'] if 'x' in face['boundingPoly']['vertices'][2] else image.width,
-                        face['boundingPoly']['vertices'][2]['y'] if 'y' in face['boundingPoly']['vertices'][2] else image.height,
-                    ))
-                    # add face detection meta data to exif
-                    exif_dict = {"0th": {}, "Exif": {}}
-                    exif_dict['Exif'][piexif.ExifIFD.UserComment] = json.dumps(face).encode('utf-8')
-                    exif_bytes = piexif.dump(exif_dict)
-                    # get bytes from the cropped image
-                    face_crop_bytes = BytesIO()
-                    face_crop.save(face_crop_bytes, format='JPEG', exif=exif_bytes)
-                    # save the cropped image to album
-                    structured_log('Uploading face {} of {}'.format(i, ori_file_name))
-                    # get file name witout extension
-                    file_name_without_ext = ori_file_name.split('.')[0]
-                    photo_api_helper.upload_image_to_photo_album(face_crop_bytes.getvalue(), f"{FACE_IMAGE_FILE_PREFIX}{image_creation_time}_{i}_{file_name_without_ext}.jpeg", album_id)
-                else:
-                    structured_log(face['boundingPoly']['vertices'])
+    # many duplicates usually point into the same few result files, each is read once
+    file_names_by_result_file = {}
+    for file_name, (result_file_name, annotated_file_name, _) in dedup_hits.items():
+        file_names_by_result_file.setdefault(result_file_name, {}).setdefault(annotated_file_name, []).append(file_name)
+    responses = []
+    missing_file_names = []
+    for result_file_name, file_names_by_annotated_file in file_names_by_result_file.items():
+        try:
+            found = read_face_detection_responses(storage_helper, result_file_name, file_names_by_annotated_file)
+        except NotFound:
+            structured_log('Result file {} is gone'.format(result_file_name), severity=LogSeverity.WARNING)
+            found = {}
+        for annotated_file_name, file_names in file_names_by_annotated_file.items():
+            detection_res = found.get(annotated_file_name)
+            if detection_res is None:
+                missing_file_names.extend(file_names)
+                continue
+            for file_name in file_names:
+                responses.append(dict(detection_res, context=dict(detection_res['context'], uri=f'gs://{bucket_name}/{file_name}')))
+    return responses, missing_file_names
+
+
+def add_to_dedup_index(dedup_index, detect_result_file_name, annotated_file_names, annotation_scales):
+    '''
+    Records the successfully annotated photos of a result file, so that later copies of them can reuse the annotation
+    '''
+    for file_name in annotated_file_names:
+        dedup_index.add(file_name, detect_result_file_name, annotation_scales.get(file_name, 1))
+
+
+def submit_face_crops(detection_res, file_name_dict, crop_engine, dry_run=False, annotation_scale=1):
+    '''
+    Starts cropping the faces of a single annotation response
+    annotation_scale: original pixels per pixel of the image Vision annotated, see ANNOTATION_INPUT_MAX_SIZE
+    returns: a future of (image creation time, list of face JPEG bytes), None if the annotation failed
+    '''
+    ori_file_name = detection_res['context']['uri'].split('/')[-1]
+    if 'error' in detection_res:
+        return None
+    faces = [rescale_face_annotation(face, annotation_scale) for face in detection_res.get('faceAnnotations', [])]
+    if faces:
+        structured_log('======== Found {} faces in {}'.format(len(faces), ori_file_name))
+    if dry_run:
+        for face in faces:
+            structured_log(face['boundingPoly']['vertices'])
+        faces = []
+    if not faces:
+        future = Future()
+        future.set_result((None, []))
+        return future
+    return crop_engine.submit(file_name_dict[ori_file_name], faces)
+
+
+def upload_face_crops(ori_file_name, crop_future, uploader):
+    '''
+    Hands the face crops of an image to the uploader once they are ready
+    returns: the file names of the face images, None if the annotation failed
+    '''
+    if crop_future is None:
+        return None
+    image_creation_time, face_crops = crop_future.result()
+    # get file name witout extension
+    file_name_without_ext = ori_file_name.split('.')[0]
+    face_file_names = []
+    for i, face_crop_bytes in enumerate(face_crops):
+        # save the cropped image to album
+        structured_log('Uploading face {} of {}'.format(i, ori_file_name))
+        face_file_name = f"{FACE_IMAGE_FILE_PREFIX}{image_creation_time}_{i}_{file_name_without_ext}.jpeg"
+        uploader.add(face_crop_bytes, face_file_name)
+        face_file_names.append(face_file_name)
+    return face_file_names
 
 
-def face_image_generation_for_google_photo(year, month, day, dry_run=False):
+def face_image_generation_for_google_photo(year, month, day, dry_run=False, media_items=None, helper=None, annotation_timeout=ANNOTATION_TIMEOUT_SECONDS,
+                                           album_id=None, manifest=None, dedup_index=None, crop_engine=None):
     '''
     Generate face images for google photo for a given date.
     face images will be saved to a google photo album named 'auto_detected_face_images'
@@ -113,40 +261,426 @@ def face_image_generation_for_google_photo(year, month, day, dry_run=False):
         year: 4 digits integer
         month: 2 digits integer
         day: 2 digits integer
+        media_items: list of media item dicts of that day if they were already listed, searched for if None
+        helper: GooglePhotoHelper to reuse, a new one is created if None
+        annotation_timeout: float, seconds to wait for each Vision operation
+        album_id: string, id of the face album, see upsert_face_album, looked up if None
+        manifest: ProcessingManifest of the day, loaded if None
+        dedup_index: ContentDedupIndex, loaded if None
+        crop_engine: FaceCropEngine, one is started for this call if None
+            album_id, manifest, dedup_index and crop_engine are passed in by callers that process a day in chunks,
+            so that they are set up once and not for every chunk
+    returns:
+        the ProcessingManifest of the day
     '''
     structured_log('======= processing image from {}-{}-{} ========'.format(year, month, day))
     if dry_run:
         structured_log('=== dry run mode ===')
-    helper = GooglePhotoHelper()
-    file_name_dict = helper.upload_from_google_photo_to_bucket(year, month, day, TEST_BUCKET_NAME, dry_run=dry_run, upload_photo=True, upload_video=False, exclude_file_prefix=FACE_IMAGE_FILE_PREFIX)
-    if not file_name_dict:
-        structured_log('No image found for {}-{}-{}'.format(year, month, day))
-        return
-    detection_result_file = async_batch_annotate_images(TEST_BUCKET_NAME, file_name_dict.keys(), f'{year}_{month}_{day}_', vision_v1.Feature.Type.FACE_DETECTION)
-    upload_face_detection_result(helper, detection_result_file, file_name_dict, TEST_BUCKET_NAME)
+    if helper is None:
+        helper = GooglePhotoHelper()
+    if album_id is None:
+        album_id = upsert_face_album(helper)
+    if manifest is None:
+        manifest = ProcessingManifest.for_day(GoogleStorageHelper(TEST_BUCKET_NAME), year, month, day)
+    if dedup_index is None:
+        dedup_index = ContentDedupIndex(GoogleStorageHelper(TEST_BUCKET_NAME))
+    if crop_engine is None:
+        with FaceCropEngine() as crop_engine:
+            return face_image_generation_for_google_photo(year, month, day, dry_run, media_items, helper, annotation_timeout, album_id, manifest, dedup_index, crop_engine)
+    annotation_scales = {}
+    if STAGED_PIPELINE:
+        return staged_face_image_generation(year, month, day, helper, manifest, dedup_index, album_id, crop_engine, dry_run=dry_run, media_items=media_items, annotation_timeout=annotation_timeout)
+    if media_items is None:
+        file_name_dict = helper.upload_from_google_photo_to_bucket(year, month, day, TEST_BUCKET_NAME, dry_run=dry_run, upload_photo=True, upload_video=False, exclude_file_prefix=FACE_IMAGE_FILE_PREFIX, manifest=manifest, annotation_max_size=ANNOTATION_INPUT_MAX_SIZE, annotation_scales=annotation_scales, dedup_index=dedup_index)
+    else:
+        # only the staged pipeline handles videos
+        media_items = [item for item in media_items if 'photo' in item['mediaMetadata']]
+        file_name_dict = helper.upload_media_items_to_bucket(media_items, TEST_BUCKET_NAME, dry_run=dry_run, exclude_file_prefix=FACE_IMAGE_FILE_PREFIX, manifest=manifest, annotation_max_size=ANNOTATION_INPUT_MAX_SIZE, annotation_scales=annotation_scales, dedup_index=dedup_index)
+    with file_name_dict, manifest:
+        if not file_name_dict:
+            structured_log('No unprocessed image found for {}-{}-{}'.format(year, month, day))
+            pipeline_metrics.log_summary('{}-{}-{}'.format(year, month, day))
+            return manifest
+        file_name_dict.log_usage()
+        # items annotated by an earlier run only need their faces cropped from the stored results
+        annotated_result_files = sorted({manifest.annotation_result_file(file_name) for file_name in file_name_dict if manifest.file_reached(file_name, STAGE_ANNOTATED)})
+        # copies of photos annotated before take their faces from the annotation of the first copy
+        file_names_to_annotate = [file_name for file_name in file_name_dict if not manifest.file_reached(file_name, STAGE_ANNOTATED) and file_name not in dedup_index.hits]
+        # the index may be shared with earlier chunks of the day, whose hits are done
+        dedup_hits = {file_name: entry for file_name, entry in dedup_index.hits.items() if file_name in file_name_dict}
+        with face_album_uploader(helper, album_id) as uploader:
+            for detection_result_file in annotated_result_files:
+                upload_face_detection_result(helper, detection_result_file, file_name_dict, TEST_BUCKET_NAME, uploader=uploader, manifest=manifest, crop_engine=crop_engine, annotation_scales=annotation_scales)
+            if dedup_hits:
+                # a reused annotation is in the coordinates of the copy it was made on
+                for file_name, entry in dedup_hits.items():
+                    annotation_scales[file_name] = entry[2]
+                reused_responses, missing_file_names = reuse_face_detection_responses(dedup_hits, TEST_BUCKET_NAME)
+                process_face_detection_responses(reused_responses, None, file_name_dict, dry_run, uploader, manifest, crop_engine, annotation_scales)
+                for file_name in missing_file_names:
+                    # the next run annotates these photos from scratch
+                    structured_log('Annotation of {} cannot be reused'.format(file_name), severity=LogSeverity.WARNING)
+                    dedup_index.forget(file_name)
+            # crop and upload the faces of each shard as soon as it is annotated,
+            # results of each run go to their own prefix so stale output files of earlier runs are never picked up
+            run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+            if file_names_to_annotate:
+                for detection_result_files in iter_sharded_batch_annotate_images(TEST_BUCKET_NAME, file_names_to_annotate, f'{year}_{month}_{day}_{run_id}_', vision_v1.Feature.Type.FACE_DETECTION, timeout=annotation_timeout):
+                    for detection_result_file in detection_result_files:
+                        annotated_file_names = upload_face_detection_result(helper, detection_result_file, file_name_dict, TEST_BUCKET_NAME, uploader=uploader, manifest=manifest, crop_engine=crop_engine, annotation_scales=annotation_scales)
+                        if not dry_run:
+                            add_to_dedup_index(dedup_index, detection_result_file, annotated_file_names, annotation_scales)
+        structured_log('Uploaded {} faces, {} failed'.format(len(uploader.created), len(uploader.failed)))
+    dedup_index.flush()
+    dedup_index.log_stats()
+    structured_log('Manifest {}: {}'.format(manifest.manifest_file_name, json.dumps(manifest.summary())))
+    pipeline_metrics.log_summary('{}-{}-{}'.format(year, month, day))
+    return manifest
+
+
+def staged_face_image_generation(year, month, day, helper, manifest, dedup_index, album_id, crop_engine, dry_run=False, media_items=None, annotation_timeout=ANNOTATION_TIMEOUT_SECONDS):
+    '''
+    Same as face_image_generation_for_google_photo, with the steps running at the same time as a StagedPipeline:
+    photos are copied to the bucket while earlier ones are annotated in small Vision operations,
+    and their faces are cropped and uploaded as soon as their annotation is there.
+    Args:
+        helper: GooglePhotoHelper
+        manifest: ProcessingManifest of the day
+        dedup_index: ContentDedupIndex
+        album_id: string, id of the face album
+        crop_engine: FaceCropEngine
+        see face_image_generation_for_google_photo for the other args
+    '''
+    storage_helper = GoogleStorageHelper(TEST_BUCKET_NAME)
+    if media_items is None:
+        media_items = helper.search_media_items_by_day(year, month, day, FACE_MEDIA_TYPES, prefetch=True)
+    annotation_scales = {}
+    # video id -> frame file names whose faces are not uploaded yet, and frame file name -> video item
+    pending_frames = {}
+    videos_by_frame = {}
+    # with microseconds, the chunks of a day often start within the same second
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    batch_numbers = itertools.count()
+
+    with SpillBlobStore() as file_name_dict, manifest, face_album_uploader(helper, album_id) as uploader:
+
+        def copy_video(item):
+            if dry_run or manifest.reached(item['id'], STAGE_FACES_UPLOADED):
+                return None
+            frame_file_names = []
+            try:
+                frames = extract_video_frames(item)
+            except VideoTooLargeError as e:
+                # not marked in the manifest, a run with a larger VIDEO_MAX_MB picks it up
+                structured_log('Skipping video: {}'.format(e), severity=LogSeverity.WARNING)
+                return None
+            for frame_file_name, frame_bytes in frames:
+                # every frame goes through the pipeline as an item of its own
+                frame_id = '{}:{}'.format(item['id'], frame_file_name)
+                if manifest.reached(frame_id, STAGE_FACES_UPLOADED):
+                    continue
+                if not manifest.reached(frame_id, STAGE_COPIED):
+                    storage_helper.upload_string_content_to_google_cloud(frame_bytes, frame_file_name, 'image/jpeg')
+                    manifest.mark(frame_id, frame_file_name, STAGE_COPIED)
+                file_name_dict[frame_file_name] = frame_bytes
+                frame_file_names.append(frame_file_name)
+            structured_log('{} has {} frames to process'.format(item['filename'], len(frame_file_names)))
+            if not frame_file_names:
+                manifest.mark(item['id'], item['filename'], STAGE_FACES_UPLOADED)
+                return None
+            pending_frames[item['id']] = set(frame_file_names)
+            for frame_file_name in frame_file_names:
+                videos_by_frame[frame_file_name] = item
+            return frame_file_names
+
+        def copy(item):
+            if 'video' in item['mediaMetadata']:
+                return copy_video(item) if VIDEO_FACE_DETECTION else None
+            if helper.copy_media_item(item, storage_helper, file_name_dict, dry_run=dry_run, exclude_file_prefix=FACE_IMAGE_FILE_PREFIX, manifest=manifest,
+                                      annotation_max_size=ANNOTATION_INPUT_MAX_SIZE, annotation_scales=annotation_scales, dedup_index=dedup_index):
+                return [item['filename']]
+
+        def annotate(file_names, emit):
+            # every response goes on to cropping as soon as it is read, not once the whole batch is annotated
+            file_names_to_annotate = []
+            dedup_hits = {}
+            file_names_by_result_file = {}
+            for file_name in file_names:
+                if manifest.file_reached(file_name, STAGE_ANNOTATED):
+                    file_names_by_result_file.setdefault(manifest.annotation_result_file(file_name), []).append(file_name)
+                elif file_name in dedup_index.hits:
+                    dedup_hits[file_name] = dedup_index.hits[file_name]
+                    # a reused annotation is in the coordinates of the copy it was made on
+                    annotation_scales[file_name] = dedup_hits[file_name][2]
+                else:
+                    file_names_to_annotate.append(file_name)
+            for result_file_name, result_file_names in file_names_by_result_file.items():
+                for detection_res in read_face_detection_responses(storage_helper, result_file_name, result_file_names).values():
+                    emit(detection_res)
+            if dedup_hits:
+                reused_responses, missing_file_names = reuse_face_detection_responses(dedup_hits, TEST_BUCKET_NAME)
+                for detection_res in reused_responses:
+                    emit(detection_res)
+                for file_name in missing_file_names:
+                    # the next run annotates these photos from scratch
+                    structured_log('Annotation of {} cannot be reused'.format(file_name), severity=LogSeverity.WARNING)
+                    dedup_index.forget(file_name)
+            if file_names_to_annotate:
+                output_file_prefix = f'{year}_{month}_{day}_{run_id}_batch{next(batch_numbers)}_'
+                for detection_result_files in iter_sharded_batch_annotate_images(TEST_BUCKET_NAME, file_names_to_annotate, output_file_prefix, vision_v1.Feature.Type.FACE_DETECTION, timeout=annotation_timeout):
+                    for detection_result_file in detection_result_files:
+                        annotated_file_names = []
+                        for detection_res in iter_result_responses(storage_helper, detection_result_file):
+                            if 'error' not in detection_res:
+                                annotated_file_names.append(detection_res['context']['uri'].split('/')[-1])
+                                manifest.mark_file(annotated_file_names[-1], STAGE_ANNOTATED, detection_result_file)
+                            emit(detection_res)
+                        if not dry_run:
+                            add_to_dedup_index(dedup_index, detection_result_file, annotated_file_names, annotation_scales)
+
+        def crop(detection_res):
+            ori_file_name = detection_res['context']['uri'].split('/')[-1]
+            crop_future = submit_face_crops(detection_res, file_name_dict, crop_engine, dry_run, annotation_scales.get(ori_file_name, 1))
+            if crop_future is not None:
+                # the crop itself runs in the engine's processes, this thread only waits for it
+                crop_future.result()
+            return [(ori_file_name, crop_future)]
+
+        def upload(cropped):
+            face_file_names_by_file = {
+                ori_file_name: upload_face_crops(ori_file_name, crop_future, uploader)
+                for ori_file_name, crop_future in cropped
+            }
+            uploaded_file_names = []
+            # only items whose faces all made it into the album are done
+            uploader.wait()
+            failed_face_file_names = {file_name for file_name, _ in uploader.failed}
+            for ori_file_name, face_file_names in face_file_names_by_file.items():
+                # the original is not needed anymore
+                file_name_dict.pop(ori_file_name, None)
+                if face_file_names is not None and failed_face_file_names.isdisjoint(face_file_names):
+                    if not dry_run:
+                        manifest.mark_file(ori_file_name, STAGE_FACES_UPLOADED)
+                    uploaded_file_names.append(ori_file_name)
+                    video = videos_by_frame.pop(ori_file_name, None)
+                    if video is not None:
+                        # a video is done with the last of its frames
+                        pending_frames[video['id']].discard(ori_file_name)
+                        if not pending_frames[video['id']] and not dry_run:
+                            manifest.mark(video['id'], video['filename'], STAGE_FACES_UPLOADED)
+            return uploaded_file_names
+
+        pipeline = StagedPipeline([
+            Stage('copy', copy, concurrency=COPY_WORKERS),
+            Stage('annotate', annotate, concurrency=ANNOTATION_CONCURRENCY, batch_size=ANNOTATION_BATCH_SIZE, batch_wait_seconds=ANNOTATION_BATCH_WAIT_SECONDS, emits=True),
+            Stage('crop', crop, concurrency=FACE_CROP_WORKERS),
+            Stage('upload', upload, batch_size=MAX_BATCH_CREATE_SIZE, batch_wait_seconds=1),
+        ])
+        done_file_names = pipeline.run(media_items)
+        if pipeline.stages[0].stats['items_out'] == 0:
+            structured_log('No unprocessed image found for {}-{}-{}'.format(year, month, day))
+        structured_log('Uploaded {} faces of {} images, {} failed'.format(len(uploader.created), len(done_file_names), len(uploader.failed)))
+    dedup_index.flush()
+    dedup_index.log_stats()
+    structured_log('Manifest {}: {}'.format(manifest.manifest_file_name, json.dumps(manifest.summary())))
+    pipeline_metrics.log_summary('{}-{}-{}'.format(year, month, day))
+    return manifest
+
+
+def process_day_before_deadline(year, month, day, dry_run=False, scheduler=None, publisher=None, continuation=0, helper=None):
+    '''
+    Processes a day page by page, in chunks that fit into the time left before the function is killed.
+    When the next chunk would not fit, the position is saved to a ContinuationCursor and a follow-up message
+    is published that resumes the day in a new invocation.
+    Args:
+        scheduler: DeadlineScheduler of this invocation, one started now if None
+        publisher: PubSubPublisher or LocalPublisher for the follow-up, a PubSubPublisher if None
+        continuation: int, how many invocations came before this one for the day
+        helper: GooglePhotoHelper to reuse, a new one is created if None
+    returns:
+        True if the day is done, False if a follow-up was published
+    '''
+    storage_helper = GoogleStorageHelper(TEST_BUCKET_NAME)
+    if scheduler is None:
+        scheduler = DeadlineScheduler()
+    scheduler.load_from_bucket(storage_helper)
+    cursor = ContinuationCursor.for_day(storage_helper, year, month, day)
+    if helper is None:
+        helper = GooglePhotoHelper()
+    # shared by all chunks of the invocation
+    album_id = upsert_face_album(helper)
+    manifest = ProcessingManifest.for_day(storage_helper, year, month, day)
+    dedup_index = ContentDedupIndex(storage_helper)
+    try:
+        with FaceCropEngine() as crop_engine:
+            for page_token, items in helper.iter_media_item_pages(day_search_payload(year, month, day, FACE_MEDIA_TYPES), cursor.page_token):
+                cursor.start_page(page_token)
+                remaining_items = [item for item in items if item['id'] not in cursor.completed_item_ids]
+                while remaining_items:
+                    chunk_size = scheduler.next_chunk_size()
+                    if chunk_size == 0:
+                        cursor.continuation = continuation + 1
+                        cursor.save()
+                        structured_log('Stopping {}-{}-{} with {:.0f}s left at {:.1f}s per item'.format(year, month, day, scheduler.remaining(), scheduler.seconds_per_item))
+                        message = follow_up_message({'year': year, 'month': month, 'day': day}, dry_run, cursor.continuation)
+                        if message is not None:
+                            (publisher or PubSubPublisher()).publish(message)
+                        return False
+                    chunk = remaining_items[:chunk_size]
+                    remaining_items = remaining_items[chunk_size:]
+                    started_at = time.monotonic()
+                    face_image_generation_for_google_photo(year, month, day, dry_run=dry_run, media_items=chunk, helper=helper,
+                                                           annotation_timeout=min(ANNOTATION_TIMEOUT_SECONDS, max(scheduler.remaining(), 1)),
+                                                           album_id=album_id, manifest=manifest, dedup_index=dedup_index, crop_engine=crop_engine)
+                    scheduler.record(len(chunk), time.monotonic() - started_at)
+                    # failed items stay unfinished in the manifest, the next run of the day retries them
+                    cursor.complete(item['id'] for item in chunk)
+        cursor.clear()
+        return True
+    finally:
+        scheduler.save_to_bucket(storage_helper)
+
+
+def process_new_media_items(dry_run=False, scheduler=None, publisher=None, continuation=0, helper=None, today=None):
+    '''
+    Processes the photos of the lookback window that no earlier run handled, see IncrementalDiscovery,
+    so photos that reached the library after their day was processed are picked up as well.
+    Only new photos are downloaded and annotated, listing the window costs one request per 100 photos, plus a search
+    of each day around the new ones to process them under the same day, and manifest, as the daily runs.
+    Like process_day_before_deadline, it stops before the deadline and publishes a follow-up, which resumes with
+    the items still missing from the seen set.
+    Args:
+        today: datetime.date, end of the window, date.today() if None
+        see process_day_before_deadline for the other args
+    returns:
+        True if the window is done, False if a follow-up was published
+    '''
+    storage_helper = GoogleStorageHelper(TEST_BUCKET_NAME)
+    if scheduler is None:
+        scheduler = DeadlineScheduler()
+    scheduler.load_from_bucket(storage_helper)
+    if helper is None:
+        helper = GooglePhotoHelper()
+    discovery = IncrementalDiscovery(storage_helper)
+    start_date, end_date = discovery.window(today or date.today())
+    # id -> media item of the new items no day search returned yet
+    new_items = {}
+    days = set()
+    for item in helper.search_media_items_by_date_range(start_date, end_date, FACE_MEDIA_TYPES, prefetch=True):
+        if item['filename'].startswith(FACE_IMAGE_FILE_PREFIX) or discovery.is_seen(item['id']):
+            continue
+        new_items[item['id']] = item
+        days.update(candidate_days(item, start_date, end_date))
+    structured_log('Found {} new photos between {} and {}, {} days to search'.format(len(new_items), start_date, end_date, len(days)))
+    # shared by all chunks of the invocation
+    album_id = upsert_face_album(helper)
+    dedup_index = ContentDedupIndex(storage_helper)
+    try:
+        with FaceCropEngine() as crop_engine:
+            for day in sorted(days):
+                if not new_items:
+                    break
+                # the day is searched to file each item under the day the daily runs key their manifests by,
+                # the local day it was taken, which the UTC creationTime does not tell
+                items = [item for item in helper.search_media_items_by_day(day.year, day.month, day.day, FACE_MEDIA_TYPES, prefetch=True) if item['id'] in new_items]
+                for item in items:
+                    new_items.pop(item['id'], None)
+                manifest = ProcessingManifest.for_day(storage_helper, day.year, day.month, day.day)
+                # items a daily run already handled only join the seen set
+                for item in items:
+                    if manifest.reached(item['id'], STAGE_FACES_UPLOADED):
+                        discovery.add(item['id'], day)
+                items = [item for item in items if not manifest.reached(item['id'], STAGE_FACES_UPLOADED)]
+                while items:
+                    chunk_size = scheduler.next_chunk_size()
+                    if chunk_size == 0:
+                        if not dry_run:
+                            discovery.save()
+                        structured_log('Stopping discovery with {:.0f}s left at {:.1f}s per item'.format(scheduler.remaining(), scheduler.seconds_per_item))
+                        message = follow_up_message({'incremental': True}, dry_run, continuation + 1)
+                        if message is not None:
+                            (publisher or PubSubPublisher()).publish(message)
+                        return False
+                    chunk, items = items[:chunk_size], items[chunk_size:]
+                    started_at = time.monotonic()
+                    face_image_generation_for_google_photo(day.year, day.month, day.day, dry_run=dry_run, media_items=chunk, helper=helper,
+                                                           annotation_timeout=min(ANNOTATION_TIMEOUT_SECONDS, max(scheduler.remaining(), 1)),
+                                                           album_id=album_id, manifest=manifest, dedup_index=dedup_index, crop_engine=crop_engine)
+                    scheduler.record(len(chunk), time.monotonic() - started_at)
+                    # failed items stay out of the seen set, so the next run tries them again
+                    for item in chunk:
+                        if manifest.reached(item['id'], STAGE_FACES_UPLOADED):
+                            discovery.add(item['id'], day)
+        # searching the same days again would not find them either, they would be listed and searched on every run
+        for item_id, item in new_items.items():
+            structured_log('{} ({}) was not found by the search of any day around {}, skipped'.format(
+                item['filename'], item_id, item['mediaMetadata']['creationTime']), severity=LogSeverity.WARNING)
+            # kept until no window can list it again, its local day is at most the day after its UTC day
+            discovery.add(item_id, creation_day(item) + timedelta(days=1))
+        discovery.finish(start_date, end_date)
+        if not dry_run:
+            discovery.save()
+        return True
+    finally:
+        scheduler.save_to_bucket(storage_helper)
 
 
 # Triggered from a message on a Cloud Pub/Sub topic.
 @functions_framework.cloud_event
 def main(cloud_event: CloudEvent):
+    '''
+    Accepts {"days_past": n, "dry_run": b} and {"incremental": true, "dry_run": b} from the scheduler,
+    and the follow-ups of runs that ran out of time, see process_day_before_deadline and process_new_media_items
+    '''
+    # the timeout counts from the start of the invocation
+    scheduler = DeadlineScheduler()
     structured_log("=================== PROCESS START FOR" + base64.b64decode(cloud_event.data["message"]["data"]).decode() + '=====================')
-    msg_json = json.loads(base64.b64decode(cloud_event.data["message"]["data"]).decode())
-    days_past = msg_json['days_past']
+    try:
+        msg_json = json.loads(base64.b64decode(cloud_event.data["message"]["data"]).decode())
+        process_message(msg_json, scheduler)
+        structured_log("=================== PROCESS END FOR" + base64.b64decode(cloud_event.data["message"]["data"]).decode() + '=====================')
+    finally:
+        # a failed invocation is the one whose latencies and logs matter most
+        try:
+            http_transport.log_latency_report()
+            get_content_cache().log_stats()
+        finally:
+            flush_logs()
+
+
+def process_message(msg_json, scheduler, publisher=None):
     dry_run = msg_json['dry_run']
-    target_day = datetime.now() - timedelta(days=days_past)
-    year = target_day.year
-    month = target_day.month
-    day = target_day.day
-    face_image_generation_for_google_photo(year, month, day, dry_run=dry_run)
-    structured_log("=================== PROCESS END FOR" + base64.b64decode(cloud_event.data["message"]["data"]).decode() + '=====================')
-
-
-def batch_process_photo(year, month, day):
-    # batch process photo
-    cur_date = datetime(year, month, day)
-    while cur_date < datetime(2022, 10, 10):
-        face_image_generation_for_google_photo(cur_date.year, cur_date.month, cur_date.day)
-        cur_date += timedelta(days=1)
+    if msg_json.get('incremental'):
+        return process_new_media_items(dry_run=dry_run, scheduler=scheduler, publisher=publisher, continuation=msg_json.get('continuation', 0))
+    if 'days_past' in msg_json:
+        target_day = datetime.now() - timedelta(days=msg_json['days_past'])
+        year, month, day = target_day.year, target_day.month, target_day.day
+        continuation = 0
+    else:
+        year, month, day = msg_json['year'], msg_json['month'], msg_json['day']
+        continuation = msg_json['continuation']
+    return process_day_before_deadline(year, month, day, dry_run=dry_run, scheduler=scheduler, publisher=publisher, continuation=continuation)
+
+
+def run_with_local_continuations(msg_json, budget_seconds=None):
+    '''
+    Runs a message like main does, with follow-ups queued in memory instead of Pub/Sub and run right after,
+    each with a fresh deadline. A small budget_seconds makes a day take several continuations, e.g. for testing
+    '''
+    publisher = LocalPublisher()
+    publisher.messages.append(msg_json)
+    while publisher.messages:
+        message = publisher.messages.popleft()
+        scheduler = DeadlineScheduler() if budget_seconds is None else DeadlineScheduler(budget_seconds)
+        process_message(message, scheduler, publisher)
+
+
+def batch_process_photo(year, month, day, end_date=None, workers=4):
+    # batch process photo from the given day up to, but excluding, end_date (today by default)
+    # backfill imports this module for its workers, so it is imported here
+    from backfill import backfill
+    end_date = end_date or date.today()
+    backfill(date(year, month, day), end_date - timedelta(days=1), workers=workers)
 
 def test_main():
     msg = {
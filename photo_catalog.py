@@ -0,0 +1,280 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import date, timedelta
+
+from google_logging import structured_log
+
+CATALOG_FILE_NAME = 'catalog/photo_catalog.sqlite'
+# the api can only filter by creation date, so every sync looks this far behind the last one
+# to pick up photos that were uploaded a while after they were taken
+SYNC_OVERLAP_DAYS = int(os.environ.get('CATALOG_SYNC_OVERLAP_DAYS', 7))
+MEDIA_TYPES = ['PHOTO', 'VIDEO']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS albums (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    media_items_count INTEGER NOT NULL DEFAULT 0,
+    -- media_items_count at the time album_items were last listed, -1 if never
+    synced_items_count INTEGER NOT NULL DEFAULT -1
+);
+CREATE INDEX IF NOT EXISTS albums_title ON albums (title);
+CREATE TABLE IF NOT EXISTS media_items (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    creation_time TEXT NOT NULL,
+    mime_type TEXT,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS media_items_creation_time ON media_items (creation_time);
+CREATE INDEX IF NOT EXISTS media_items_filename ON media_items (filename);
+CREATE TABLE IF NOT EXISTS album_items (
+    album_id TEXT NOT NULL,
+    media_item_id TEXT NOT NULL,
+    PRIMARY KEY (album_id, media_item_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS album_items_media_item_id ON album_items (media_item_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+def media_item_row(item):
+    metadata = item.get('mediaMetadata', {})
+    return (
+        item['id'],
+        item['filename'],
+        metadata.get('creationTime', ''),
+        item.get('mimeType'),
+        int(metadata['width']) if 'width' in metadata else None,
+        int(metadata['height']) if 'height' in metadata else None,
+    )
+
+
+class PhotoCatalog:
+    '''
+    Local SQLite catalog of the albums and media items of the library, so that album lookups and date queries
+    are index lookups instead of paginated api scans. It is brought up to date incrementally with sync.
+    The catalog can live in a local file, or in the bucket with from_bucket and save_to_bucket.
+    '''
+
+    def __init__(self, db_path, temp_dir=None):
+        '''
+        Args:
+            db_path: string, path of the SQLite file, created if missing
+            temp_dir: string, directory owned by the catalog, removed with everything in it on close
+        '''
+        self.db_path = db_path
+        self.temp_dir = temp_dir
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        self.storage_helper = None
+        self.bucket_file_name = None
+
+    @classmethod
+    def from_bucket(cls, storage_helper, file_name=CATALOG_FILE_NAME, db_path=None):
+        '''
+        Opens a local copy of the catalog stored in a bucket, an empty catalog if there is none yet
+        Args:
+            storage_helper: GoogleStorageHelper of the bucket
+            file_name: string, name of the catalog in the bucket
+            db_path: string, path of the local copy, a temporary file removed on close if None
+        '''
+        temp_dir = None
+        if db_path is None:
+            # /tmp of a Cloud Function is held in memory, so the copy must not outlive the catalog
+            temp_dir = tempfile.mkdtemp()
+            db_path = os.path.join(temp_dir, os.path.basename(file_name))
+        try:
+            if storage_helper.file_exists(file_name):
+                with open(db_path, 'wb') as f:
+                    f.write(storage_helper.read_file_from_google_cloud_to_bytes(file_name))
+            catalog = cls(db_path, temp_dir)
+        except BaseException:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        catalog.storage_helper = storage_helper
+        catalog.bucket_file_name = file_name
+        return catalog
+
+    def save_to_bucket(self):
+        '''
+        Uploads the catalog back to the bucket it was opened from
+        '''
+        self.connection.commit()
+        # a consistent snapshot, even while the connection stays open
+        snapshot_path = self.db_path + '.snapshot'
+        with sqlite3.connect(snapshot_path) as snapshot:
+            self.connection.backup(snapshot)
+        snapshot.close()
+        try:
+            with open(snapshot_path, 'rb') as f:
+                self.storage_helper.upload_string_content_to_google_cloud(f.read(), self.bucket_file_name, 'application/vnd.sqlite3')
+        finally:
+            os.remove(snapshot_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self.connection.commit()
+            self.connection.close()
+        finally:
+            if self.temp_dir is not None:
+                shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _get_state(self, key):
+        row = self.connection.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row is not None else None
+
+    def _set_state(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    def upsert_albums(self, albums):
+        '''
+        Args:
+            albums: iterable of album dicts from the api
+        '''
+        self.connection.executemany(
+            'INSERT INTO albums (id, title, media_items_count) VALUES (?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET title = excluded.title, media_items_count = excluded.media_items_count',
+            ((album['id'], album['title'], int(album.get('mediaItemsCount', 0))) for album in albums))
+        self.connection.commit()
+
+    def remove_album(self, album_id):
+        '''
+        Forgets an album that no longer exists in the library, together with its items
+        '''
+        with self.connection:
+            self.connection.execute('DELETE FROM album_items WHERE album_id = ?', (album_id,))
+            self.connection.execute('DELETE FROM albums WHERE id = ?', (album_id,))
+
+    def upsert_media_items(self, items):
+        '''
+        Args:
+            items: iterable of media item dicts from the api
+        returns: number of items written
+        '''
+        cursor = self.connection.executemany(
+            'INSERT OR REPLACE INTO media_items (id, filename, creation_time, mime_type, width, height) VALUES (?, ?, ?, ?, ?, ?)',
+            (media_item_row(item) for item in items))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def sync_albums(self, photo_helper):
+        '''
+        Replaces the albums with the current album list, one cheap api scan since albums come 50 per page
+        '''
+        albums = list(photo_helper.iter_albums())
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS current_albums (id TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM current_albums')
+            self.connection.executemany('INSERT OR IGNORE INTO current_albums (id) VALUES (?)', ((album['id'],) for album in albums))
+            self.connection.execute('DELETE FROM album_items WHERE album_id NOT IN (SELECT id FROM current_albums)')
+            self.connection.execute('DELETE FROM albums WHERE id NOT IN (SELECT id FROM current_albums)')
+        self.upsert_albums(albums)
+        structured_log('Catalog has {} albums'.format(len(albums)))
+
+    def sync_media_items(self, photo_helper, full=False, today=None):
+        '''
+        Lists the media items created since the last sync, minus SYNC_OVERLAP_DAYS, the whole library on the first sync
+        Args:
+            photo_helper: GooglePhotoHelper
+            full: boolean, whether to list the whole library again
+            today: datetime.date, last day to list, date.today() if None
+        '''
+        today = today or date.today()
+        synced_until = self._get_state('media_items_synced_until')
+        if full or synced_until is None:
+            items = photo_helper.iter_media_items({}, prefetch=True)
+        else:
+            start_date = date.fromisoformat(synced_until) - timedelta(days=SYNC_OVERLAP_DAYS)
+            items = photo_helper.search_media_items_by_date_range(start_date, today, MEDIA_TYPES, prefetch=True)
+        count = self.upsert_media_items(items)
+        self._set_state('media_items_synced_until', today.isoformat())
+        self.connection.commit()
+        structured_log('Catalog synced {} media items up to {}'.format(count, today))
+
+    def sync_album_items(self, photo_helper):
+        '''
+        Lists the items of the albums whose item count changed since they were last listed
+        '''
+        stale_albums = self.connection.execute(
+            'SELECT id, media_items_count FROM albums WHERE synced_items_count != media_items_count').fetchall()
+        for album in stale_albums:
+            items = list(photo_helper.iter_media_items({'albumId': album['id']}, prefetch=True))
+            self.upsert_media_items(items)
+            with self.connection:
+                self.connection.execute('DELETE FROM album_items WHERE album_id = ?', (album['id'],))
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO album_items (album_id, media_item_id) VALUES (?, ?)',
+                    ((album['id'], item['id']) for item in items))
+                self.connection.execute('UPDATE albums SET synced_items_count = ? WHERE id = ?', (album['media_items_count'], album['id']))
+        structured_log('Catalog listed the items of {} changed albums'.format(len(stale_albums)))
+
+    def sync(self, photo_helper, full=False):
+        '''
+        Brings albums, media items and album membership up to date
+        '''
+        self.sync_albums(photo_helper)
+        self.sync_media_items(photo_helper, full=full)
+        self.sync_album_items(photo_helper)
+        if self.storage_helper is not None:
+            self.save_to_bucket()
+
+    def find_albums_by_name(self, album_name):
+        '''
+        returns: list of album dicts with id, title and mediaItemsCount, like the api returns them
+        '''
+        rows = self.connection.execute('SELECT id, title, media_items_count FROM albums WHERE title = ?', (album_name,))
+        return [{'id': row['id'], 'title': row['title'], 'mediaItemsCount': str(row['media_items_count'])} for row in rows]
+
+    def _media_items(self, query, params):
+        return [dict(row) for row in self.connection.execute(query, params)]
+
+    def media_items_by_date_range(self, start_date, end_date):
+        '''
+        Args:
+            start_date: datetime.date, first day
+            end_date: datetime.date, last day, inclusive
+        returns: list of media item dicts with id, filename, creation_time, mime_type, width and height, oldest first
+        '''
+        return self._media_items(
+            'SELECT * FROM media_items WHERE creation_time >= ? AND creation_time < ? ORDER BY creation_time',
+            (start_date.isoformat(), (end_date + timedelta(days=1)).isoformat()))
+
+    def media_items_by_filename(self, filename):
+        return self._media_items('SELECT * FROM media_items WHERE filename = ?', (filename,))
+
+    def media_items_in_album(self, album_id):
+        return self._media_items(
+            'SELECT media_items.* FROM album_items JOIN media_items ON media_items.id = album_items.media_item_id '
+            'WHERE album_items.album_id = ? ORDER BY media_items.creation_time', (album_id,))
+
+    def albums_of_media_item(self, media_item_id):
+        rows = self.connection.execute(
+            'SELECT albums.id, albums.title FROM album_items JOIN albums ON albums.id = album_items.album_id '
+            'WHERE album_items.media_item_id = ?', (media_item_id,))
+        return [dict(row) for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync the local catalog of albums and media items')
+    parser.add_argument('db_path', help='path of the SQLite catalog, e.g. photo_catalog.sqlite')
+    parser.add_argument('--full', action='store_true', help='list the whole library again')
+    args = parser.parse_args()
+    from google_photo_api import GooglePhotoHelper
+    with PhotoCatalog(args.db_path) as catalog:
+        catalog.sync(GooglePhotoHelper(), full=args.full)
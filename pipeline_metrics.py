@@ -0,0 +1,176 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from google_logging import structured_log, LogSeverity
+
+# the stages of a run, in pipeline order, the summary lists them in this order
+STAGES = ('list', 'download', 'video', 'gcs_upload', 'vision', 'crop', 'photos_upload')
+# one DEBUG entry per span, off by default since a run has thousands of them
+TRACE_SPANS = os.environ.get('TRACE_SPANS', '0') == '1'
+# span durations kept per stage for percentiles, later spans only count to the totals
+MAX_DURATION_SAMPLES = 10000
+
+
+class StageStats:
+    '''
+    Accumulated work of a stage over a run
+    '''
+
+    def __init__(self):
+        self.spans = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.durations = []
+
+    def percentile(self, fraction):
+        if not self.durations:
+            return 0.0
+        durations = sorted(self.durations)
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    def as_dict(self):
+        return {
+            'spans': self.spans,
+            'seconds': round(self.seconds, 3),
+            'max_seconds': round(self.max_seconds, 3),
+            'p50_seconds': round(self.percentile(0.5), 3),
+            'p99_seconds': round(self.percentile(0.99), 3),
+            'items': self.items,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'errors': self.errors,
+        }
+
+
+class Span:
+    '''
+    A timed piece of work of a stage, see span
+    '''
+
+    def __init__(self, stage, items=0, bytes=0):
+        self.stage = stage
+        self.items = items
+        self.bytes = bytes
+        self.retries = 0
+
+    def add(self, items=0, bytes=0):
+        self.items += items
+        self.bytes += bytes
+
+
+_lock = threading.Lock()
+_stages = {}
+_local = threading.local()
+_run_started = time.monotonic()
+
+
+def peak_memory_mb():
+    '''
+    returns: the peak resident memory of this process so far, in MiB
+    '''
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def record(stage, seconds=0.0, items=0, bytes=0, retries=0, errors=0):
+    '''
+    Adds work to a stage that was not measured with span, e.g. because it ran in another process
+    '''
+    with _lock:
+        stats = _stages.setdefault(stage, StageStats())
+        stats.spans += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.items += items
+        stats.bytes += bytes
+        stats.retries += retries
+        stats.errors += errors
+        if len(stats.durations) < MAX_DURATION_SAMPLES:
+            stats.durations.append(seconds)
+
+
+@contextmanager
+def span(stage, items=0, bytes=0, **fields):
+    '''
+    Times a piece of work of a stage, e.g.
+        with span('download') as s:
+            content = http_transport.get(url).content
+            s.add(items=1, bytes=len(content))
+    Retries made by http_transport inside the span are counted to it, an exception counts as an error.
+    fields: additional fields of the span entry logged when TRACE_SPANS is on
+    '''
+    current = Span(stage, items, bytes)
+    parent = getattr(_local, 'span', None)
+    _local.span = current
+    start = time.monotonic()
+    error = False
+    try:
+        yield current
+    except Exception:
+        error = True
+        raise
+    finally:
+        _local.span = parent
+        seconds = time.monotonic() - start
+        record(stage, seconds, current.items, current.bytes, current.retries, int(error))
+        if TRACE_SPANS:
+            structured_log('span {}'.format(stage), severity=LogSeverity.DEBUG, stage=stage, duration_ms=round(seconds * 1000, 1),
+                           items=current.items, bytes=current.bytes, retries=current.retries, error=error, **fields)
+
+
+def add_retry():
+    '''
+    Counts a retry to the innermost span of the calling thread, if there is one
+    '''
+    current = getattr(_local, 'span', None)
+    if current is not None:
+        current.retries += 1
+
+
+def summary():
+    '''
+    returns: dict of stage name -> accumulated stats, pipeline stages first
+    '''
+    with _lock:
+        names = [stage for stage in STAGES if stage in _stages] + sorted(set(_stages) - set(STAGES))
+        return {stage: _stages[stage].as_dict() for stage in names}
+
+
+def log_summary(label=''):
+    '''
+    Logs a single line with the stats of every stage since the last reset, then resets them.
+    Memory is only reported for the whole process, stages overlap and ru_maxrss cannot be told apart between them.
+    returns: the logged stats, see summary
+    '''
+    stages = summary()
+    wall_seconds = time.monotonic() - _run_started
+    text = ' | '.join(
+        '{} {:.1f}s {} items {:.1f} MiB {} retries'.format(stage, stats['seconds'], stats['items'], stats['bytes'] / (1024 * 1024), stats['retries'])
+        for stage, stats in stages.items())
+    structured_log('Stage summary {} ({:.1f}s, peak {:.0f} MiB): {}'.format(label, wall_seconds, peak_memory_mb(), text),
+                   severity=LogSeverity.INFO, stages=stages, wall_seconds=round(wall_seconds, 3), peak_memory_mb=round(peak_memory_mb(), 1))
+    reset()
+    return stages
+
+
+def reset():
+    global _run_started
+    with _lock:
+        _stages.clear()
+        _run_started = time.monotonic()
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    reset()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
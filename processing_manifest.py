@@ -0,0 +1,127 @@
+import json
+import threading
+
+from google_logging import structured_log, LogSeverity
+
+MANIFEST_FILE_PREFIX = 'manifests/'
+
+# stages an item goes through, in order
+STAGE_SEEN = 0
+STAGE_COPIED = 1
+STAGE_ANNOTATED = 2
+STAGE_FACES_UPLOADED = 3
+STAGE_NAMES = {STAGE_COPIED: 'copied', STAGE_ANNOTATED: 'annotated', STAGE_FACES_UPLOADED: 'faces_uploaded'}
+
+
+class ProcessingManifest:
+    '''
+    Records per media item id how far it went through the pipeline, so that reruns skip finished work.
+    The manifest is a single json file in the bucket, loaded once and written back in batches:
+    {"items": {media_item_id: [stage, file_name, annotation_result_file_name, annotation_scale]}}
+    annotation_scale is null if the bucket holds the original, or the original pixels per pixel of the scaled copy
+    the bucket holds instead, see ANNOTATION_INPUT_MAX_SIZE. Entries written before it was recorded have 3 fields.
+    Updates may come from several threads at once.
+    '''
+
+    def __init__(self, storage_helper, manifest_file_name, flush_every=100):
+        '''
+        Args:
+            storage_helper: GoogleStorageHelper of the bucket holding the manifest
+            manifest_file_name: string, name of the manifest file in the bucket
+            flush_every: int, number of updates after which the manifest is written back
+        '''
+        self.storage_helper = storage_helper
+        self.manifest_file_name = manifest_file_name
+        self.flush_every = flush_every
+        self.items = {}
+        self.item_id_by_file_name = {}
+        self.unsaved_updates = 0
+        self.lock = threading.RLock()
+        if storage_helper.file_exists(manifest_file_name):
+            self.items = json.loads(storage_helper.read_file_from_google_cloud_to_string(manifest_file_name))['items']
+            self.item_id_by_file_name = {entry[1]: item_id for item_id, entry in self.items.items()}
+        structured_log('Loaded manifest {} with {} items'.format(manifest_file_name, len(self.items)))
+
+    @classmethod
+    def for_day(cls, storage_helper, year, month, day):
+        return cls(storage_helper, f'{MANIFEST_FILE_PREFIX}{year}_{month}_{day}.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def stage(self, item_id):
+        '''
+        returns: the last stage the item reached, 0 if it was never processed
+        '''
+        entry = self.items.get(item_id)
+        return entry[0] if entry is not None else 0
+
+    def reached(self, item_id, stage):
+        return self.stage(item_id) >= stage
+
+    def file_reached(self, file_name, stage):
+        item_id = self.item_id_by_file_name.get(file_name)
+        return item_id is not None and self.reached(item_id, stage)
+
+    def annotation_result_file(self, file_name):
+        item_id = self.item_id_by_file_name.get(file_name)
+        return self.items[item_id][2] if item_id is not None else None
+
+    def annotation_scale(self, item_id, default=None):
+        '''
+        returns: the scale of the copy in the bucket, None if the bucket holds the original or the item is not there,
+        default for entries written before the scale was recorded
+        '''
+        entry = self.items.get(item_id)
+        if entry is None:
+            return None
+        return entry[3] if len(entry) > 3 else default
+
+    def mark(self, item_id, file_name, stage, annotation_result_file_name=None, annotation_scale=None):
+        '''
+        Records that an item reached a stage, stages never go backwards
+        '''
+        with self.lock:
+            entry = self.items.get(item_id, [0, file_name, None, None])
+            self.items[item_id] = [
+                max(entry[0], stage),
+                file_name,
+                annotation_result_file_name if annotation_result_file_name is not None else entry[2],
+                annotation_scale if annotation_scale is not None else (entry[3] if len(entry) > 3 else None),
+            ]
+            self.item_id_by_file_name[file_name] = item_id
+            self.unsaved_updates += 1
+            if self.unsaved_updates >= self.flush_every:
+                self.flush()
+
+    def mark_file(self, file_name, stage, annotation_result_file_name=None):
+        '''
+        Same as mark, for items known by their file name in the bucket
+        '''
+        item_id = self.item_id_by_file_name.get(file_name)
+        if item_id is None:
+            structured_log('{} is not in manifest {}'.format(file_name, self.manifest_file_name), severity=LogSeverity.WARNING)
+            return
+        self.mark(item_id, file_name, stage, annotation_result_file_name)
+
+    def flush(self):
+        '''
+        Writes the manifest back to the bucket if anything changed
+        '''
+        with self.lock:
+            if self.unsaved_updates == 0:
+                return
+            # uploads stay in order, so an older snapshot never overwrites a newer one
+            self.storage_helper.upload_string_content_to_google_cloud(
+                json.dumps({'items': self.items}, separators=(',', ':')), self.manifest_file_name, 'application/json')
+            self.unsaved_updates = 0
+
+    def summary(self):
+        counts = {name: 0 for name in STAGE_NAMES.values()}
+        for entry in self.items.values():
+            if entry[0] in STAGE_NAMES:
+                counts[STAGE_NAMES[entry[0]]] += 1
+        return counts
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from google_logging import structured_log, LogSeverity
+
+# items waiting between two stages, a full queue holds back the stage feeding it
+STAGE_QUEUE_SIZE = int(os.environ.get('STAGE_QUEUE_SIZE', 64))
+
+# marks the end of the items in a queue
+_DONE = object()
+# how often an emit blocked on a full queue checks whether the pipeline was stopped
+EMIT_POLL_SECONDS = 1.0
+
+
+class PipelineStopped(Exception):
+    '''
+    Raised by emit in a stage that is still running when its pipeline stopped
+    '''
+
+
+class Stage:
+    '''
+    A step of a StagedPipeline: a blocking function that turns an item, or a batch of items, into any number of
+    items for the next stage. It runs in a thread, in up to concurrency calls at a time.
+    '''
+
+    def __init__(self, name, func, concurrency=1, batch_size=1, batch_wait_seconds=0.0, emits=False):
+        '''
+        Args:
+            name: string, name of the stage in logs
+            func: callable taking an item, or a list of items if batch_size > 1, returning an iterable of items
+                for the next stage, or None for none
+            concurrency: int, number of calls of func running at the same time
+            batch_size: int, if > 1, func gets lists of up to batch_size items
+            batch_wait_seconds: float, how long a batch that is not full waits for more items
+            emits: boolean, if True, func is called with an emit callable as second argument instead, and hands
+                each item for the next stage to it as soon as it is ready, so that the next stage starts on it while
+                func is still working. emit blocks while the next stage is full, func returns None
+        '''
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.emits = emits
+        self.stats = {'items_in': 0, 'items_out': 0, 'calls': 0, 'errors': 0, 'busy_seconds': 0.0}
+
+
+class StagedPipeline:
+    '''
+    Runs items through a chain of stages that all work at the same time, connected by bounded queues.
+    An item moves on as soon as its stage is done with it, so the network bound stages keep going while
+    the CPU bound ones work, and the wall time of a run approaches that of its slowest stage instead of
+    the sum of all stages. A stage that falls behind fills its input queue, which holds back the stages before it.
+    A call that raises is logged and its items are dropped, the other items carry on.
+    '''
+
+    def __init__(self, stages, queue_size=STAGE_QUEUE_SIZE):
+        '''
+        Args:
+            stages: list of Stage, in pipeline order
+            queue_size: int, max number of items waiting in front of each stage
+        '''
+        self.stages = stages
+        self.queue_size = queue_size
+        # set once the loop stops, so that stages blocked in emit give up
+        self.stopped = threading.Event()
+
+    def run(self, items):
+        '''
+        Runs all items through the stages and blocks until the last stage is done
+        Args:
+            items: iterable of items for the first stage, consumed in a thread so it may block, e.g. on paging
+        returns: list of the items coming out of the last stage
+        '''
+        started_at = time.monotonic()
+        self.stopped.clear()
+        loop = asyncio.new_event_loop()
+        # one thread per concurrent call, plus the one reading the input
+        executor = ThreadPoolExecutor(max_workers=sum(stage.concurrency for stage in self.stages) + 1)
+        try:
+            results = loop.run_until_complete(self._run(loop, executor, items))
+        finally:
+            self.stopped.set()
+            executor.shutdown()
+            loop.close()
+        self.log_stats(time.monotonic() - started_at)
+        return results
+
+    async def _run(self, loop, executor, items):
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        results = []
+        tasks = [loop.create_task(self._feed(loop, executor, iter(items), queues[0], self.stages[0].concurrency))]
+        for i, stage in enumerate(self.stages):
+            output_queue = queues[i + 1] if i + 1 < len(queues) else None
+            consumers = self.stages[i + 1].concurrency if output_queue is not None else 0
+            workers = [loop.create_task(self._work(loop, executor, stage, queues[i], output_queue, results))
+                       for _ in range(stage.concurrency)]
+            tasks.append(loop.create_task(self._close_when_done(workers, output_queue, consumers)))
+            tasks.extend(workers)
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return results
+
+    async def _feed(self, loop, executor, iterator, queue, consumers):
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, _DONE)
+            if item is _DONE:
+                break
+            await queue.put(item)
+        for _ in range(consumers):
+            await queue.put(_DONE)
+
+    async def _close_when_done(self, workers, output_queue, consumers):
+        await asyncio.gather(*workers)
+        for _ in range(consumers):
+            await output_queue.put(_DONE)
+
+    async def _next_batch(self, stage, queue):
+        item = await queue.get()
+        if item is _DONE:
+            return None, True
+        batch = [item]
+        deadline = time.monotonic() + stage.batch_wait_seconds
+        while len(batch) < stage.batch_size:
+            if not queue.empty():
+                item = queue.get_nowait()
+            else:
+                wait_seconds = deadline - time.monotonic()
+                if wait_seconds <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), wait_seconds)
+                except asyncio.TimeoutError:
+                    break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _work(self, loop, executor, stage, input_queue, output_queue, results):
+        done = False
+        while not done:
+            if stage.batch_size > 1:
+                batch, done = await self._next_batch(stage, input_queue)
+                if batch is None:
+                    break
+                args, count = batch, len(batch)
+            else:
+                args = await input_queue.get()
+                if args is _DONE:
+                    break
+                count = 1
+            stage.stats['items_in'] += count
+            stage.stats['calls'] += 1
+            started_at = time.monotonic()
+            if stage.emits:
+                call = functools.partial(stage.func, args, functools.partial(self._emit_threadsafe, loop, stage, output_queue, results))
+            else:
+                call = functools.partial(stage.func, args)
+            try:
+                outputs = await loop.run_in_executor(executor, call)
+            except Exception as e:
+                stage.stats['errors'] += 1
+                structured_log('Stage {} failed on {} items: {!r}'.format(stage.name, count, e), severity=LogSeverity.ERROR)
+                outputs = None
+            stage.stats['busy_seconds'] += time.monotonic() - started_at
+            for output in outputs or ():
+                await self._emit(stage, output_queue, results, output)
+
+    async def _emit(self, stage, output_queue, results, output):
+        stage.stats['items_out'] += 1
+        if output_queue is None:
+            results.append(output)
+        else:
+            await output_queue.put(output)
+
+    def _emit_threadsafe(self, loop, stage, output_queue, results, output):
+        '''
+        The emit of a stage with emits=True, called from the thread of the stage
+        '''
+        future = asyncio.run_coroutine_threadsafe(self._emit(stage, output_queue, results, output), loop)
+        while True:
+            try:
+                return future.result(EMIT_POLL_SECONDS)
+            except FutureTimeoutError:
+                if self.stopped.is_set():
+                    future.cancel()
+                    raise PipelineStopped(stage.name)
+
+    def log_stats(self, wall_seconds):
+        text = ' | '.join('{} {} in {} out {:.1f}s busy x{}'.format(
+            stage.name, stage.stats['items_in'], stage.stats['items_out'], stage.stats['busy_seconds'], stage.concurrency)
+            for stage in self.stages)
+        structured_log('Pipeline done in {:.1f}s: {}'.format(wall_seconds, text), severity=LogSeverity.INFO,
+                       stages={stage.name: dict(stage.stats, busy_seconds=round(stage.stats['busy_seconds'], 3)) for stage in self.stages})
@@ -0,0 +1,26 @@
+import io
+import json
+
+import pytest
+
+from vision_batch import iter_json_array_items
+
+DOCUMENTS = [
+    {'responses': []},
+    {'responses': [12.5, -0.25, 1e3, 2.5E-7, -4e+2, 0, 10, 100.0]},
+    {'responses': [{'faceAnnotations': [{'detectionConfidence': 0.987, 'rollAngle': -12.5e-1}]}, {}], 'context': {'uri': 'gs://b/ä.jpg'}},
+    {'other': [1.5, {'x': 'y'}], 'responses': [True, False, None, 'text', [1, [2.0]]], 'after': 3.25},
+    {},
+]
+
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1024])
+def test_items_match_json_loads(document, chunk_size):
+    content = json.dumps(document, ensure_ascii=False).encode('utf-8')
+    items = list(iter_json_array_items(io.BytesIO(content), 'responses', chunk_size=chunk_size))
+    assert items == json.loads(content).get('responses', [])
+
+
+def test_number_split_after_the_decimal_point():
+    assert list(iter_json_array_items(io.BytesIO(b'{"responses":[12.5]}'), 'responses', chunk_size=1)) == [12.5]
@@ -0,0 +1,170 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import piexif
+
+import http_transport
+import pipeline_metrics
+
+try:
+    import av
+except ImportError:
+    # only needed for face detection in videos, pip install av
+    av = None
+
+# sampled frames per second of video, only keyframes are decoded so the actual rate is at most the keyframe rate
+VIDEO_FRAMES_PER_SECOND = float(os.environ.get('VIDEO_FRAMES_PER_SECOND', 0.5))
+VIDEO_MAX_FRAMES = int(os.environ.get('VIDEO_MAX_FRAMES', 60))
+# dHash bits a frame has to differ in from the last kept frame, a static scene yields a single frame
+VIDEO_FRAME_MIN_HAMMING_DISTANCE = int(os.environ.get('VIDEO_FRAME_MIN_HAMMING_DISTANCE', 8))
+# longest side of a frame sent to Vision
+VIDEO_FRAME_MAX_SIZE = int(os.environ.get('VIDEO_FRAME_MAX_SIZE', 1920))
+VIDEO_FRAME_QUALITY = 90
+VIDEO_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# videos are downloaded into a temporary file, which on Cloud Functions is in memory and counts against the
+# memory limit of the function, larger videos are skipped. Point TMPDIR to a disk backed mount for large videos
+VIDEO_MAX_MB = int(os.environ.get('VIDEO_MAX_MB', 512))
+VIDEO_DOWNLOAD_TIMEOUT = (10, 60)
+
+
+class VideoTooLargeError(Exception):
+    pass
+
+
+def perceptual_hash(image):
+    '''
+    64 bit difference hash of an image, robust against re-encoding and small color changes
+    returns: the hash as a 16 digit hex string
+    '''
+    if image.format == 'JPEG':
+        # decoding at 1/8 scale is plenty for a 9x8 thumbnail
+        image.draft('L', (64, 64))
+    pixels = list(image.convert('L').resize((9, 8)).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f'{bits:016x}'
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def check_video_support():
+    '''
+    Fails if PyAV is missing, called where videos are enabled so that this shows up before any video is downloaded
+    '''
+    if av is None:
+        raise ImportError('PyAV is required for face detection in videos, pip install av')
+
+
+def iter_keyframes(video_path, frames_per_second=VIDEO_FRAMES_PER_SECOND):
+    '''
+    Decodes keyframes of a video at about frames_per_second, without decoding any other frame.
+    Packets are skipped before decoding unless they hold a keyframe that is due, which is a small
+    fraction of the work of decoding the whole video.
+    yields:
+        tuples (seconds from the start, PIL image)
+    '''
+    check_video_support()
+    interval = 1 / frames_per_second
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = 'NONKEY'
+        next_seconds = 0.0
+        for packet in container.demux(stream):
+            if not packet.is_keyframe or packet.pts is None:
+                continue
+            packet_seconds = float(packet.pts * packet.time_base)
+            if packet_seconds < next_seconds:
+                continue
+            # the decoder may hand a frame out a few packets later, so the sampling goes by the packets
+            next_seconds = packet_seconds + interval
+            for frame in stream.decode(packet):
+                yield _frame_seconds(frame, stream), frame.to_image()
+        for frame in stream.decode(None):
+            yield _frame_seconds(frame, stream), frame.to_image()
+
+
+def _frame_seconds(frame, stream):
+    return float(frame.pts * (frame.time_base or stream.time_base))
+
+
+def drop_near_duplicate_frames(frames, min_distance=VIDEO_FRAME_MIN_HAMMING_DISTANCE):
+    '''
+    Drops frames whose dHash is within min_distance bits of the last frame that was kept
+    '''
+    last_hash = None
+    for seconds, image in frames:
+        frame_hash = perceptual_hash(image)
+        if last_hash is not None and hamming_distance(frame_hash, last_hash) < min_distance:
+            continue
+        last_hash = frame_hash
+        yield seconds, image
+
+
+def frame_to_jpeg(image, seconds, video_file_name, creation_time=None, max_size=VIDEO_FRAME_MAX_SIZE):
+    '''
+    Encodes a frame as JPEG, with the time of the frame in the EXIF: DateTimeOriginal and SubSecTimeOriginal
+    of the moment it shows if the creation time of the video is known, and ImageDescription with the offset
+    into the video, e.g. "VID_20221029.mp4@12.345s"
+    Args:
+        creation_time: string, creationTime of the video media item, e.g. "2022-10-29T12:34:56Z"
+    '''
+    if max_size and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size))
+    exif_dict = {'0th': {piexif.ImageIFD.ImageDescription: '{}@{:.3f}s'.format(video_file_name, seconds).encode('utf-8')}, 'Exif': {}}
+    if creation_time is not None:
+        frame_time = datetime.strptime(creation_time[:19], '%Y-%m-%dT%H:%M:%S') + timedelta(seconds=seconds)
+        exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = frame_time.strftime('%Y:%m:%d %H:%M:%S').encode('ascii')
+        exif_dict['Exif'][piexif.ExifIFD.SubSecTimeOriginal] = '{:03d}'.format(frame_time.microsecond // 1000).encode('ascii')
+    jpeg = BytesIO()
+    image.convert('RGB').save(jpeg, format='JPEG', quality=VIDEO_FRAME_QUALITY, exif=piexif.dump(exif_dict))
+    return jpeg.getvalue()
+
+
+def frame_file_name(video_file_name, seconds):
+    '''
+    returns: the file name of a frame, e.g. VID_20221029_frame000012345.jpg for 12.345 s into VID_20221029.mp4
+    '''
+    return '{}_frame{:09d}.jpg'.format(os.path.splitext(video_file_name)[0], round(seconds * 1000))
+
+
+def extract_video_frames(item, frames_per_second=VIDEO_FRAMES_PER_SECOND, max_frames=VIDEO_MAX_FRAMES, max_size_mb=VIDEO_MAX_MB):
+    '''
+    Downloads a video media item into a temporary file and extracts its sampled, distinct keyframes
+    Args:
+        item: media item dict of a video
+        max_size_mb: int, size of the largest video that is downloaded, see VIDEO_MAX_MB
+    returns:
+        list of (frame file name, JPEG bytes)
+    raises:
+        VideoTooLargeError if the video is larger than max_size_mb, the download stops there
+    '''
+    max_bytes = max_size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(item['filename'])[1]) as video_file:
+        with pipeline_metrics.span('download') as span, \
+                http_transport.get(item['baseUrl'] + '=dv', stream=True, timeout=VIDEO_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length', 0)) > max_bytes:
+                raise VideoTooLargeError('{} is larger than {} MiB'.format(item['filename'], max_size_mb))
+            # the video goes to the temporary file as it arrives, it is never in the memory of the process as a whole
+            for chunk in response.iter_content(VIDEO_DOWNLOAD_CHUNK_SIZE):
+                video_file.write(chunk)
+                span.add(bytes=len(chunk))
+                if video_file.tell() > max_bytes:
+                    raise VideoTooLargeError('{} is larger than {} MiB'.format(item['filename'], max_size_mb))
+            span.add(items=1)
+        video_file.flush()
+        frames = []
+        with pipeline_metrics.span('video', items=1) as span:
+            for seconds, image in drop_near_duplicate_frames(iter_keyframes(video_file.name, frames_per_second)):
+                frames.append((frame_file_name(item['filename'], seconds),
+                               frame_to_jpeg(image, seconds, item['filename'], item['mediaMetadata'].get('creationTime'))))
+                if len(frames) >= max_frames:
+                    break
+            span.add(bytes=sum(len(jpeg) for _, jpeg in frames))
+    return frames
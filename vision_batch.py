@@ -0,0 +1,229 @@
+import codecs
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import vision_v1
+
+import client_registry
+import pipeline_metrics
+from google_cloud_storage_api import GoogleStorageHelper
+from google_logging import structured_log, LogSeverity
+
+# see https://cloud.google.com/vision/quotas, an async batch accepts at most 2000 images
+# and writes at most 100 responses into each output json file
+MAX_IMAGES_PER_OPERATION = 2000
+MAX_RESPONSES_PER_OUTPUT_FILE = 100
+# smaller shards finish sooner, so cropping can start while the rest is still annotated
+DEFAULT_SHARD_SIZE = 100
+POLL_INTERVAL_SECONDS = 5
+SUBMIT_WORKERS = 8
+# output files are read this many bytes at a time, see iter_result_responses
+RESULT_READ_CHUNK_SIZE = 256 * 1024
+
+
+def shard_file_names(file_name_list, shard_size=DEFAULT_SHARD_SIZE):
+    '''
+    Splits the file names into shards that fit into a single async batch operation
+    '''
+    shard_size = max(1, min(shard_size, MAX_IMAGES_PER_OPERATION))
+    return [file_name_list[i:i + shard_size] for i in range(0, len(file_name_list), shard_size)]
+
+
+def submit_batch_annotate_images(client, bucket_name, input_image_file_name_list, output_file_prefix, annotation_type):
+    '''
+    Starts a single async batch annotation without waiting for it
+    return: the long running operation
+    '''
+    features = [
+        {"type_": annotation_type},
+    ]
+    # Each requests element corresponds to a single image.
+    requests = [{"image": {"source":  {"image_uri": f"gs://{bucket_name}/{file_name}"}}, "features": features} for file_name in input_image_file_name_list]
+    output_config = {"gcs_destination": {"uri": f"gs://{bucket_name}/{output_file_prefix}"},
+                     "batch_size": min(len(input_image_file_name_list), MAX_RESPONSES_PER_OUTPUT_FILE)}
+    return client.async_batch_annotate_images(requests=requests, output_config=output_config)
+
+
+def iter_sharded_batch_annotate_images(
+    bucket_name,
+    input_image_file_name_list,
+    output_file_prefix,
+    annotation_type=vision_v1.Feature.Type.FACE_DETECTION,
+    shard_size=DEFAULT_SHARD_SIZE,
+    timeout=None,
+):
+    '''
+    Annotates the images in shards that are submitted concurrently and polled without blocking on any single one.
+    Args:
+        bucket_name: string, bucket holding the images, the results are written there too
+        input_image_file_name_list: list of file names in the bucket
+        output_file_prefix: string, prefix of the output files, each shard writes under f'{output_file_prefix}shard{n}_'
+        annotation_type: vision_v1.Feature.Type
+        shard_size: int, number of images per operation
+        timeout: float, seconds to wait for all shards, None to wait forever
+    yields:
+        list of output json file names of each shard, as soon as the shard is done
+    '''
+    client = client_registry.get_vision_client()
+    storage_helper = GoogleStorageHelper(bucket_name)
+    shards = shard_file_names(list(input_image_file_name_list), shard_size)
+    shard_prefixes = [f'{output_file_prefix}shard{n}_' for n in range(len(shards))]
+    structured_log('Submitting {} images in {} annotation shards'.format(sum(len(shard) for shard in shards), len(shards)))
+    submitted_at = time.monotonic()
+    with ThreadPoolExecutor(max_workers=SUBMIT_WORKERS) as executor:
+        operations = list(executor.map(
+            lambda args: submit_batch_annotate_images(client, bucket_name, args[0], args[1], annotation_type),
+            zip(shards, shard_prefixes),
+        ))
+
+    pending = dict(zip(shard_prefixes, operations))
+    shard_sizes = dict(zip(shard_prefixes, map(len, shards)))
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while pending:
+        for shard_prefix, operation in list(pending.items()):
+            # done() refreshes the operation state with a single non-blocking call
+            if not operation.done():
+                continue
+            del pending[shard_prefix]
+            # time from submission until the shard was seen done, so it includes up to POLL_INTERVAL_SECONDS of polling
+            shard_seconds = time.monotonic() - submitted_at
+            if operation.exception() is not None:
+                pipeline_metrics.record('vision', shard_seconds, errors=1)
+                structured_log('Annotation shard {} failed: {}'.format(shard_prefix, operation.exception()), severity=LogSeverity.ERROR)
+                continue
+            output_file_names = list_output_files(storage_helper, shard_prefix)
+            pipeline_metrics.record('vision', shard_seconds, items=shard_sizes[shard_prefix])
+            structured_log('Annotation shard {} done with output files: {}'.format(shard_prefix, output_file_names))
+            yield output_file_names
+        if pending:
+            if deadline is not None and time.monotonic() > deadline:
+                structured_log('Gave up waiting for annotation shards: {}'.format(list(pending)), severity=LogSeverity.ERROR)
+                pipeline_metrics.record('vision', time.monotonic() - submitted_at, errors=len(pending))
+                return
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+
+def list_output_files(storage_helper, output_file_prefix):
+    '''
+    Finds all output json files of an annotation, e.g. output-1-to-100.json, output-101-to-150.json
+    '''
+    return sorted(
+        (name for name in storage_helper.list_file_names(output_file_prefix) if name.endswith('.json')),
+        key=_output_file_start,
+    )
+
+
+def _output_file_start(file_name):
+    # output-{start}-to-{end}.json
+    try:
+        return int(file_name.rsplit('output-', 1)[1].split('-to-')[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def iter_result_responses(storage_helper, result_file_name, chunk_size=RESULT_READ_CHUNK_SIZE):
+    '''
+    Streams the responses of an output json file, {"responses": [...]}, from the bucket.
+    The file is read and parsed a chunk at a time, so memory does not grow with the number of responses
+    and the first response is there before the rest of the file is downloaded.
+    yields:
+        response dicts, in file order
+    '''
+    with storage_helper.open_file(result_file_name, chunk_size) as f:
+        yield from iter_json_array_items(f, 'responses', chunk_size)
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CONTINUATION = frozenset('.eE+-0123456789')
+
+
+class _JsonStreamReader:
+    '''
+    Reads json values one at a time from a binary file, keeping only the unparsed rest of the last chunks
+    '''
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _fill(self):
+        '''
+        returns: False at the end of the file
+        '''
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk, final=self.eof)
+        self.position = 0
+        return not self.eof
+
+    def peek(self):
+        '''
+        returns: the next character that is not whitespace, without consuming it
+        '''
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError('Unexpected end of json')
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at {!r}'.format(char, self.buffer[self.position:self.position + 20]))
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # the value continues in the next chunk
+                if not self._fill():
+                    raise
+                continue
+            # so might a number, 12 may be the start of 12.5 or 12e3, only the character after it tells
+            if (end == len(self.buffer) or self.buffer[end] in _NUMBER_CONTINUATION) and self._fill():
+                continue
+            self.position = end
+            return value
+
+
+def iter_json_array_items(f, key, chunk_size=RESULT_READ_CHUNK_SIZE):
+    '''
+    Iterates over the items of the array under key of the json object in a binary file, e.g. a Vision output file,
+    parsing one item at a time. The other keys of the object are parsed and dropped.
+    '''
+    reader = _JsonStreamReader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.position += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() != ',':
+                        reader.expect(']')
+                        break
+                    reader.position += 1
+        else:
+            reader.value()
+        if reader.peek() != ',':
+            reader.expect('}')
+            return
+        reader.position += 1